@@ -5,8 +5,11 @@ from os.path import dirname, abspath
 import ast
 import unittest
 
-from pystaging.quotation import symbol, staging, quote, escape, run, string
+from pystaging.quotation import (symbol, namescope, staging, quote, escape,
+                                 run, string)
 from pystaging.astutils import astcompile
+from pystaging.compilation import (CompilationUnit, IncrementalCompiler,
+                                   StreamCompiler)
 
 __version__ = '0.1'
 
@@ -4,9 +4,9 @@
 AST utilities:
 
     - parse
-    - compile
-    - stringify
-    - wrap
+    - compile (with an opt-in compile cache)
+    - stringify (an iterative unparser)
+    - wrap (and persist objects in generated code)
     - escape
 """
 
@@ -14,49 +14,286 @@ from __future__ import print_function, division, absolute_import
 
 import ast
 import sys
+import threading
 from functools import partial
 
-from pystaging.utils import hashable
+from pystaging.utils import hashable, LRUCache
 
 # ______________________________________________________________________
 
 is_expr = lambda tree: isinstance(tree, (ast.Expression, ast.expr))
 is_stmt = lambda tree: isinstance(tree, (ast.stmt, ast.Suite, ast.Module))
 
-def astcompile(tree, filename="<string>", flags=0):
-    """Compile an AST"""
+def materialize(tree):
+    """
+    The AST of a lazy quotation (see templates.LazyQuotation), other trees
+    are returned as they are.
+    """
+    if isinstance(tree, ast.AST):
+        return tree
+    build = getattr(tree, 'materialize', None)
+    return build() if build is not None else tree
+
+def astcompile(tree, filename="<string>", flags=0, cache=False, key=None):
+    """
+    Compile an AST. With cache=True the code object is kept in the compile
+    cache, keyed by the identity of the tree, or of key for a tree built
+    around it: compiling the same tree again returns the same code, as long
+    as it is not modified in place.
+    """
+    tree = materialize(tree)
+    if key is None:
+        key = tree
     env = sys._getframe(1).f_globals
     if "print_function" in env and env["print_function"].compiler_flag:
         flags |= env["print_function"].compiler_flag
 
     if is_stmt(tree):
-        return _compilestmt(tree, filename, flags)
+        if not isinstance(tree, ast.Module):
+            tree = ast.Module([tree])
+        mode = 'exec'
     else:
         assert is_expr(tree), tree
-        return _compileexpr(tree, filename, flags)
+        if not isinstance(tree, ast.Expression):
+            tree = ast.Expression(tree)
+        mode = 'eval'
+
+    if cache and compile_cache.enabled:
+        return compile_cache.compile(key, filename, mode, flags, tree)
+    return _compile(tree, filename, mode, flags)
+
+def _compile(tree, filename, mode, flags):
+    fix_locations(tree)
+    return compile(tree, filename, mode, flags, True)
+
+def fix_locations(tree):
+    """
+    Iterative ast.fix_missing_locations: nodes without a location get the
+    location of their parent, or 1, 0 at the top.
+    """
+    stack = [(tree, 1, 0)]
+    pop, push = stack.pop, stack.append
+    while stack:
+        node, lineno, col_offset = pop()
+        attrs = node.__dict__
+        if 'lineno' in node._attributes:
+            if 'lineno' in attrs:
+                lineno = attrs['lineno']
+            else:
+                node.lineno = lineno
+            if 'col_offset' in attrs:
+                col_offset = attrs['col_offset']
+            else:
+                node.col_offset = col_offset
+        for field in node._fields:
+            value = attrs.get(field)
+            if isinstance(value, ast.AST):
+                push((value, lineno, col_offset))
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        push((item, lineno, col_offset))
+    return tree
+
+# ______________________________________________________________________
+# Compile cache
+
+# Structural keys precomputed for interned nodes (see pystaging.interning):
+# id(node) -> (node, fields, key), added and removed by the InternTable
+# owning the node, with the field values the node was created with. A key
+# is only used while every node under it still has those field values.
+keycache = {}
+
+def fieldkey(value):
+    """Key of a field value: the identity of an AST, else its structure"""
+    if isinstance(value, ast.AST):
+        return id(value)
+    elif isinstance(value, list):
+        return (list,) + tuple(map(fieldkey, value))
+    return structkey(value)
+
+def snapshot(fields):
+    """Field values to check a node against, with lists copied"""
+    return tuple([tuple(value) if isinstance(value, list) else value
+                  for value in fields])
+
+def unchanged(node, fields):
+    """Whether the fields of node still hold the values of a snapshot"""
+    attrs = node.__dict__
+    for name, value in zip(node._fields, fields):
+        current = attrs.get(name)
+        if current is value:
+            continue
+        elif isinstance(current, list) and type(value) is tuple:
+            if len(current) != len(value) or any(
+                    a is not b for a, b in zip(current, value)):
+                return False
+        elif (isinstance(current, (ast.AST, list)) or
+                  structkey(current) != structkey(value)):
+            return False
+    return True
+
+def structkey(tree):
+    """
+    Canonical structural key for an AST: node types, fields and constants,
+    ignoring source locations. Structurally identical trees have equal keys.
+    Interned subtrees (see pystaging.interning) that were not modified
+    since they were interned share their precomputed key.
+    """
+    return keyof(tree)[0]
+
+def keyof(tree):
+    """Return the structural key of tree and whether it is unmodified"""
+    if isinstance(tree, ast.AST):
+        keys, unmodified = [], True
+        for field in tree._fields:
+            key, same = keyof(getattr(tree, field, None))
+            keys.append(key)
+            unmodified = unmodified and same
+        entry = keycache.get(id(tree))
+        if (unmodified and entry is not None and entry[0] is tree and
+                unchanged(tree, entry[1])):
+            return entry[2], True
+        return (type(tree),) + tuple(keys), False
+    elif isinstance(tree, list):
+        results = map(keyof, tree)
+        return ((list,) + tuple(key for key, same in results),
+                all(same for key, same in results))
+    elif isinstance(tree, (int, long, float, complex)):
+        # Distinguish 1, 1.0 and True, and 0.0 and -0.0
+        return (type(tree), repr(tree)), True
+    else:
+        return (type(tree), tree), True
+
+class CompileCache(object):
+    """
+    LRU cache of code objects keyed by the identity of the compiled AST,
+    the compile mode, flags and filename. A structural key costs about as
+    much as compiling, an identity key is cheap; interned trees
+    (pystaging.interning) are shared by identity, so structurally
+    identical interned quotations share their code. Cached trees are kept
+    alive by the cache and must not be modified in place. The cache may be
+    shared by several threads: lookups and updates hold a lock, compiling
+    does not.
 
-def _compilestmt(tree, filename, flags):
-    if not isinstance(tree, ast.Module):
-        tree = ast.Module([tree])
-    ast.fix_missing_locations(tree)
-    return compile(tree, filename, 'exec', flags, True)
+        enabled: set to False to always invoke the compiler
+    """
 
-def _compileexpr(tree, filename, flags):
-    if not isinstance(tree, ast.Expression):
-        tree = ast.Expression(tree)
-    ast.fix_missing_locations(tree)
-    return compile(tree, filename, 'eval', flags, True)
+    def __init__(self, maxsize=512, enabled=True):
+        self.cache = LRUCache(maxsize)
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+    def compile(self, tree, filename, mode, flags, module=None):
+        """
+        Compile tree, or module when given (a Module or Expression wrapping
+        tree), keyed by the identity of tree.
+        """
+        key = (id(tree), filename, mode, flags)
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None and entry[0] is tree:
+            return entry[1]
+
+        code = _compile(tree if module is None else module,
+                        filename, mode, flags)
+        with self.lock:
+            self.cache[key] = (tree, code)
+        return code
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            return self.cache.stats()
+
+compile_cache = CompileCache()
 
 
 def astparse(tree, filename="<string>", flags=0):
     pass
 
-def wrap(obj):
-    """Wrap an object in an AST"""
+def copynode(node, **fields):
+    """Shallow copy an AST node, replacing the given fields"""
+    new = type(node).__new__(type(node))
+    new.__dict__.update(node.__dict__)
+    new.__dict__.update(fields)
+    return new
+
+def copytree(tree):
+    """
+    Deep copy the AST nodes of a tree (or a list of trees), sharing the
+    values in them, e.g. the objects of Persisted nodes.
+    """
+    root = [tree]
+    stack = [root]
+    while stack:
+        attrs = stack.pop()
+        items = enumerate(attrs) if isinstance(attrs, list) else \
+                attrs.iteritems()
+        for key, value in list(items):
+            if isinstance(value, list):
+                value = attrs[key] = list(value)
+                stack.append(value)
+            elif isinstance(value, ast.AST):
+                new = type(value).__new__(type(value))
+                new.__dict__.update(value.__dict__)
+                attrs[key] = new
+                stack.append(new.__dict__)
+    return root[0]
+
+def boundnames(stmts):
+    """The names the statements bind in the scope they run in"""
+    names = set()
+    stack = list(stmts)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names.add(node.name)
+            stack.extend(node.decorator_list)
+            stack.extend(getattr(node, 'bases', ()))
+            if isinstance(node, ast.FunctionDef):
+                stack.extend(node.args.defaults)
+        elif isinstance(node, ast.Name) and not isinstance(node.ctx,
+                                                           ast.Load):
+            names.add(node.id)
+        elif isinstance(node, ast.alias):
+            names.add(node.asname or node.name.split('.')[0])
+        elif not isinstance(node, scope_types):
+            stack.extend(ast.iter_child_nodes(node))
+    return names
+
+scope_types = (ast.Lambda, ast.GeneratorExp, ast.SetComp, ast.DictComp)
+
+class Persisted(ast.Name):
+    """
+    A name that generated code loads a persisted object from. The node
+    holds the object, which is bound to the name for the code it is
+    compiled into (see quotation.persist and quotation.compilecode).
+    """
+
+    def __init__(self, id, value):
+        super(Persisted, self).__init__(id, ast.Load())
+        self.value = value
+
+def inlinable(obj):
+    """Whether wrap() expands obj into an AST: None, numbers and strings"""
+    return obj is None or isinstance(obj, (int, long, float, str))
+
+def wrap(obj, persist=None):
+    """
+    Wrap an object in an AST. Literals are expanded into AST nodes, other
+    objects, including containers of any size, are passed to persist,
+    which returns a node that references them, e.g. quotation.persist.
+    """
     if isinstance(obj, ast.AST):
         return obj
-    elif isinstance(obj, (list, dict, tuple, int, float, basestring)):
+    elif inlinable(obj):
         return escape_ast(obj)
+    elif persist is not None:
+        return persist(obj)
     else:
         raise TypeError(
             "Cannot wrap objects of type %s into an AST" % (type(obj),))
@@ -91,7 +328,7 @@ def mk_escaper(ast_module):
         elif isinstance(obj, tuple):
             ret_val = ast_module.Tuple([escape(subobj) for subobj in obj],
                                         ast_module.Load())
-        elif isinstance(obj, int):
+        elif isinstance(obj, (int, long)):
             ret_val = ast_module.Num(obj)
         elif isinstance(obj, float):
             ret_val = ast_module.Num(obj)
@@ -105,4 +342,447 @@ def mk_escaper(ast_module):
 
     return escape_ast
 
-escape_ast = mk_escaper(ast)
\ No newline at end of file
+escape_ast = mk_escaper(ast)
+# ______________________________________________________________________
+# Unparsing
+
+def unparse(tree, file=None):
+    """
+    Return Python source code for an AST, or write it to a file object.
+    Operator expressions are fully parenthesized. Statements are followed
+    by a newline, expressions are not.
+    """
+    tree = materialize(tree)
+    if file is not None:
+        Unparser(file.write).run(tree)
+    else:
+        chunks = []
+        Unparser(chunks.append).run(tree)
+        return "".join(chunks)
+
+INDENT, DEDENT, FILL = object(), object(), object()
+
+# Source of inf, which has no literal
+INFSTR = "1e" + repr(sys.float_info.max_10_exp + 1)
+
+class Unparser(object):
+    """
+    Iterative unparser. Each node handler returns the pieces of its source
+    in order: strings, child nodes and the INDENT, DEDENT and FILL (newline
+    and indentation) markers. Pieces are expanded from an explicit stack,
+    so arbitrarily deep trees do not exhaust the Python stack. Output is
+    buffered and passed to write in chunks of bufsize pieces.
+    """
+
+    binops = {
+        'Add': '+', 'Sub': '-', 'Mult': '*', 'Div': '/', 'Mod': '%',
+        'LShift': '<<', 'RShift': '>>', 'BitOr': '|', 'BitXor': '^',
+        'BitAnd': '&', 'FloorDiv': '//', 'Pow': '**',
+    }
+    unops = {'Invert': '~', 'Not': 'not', 'UAdd': '+', 'USub': '-'}
+    cmpops = {
+        'Eq': '==', 'NotEq': '!=', 'Lt': '<', 'LtE': '<=', 'Gt': '>',
+        'GtE': '>=', 'Is': 'is', 'IsNot': 'is not', 'In': 'in',
+        'NotIn': 'not in',
+    }
+    boolops = {'And': 'and', 'Or': 'or'}
+
+    def __init__(self, write, bufsize=8192):
+        self.write = write
+        self.bufsize = bufsize
+        self.unicode_literals = False
+        self.handlers = {} # node type -> handler
+
+    def run(self, tree):
+        buf, written, level = [], False, 0
+        stack = [tree]
+        pop, push, extend = stack.pop, stack.append, stack.extend
+        handlers = self.handlers
+        while stack:
+            item = pop()
+            cls = type(item)
+            if cls is str or cls is unicode:
+                buf.append(item)
+                if len(buf) >= self.bufsize:
+                    self.write("".join(buf))
+                    buf, written = [], True
+            elif item is FILL:
+                push("    " * level)
+                if buf or written:
+                    push("\n")
+            elif item is INDENT:
+                level += 1
+            elif item is DEDENT:
+                level -= 1
+            elif cls is list:
+                extend(reversed(self.statements(item)))
+            else:
+                handler = handlers.get(cls) or self.handler(cls)
+                extend(reversed(handler(item)))
+
+        if isinstance(tree, (ast.stmt, ast.mod, list)) and not (
+                isinstance(tree, ast.Expression)):
+            buf.append("\n")
+        if buf:
+            self.write("".join(buf))
+
+    # __________________________________________________________________
+    # Helpers
+
+    def handler(self, cls):
+        handler = getattr(self, 'unparse_' + cls.__name__, None)
+        if handler is None:
+            raise NotImplementedError("Cannot unparse %s" % cls.__name__)
+        self.handlers[cls] = handler
+        return handler
+
+    def statements(self, stmts):
+        return list(stmts) or [FILL, "pass"]
+
+    def block(self, header, body):
+        """header: body, with the body indented"""
+        return header + [":", INDENT] + self.statements(body) + [DEDENT]
+
+    def commas(self, items):
+        pieces = []
+        for i, item in enumerate(items):
+            if i:
+                pieces.append(", ")
+            pieces.append(item)
+        return pieces
+
+    def decorators(self, node):
+        pieces = []
+        for decorator in node.decorator_list:
+            pieces.extend([FILL, "@", decorator])
+        return pieces
+
+    # __________________________________________________________________
+    # Modules
+
+    def unparse_Module(self, node):
+        return self.statements(node.body) if node.body else []
+
+    unparse_Interactive = unparse_Suite = unparse_Module
+
+    def unparse_Expression(self, node):
+        return [node.body]
+
+    # __________________________________________________________________
+    # Statements
+
+    def unparse_Expr(self, node):
+        return [FILL, node.value]
+
+    def unparse_Assign(self, node):
+        pieces = [FILL]
+        for target in node.targets:
+            pieces.extend([target, " = "])
+        return pieces + [node.value]
+
+    def unparse_AugAssign(self, node):
+        op = self.binops[type(node.op).__name__]
+        return [FILL, node.target, " %s= " % op, node.value]
+
+    def unparse_Print(self, node):
+        pieces = [FILL, "print "]
+        values = list(node.values)
+        if node.dest:
+            pieces.extend([">>", node.dest])
+            if values:
+                pieces.append(", ")
+        pieces.extend(self.commas(values))
+        if not node.nl:
+            pieces.append(",")
+        return pieces
+
+    def unparse_Delete(self, node):
+        return [FILL, "del "] + self.commas(node.targets)
+
+    def unparse_Pass(self, node):
+        return [FILL, "pass"]
+
+    def unparse_Break(self, node):
+        return [FILL, "break"]
+
+    def unparse_Continue(self, node):
+        return [FILL, "continue"]
+
+    def unparse_Return(self, node):
+        if node.value is None:
+            return [FILL, "return"]
+        return [FILL, "return ", node.value]
+
+    def unparse_Global(self, node):
+        return [FILL, "global ", ", ".join(node.names)]
+
+    def unparse_Import(self, node):
+        return [FILL, "import "] + self.commas(node.names)
+
+    def unparse_ImportFrom(self, node):
+        module = "." * (node.level or 0) + (node.module or "")
+        if module == '__future__' and any(alias.name == 'unicode_literals'
+                                          for alias in node.names):
+            self.unicode_literals = True
+        return [FILL, "from ", module, " import "] + self.commas(node.names)
+
+    def unparse_Exec(self, node):
+        pieces = [FILL, "exec ", node.body]
+        if node.globals:
+            pieces.extend([" in ", node.globals])
+        if node.locals:
+            pieces.extend([", ", node.locals])
+        return pieces
+
+    def unparse_Raise(self, node):
+        pieces = [FILL, "raise"]
+        if node.type:
+            pieces.extend([" ", node.type])
+        if node.inst:
+            pieces.extend([", ", node.inst])
+        if node.tback:
+            pieces.extend([", ", node.tback])
+        return pieces
+
+    def unparse_Assert(self, node):
+        pieces = [FILL, "assert ", node.test]
+        if node.msg:
+            pieces.extend([", ", node.msg])
+        return pieces
+
+    def unparse_If(self, node):
+        pieces = self.block([FILL, "if ", node.test], node.body)
+        # Collapse nested ifs into elifs
+        while (len(node.orelse) == 1 and
+               isinstance(node.orelse[0], ast.If)):
+            node = node.orelse[0]
+            pieces.extend(self.block([FILL, "elif ", node.test], node.body))
+        if node.orelse:
+            pieces.extend(self.block([FILL, "else"], node.orelse))
+        return pieces
+
+    def unparse_For(self, node):
+        pieces = self.block([FILL, "for ", node.target, " in ", node.iter],
+                            node.body)
+        if node.orelse:
+            pieces.extend(self.block([FILL, "else"], node.orelse))
+        return pieces
+
+    def unparse_While(self, node):
+        pieces = self.block([FILL, "while ", node.test], node.body)
+        if node.orelse:
+            pieces.extend(self.block([FILL, "else"], node.orelse))
+        return pieces
+
+    def unparse_With(self, node):
+        header = [FILL, "with ", node.context_expr]
+        if node.optional_vars:
+            header.extend([" as ", node.optional_vars])
+        return self.block(header, node.body)
+
+    def unparse_TryExcept(self, node):
+        pieces = self.block([FILL, "try"], node.body)
+        pieces.extend(node.handlers)
+        if node.orelse:
+            pieces.extend(self.block([FILL, "else"], node.orelse))
+        return pieces
+
+    def unparse_TryFinally(self, node):
+        if len(node.body) == 1 and isinstance(node.body[0], ast.TryExcept):
+            # try-except-finally
+            pieces = [node.body[0]]
+        else:
+            pieces = self.block([FILL, "try"], node.body)
+        return pieces + self.block([FILL, "finally"], node.finalbody)
+
+    def unparse_ExceptHandler(self, node):
+        header = [FILL, "except"]
+        if node.type:
+            header.extend([" ", node.type])
+        if node.name:
+            header.extend([" as ", node.name])
+        return self.block(header, node.body)
+
+    def unparse_FunctionDef(self, node):
+        header = [FILL, "def ", node.name, "(", node.args, ")"]
+        return self.decorators(node) + self.block(header, node.body)
+
+    def unparse_ClassDef(self, node):
+        header = [FILL, "class ", node.name]
+        if node.bases:
+            header.extend(["("] + self.commas(node.bases) + [")"])
+        return self.decorators(node) + self.block(header, node.body)
+
+    # __________________________________________________________________
+    # Expressions
+
+    def unparse_Name(self, node):
+        return [node.id]
+
+    unparse_Persisted = unparse_Name
+
+    def unparse_Num(self, node):
+        if isinstance(node.n, float) and node.n != node.n:
+            return ["(%s - %s)" % (INFSTR, INFSTR)] # nan
+        source = repr(node.n).replace("inf", INFSTR)
+        if source.startswith("-"):
+            source = "(%s)" % source
+        return [source]
+
+    def unparse_Str(self, node):
+        if self.unicode_literals and isinstance(node.s, str):
+            return ["b" + repr(node.s)]
+        return [repr(node.s)]
+
+    def unparse_Repr(self, node):
+        return ["`", node.value, "`"]
+
+    def unparse_Attribute(self, node):
+        pieces = [node.value]
+        # 1.real is a syntax error, 1 .real is not
+        if (isinstance(node.value, ast.Num) and
+                isinstance(node.value.n, (int, long))):
+            pieces.append(" ")
+        return pieces + [".", node.attr]
+
+    def unparse_Subscript(self, node):
+        return [node.value, "[", node.slice, "]"]
+
+    def unparse_Index(self, node):
+        return [node.value]
+
+    def unparse_Slice(self, node):
+        pieces = []
+        if node.lower:
+            pieces.append(node.lower)
+        pieces.append(":")
+        if node.upper:
+            pieces.append(node.upper)
+        if node.step:
+            pieces.extend([":", node.step])
+        return pieces
+
+    def unparse_ExtSlice(self, node):
+        return self.commas(node.dims)
+
+    def unparse_Ellipsis(self, node):
+        return ["..."]
+
+    def unparse_Call(self, node):
+        args = list(node.args) + list(node.keywords)
+        if node.starargs:
+            args.append(["*", node.starargs])
+        if node.kwargs:
+            args.append(["**", node.kwargs])
+        pieces = [node.func, "("]
+        for piece in self.commas(args):
+            if isinstance(piece, list):
+                pieces.extend(piece)
+            else:
+                pieces.append(piece)
+        return pieces + [")"]
+
+    def unparse_keyword(self, node):
+        return [node.arg, "=", node.value]
+
+    def unparse_BinOp(self, node):
+        op = self.binops[type(node.op).__name__]
+        return ["(", node.left, " %s " % op, node.right, ")"]
+
+    def unparse_UnaryOp(self, node):
+        pieces = ["(", self.unops[type(node.op).__name__], " "]
+        if isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Num):
+            # -(1) rather than --1 for negative numbers
+            pieces.extend(["(", node.operand, ")"])
+        else:
+            pieces.append(node.operand)
+        return pieces + [")"]
+
+    def unparse_BoolOp(self, node):
+        op = " %s " % self.boolops[type(node.op).__name__]
+        pieces = ["("]
+        for i, value in enumerate(node.values):
+            if i:
+                pieces.append(op)
+            pieces.append(value)
+        return pieces + [")"]
+
+    def unparse_Compare(self, node):
+        pieces = ["(", node.left]
+        for op, comparator in zip(node.ops, node.comparators):
+            pieces.extend([" %s " % self.cmpops[type(op).__name__],
+                           comparator])
+        return pieces + [")"]
+
+    def unparse_IfExp(self, node):
+        return ["(", node.body, " if ", node.test, " else ", node.orelse, ")"]
+
+    def unparse_Lambda(self, node):
+        return ["(lambda ", node.args, ": ", node.body, ")"]
+
+    def unparse_Yield(self, node):
+        if node.value is None:
+            return ["(yield)"]
+        return ["(yield ", node.value, ")"]
+
+    def unparse_Tuple(self, node):
+        if len(node.elts) == 1:
+            return ["(", node.elts[0], ",)"]
+        return ["("] + self.commas(node.elts) + [")"]
+
+    def unparse_List(self, node):
+        return ["["] + self.commas(node.elts) + ["]"]
+
+    def unparse_Set(self, node):
+        return ["{"] + self.commas(node.elts) + ["}"]
+
+    def unparse_Dict(self, node):
+        pieces = ["{"]
+        for i, (key, value) in enumerate(zip(node.keys, node.values)):
+            if i:
+                pieces.append(", ")
+            pieces.extend([key, ": ", value])
+        return pieces + ["}"]
+
+    def unparse_ListComp(self, node):
+        return ["[", node.elt] + node.generators + ["]"]
+
+    def unparse_GeneratorExp(self, node):
+        return ["(", node.elt] + node.generators + [")"]
+
+    def unparse_SetComp(self, node):
+        return ["{", node.elt] + node.generators + ["}"]
+
+    def unparse_DictComp(self, node):
+        return ["{", node.key, ": ", node.value] + node.generators + ["}"]
+
+    def unparse_comprehension(self, node):
+        pieces = [" for ", node.target, " in ", node.iter]
+        for condition in node.ifs:
+            pieces.extend([" if ", condition])
+        return pieces
+
+    def unparse_arguments(self, node):
+        args = []
+        ndefaults = len(node.defaults)
+        nplain = len(node.args) - ndefaults
+        for i, arg in enumerate(node.args):
+            if i < nplain:
+                args.append([arg])
+            else:
+                args.append([arg, "=", node.defaults[i - nplain]])
+        if node.vararg:
+            args.append(["*" + node.vararg])
+        if node.kwarg:
+            args.append(["**" + node.kwarg])
+        pieces = []
+        for i, arg in enumerate(args):
+            if i:
+                pieces.append(", ")
+            pieces.extend(arg)
+        return pieces
+
+    def unparse_alias(self, node):
+        if node.asname:
+            return [node.name, " as ", node.asname]
+        return [node.name]
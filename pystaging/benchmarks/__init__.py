@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for pystaging. Run a benchmark module directly, e.g.
+
+    python -m pystaging.benchmarks.bench_templates
+
+or run the registered benchmarks of all modules, see runner.py:
+
+    python runbenchmarks.py --save before.json
+    python runbenchmarks.py --compare before.json
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import timeit
+import collections
+
+def bench(func, number=10000, repeat=3):
+    """Return the best time per call of func in seconds"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def report(name, seconds, baseline=None):
+    """Print a benchmark result, relative to a baseline time if given"""
+    line = "%-40s %10.2f us" % (name, seconds * 1e6)
+    if baseline is not None:
+        line += "  (%.2fx)" % (baseline / seconds)
+    print(line)
+
+# ______________________________________________________________________
+# Benchmark registry, run by pystaging.benchmarks.runner
+
+benchmarks = collections.OrderedDict() # name -> Benchmark
+
+class Benchmark(object):
+    """
+    A registered benchmark.
+
+        setup:  function that prepares the benchmark and returns the
+                function to time
+        number: calls per timing
+        repeat: timings, of which the best is reported
+    """
+
+    def __init__(self, name, setup, number=1000, repeat=3):
+        self.name = name
+        self.setup = setup
+        self.number = number
+        self.repeat = repeat
+
+    def run(self):
+        """Return the best time per call in seconds"""
+        return bench(self.setup(), self.number, self.repeat)
+
+def benchmark(name, number=1000, repeat=3):
+    """Register the decorated setup function as a benchmark"""
+    def decorator(setup):
+        benchmarks[name] = Benchmark(name, setup, number, repeat)
+        return setup
+    return decorator
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the time to build code objects for generated kernels of 10^3 to
+10^5 statements with astcompile(), which runs fix_locations() and compile(),
+and with the assembler of pystaging.bytecode:
+
+    def kernel(A, B, out, scale, offset, f):
+        total = acc = 0
+        out[0] = A[0] * scale + B[0] - offset
+        total = total + f(out[0], k=0)
+        for i in range(0):
+            acc = acc + A[i] * B[i]
+        ...
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging import staging, quote, escape
+from pystaging.astutils import astcompile
+from pystaging.bytecode import bytecompile
+from pystaging.benchmarks import bench, report, benchmark
+
+@staging
+def statements(k, n):
+    with quote as body:
+        out[escape[k]] = A[escape[k]] * scale + B[escape[k]] - offset
+        total = total + f(out[escape[k]], k=escape[k])
+        for i in range(escape[n]):
+            acc = acc + A[i] * B[i]
+    return body
+
+def kernel(size):
+    """A function of size statements, with a loop in every third one"""
+    body = ast.parse("total = acc = 0").body
+    for k in range(size // 3):
+        body.extend(statements(ast.Num(k), ast.Num(k % 8)).body)
+    args = ast.arguments([ast.Name(name, ast.Param()) for name in
+                          ('A', 'B', 'out', 'scale', 'offset', 'f')],
+                         None, None, [])
+    return ast.Module([ast.FunctionDef('kernel', args, body, [])])
+
+@benchmark('backend.compile', number=10)
+def bench_compile():
+    tree = kernel(1000)
+    return lambda: astcompile(tree, cache=False)
+
+@benchmark('backend.bytecode', number=10)
+def bench_bytecode():
+    tree = kernel(1000)
+    return lambda: bytecompile(tree)
+
+def main(sizes=(1000, 10000, 100000)):
+    for size in sizes:
+        tree = kernel(size)
+        number = max(1, 10000 // size)
+        baseline = bench(lambda: astcompile(tree, cache=False),
+                         number=number, repeat=3)
+        report("astcompile, %d statements" % size, baseline)
+        report("bytecompile, %d statements" % size,
+               bench(lambda: bytecompile(tree), number=number, repeat=3),
+               baseline)
+
+if __name__ == '__main__':
+    main()
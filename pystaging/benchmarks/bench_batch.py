@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare running generated kernels one by one with run() against compiling
+them in batches with a CompilationUnit, reporting the cost per kernel as
+the batch size grows.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging import staging, quote, escape, run, CompilationUnit
+from pystaging.benchmarks import bench, report, benchmark
+
+@staging
+def make_kernel(c):
+    with quote as body:
+        def kernel(A, B, out):
+            for i in range(len(out)):
+                out[i] = A[i] * escape[c] + B[i] * (1 - escape[c])
+            return out
+    return body
+
+def runeach(kernels):
+    namespace = {}
+    for kernel in kernels:
+        run(kernel, namespace)
+
+def runbatch(kernels):
+    unit = CompilationUnit()
+    for kernel in kernels:
+        unit.add(kernel)
+    unit.run({})
+
+def kernels(size):
+    return [make_kernel(ast.Num(n / size)) for n in range(size)]
+
+@benchmark('batch.run_each', number=10)
+def bench_run_each():
+    batch = kernels(100)
+    return lambda: runeach(batch)
+
+@benchmark('batch.unit', number=10)
+def bench_unit():
+    batch = kernels(100)
+    return lambda: runbatch(batch)
+
+def main(sizes=(1, 10, 100, 1000)):
+    for size in sizes:
+        batch = kernels(size)
+        number = max(1, 1000 // size)
+        baseline = bench(lambda: runeach(batch), number=number) / size
+        report("run() x %d (per kernel)" % size, baseline)
+        report("CompilationUnit of %d (per kernel)" % size,
+               bench(lambda: runbatch(batch), number=number) / size,
+               baseline)
+
+if __name__ == '__main__':
+    main()
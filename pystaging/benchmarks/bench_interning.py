@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare building and keeping many small, repetitive quotations with
+escape_ast, templates and interned templates: time per quotation and the
+number of distinct AST nodes that stay alive.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging import staging, quote, escape
+from pystaging.interning import InternTable
+from pystaging.benchmarks import bench, report, benchmark
+
+# Staging rebinds the name of the function, so each variant stages one of
+# its own
+@staging
+def make_escaped(c):
+    return quote[out[i] + A[i] * escape[c] - B[i] * escape[c]]
+
+@staging(templates=True)
+def make_template(c):
+    return quote[out[i] + A[i] * escape[c] - B[i] * escape[c]]
+
+@staging(intern=InternTable())
+def make_interned(c):
+    return quote[out[i] + A[i] * escape[c] - B[i] * escape[c]]
+
+@benchmark('interning.escape_ast')
+def bench_escaped():
+    return lambda: make_escaped(ast.Num(3))
+
+@benchmark('interning.templates')
+def bench_template():
+    return lambda: make_template(ast.Num(3))
+
+@benchmark('interning.interned')
+def bench_interned():
+    const = ast.Num(3)
+    return lambda: make_interned(const)
+
+def livenodes(trees):
+    return len(set(id(node) for tree in trees for node in ast.walk(tree)))
+
+def main(n=10000):
+    consts = [ast.Num(k) for k in range(10)]
+    baseline = None
+    for name, make in [("escape_ast", make_escaped),
+                       ("templates", make_template),
+                       ("interned templates", make_interned)]:
+        seconds = bench(lambda: make(consts[3]))
+        baseline = baseline or seconds
+        report(name, seconds, baseline)
+
+        trees = [make(consts[k % len(consts)]) for k in range(n)]
+        print("%-40s %10d nodes" % ("  live after %d quotations" % n,
+                                   livenodes(trees)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare staging and compiling a batch of kernels serially with
+stage_parallel() on increasing numbers of processes.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+import time
+import multiprocessing
+
+from pystaging import staging, quote, escape
+from pystaging.astutils import astcompile, compile_cache
+from pystaging.parallel import stage_parallel
+from pystaging.benchmarks import report, benchmark
+
+@staging
+def make_kernel(c):
+    with quote as body:
+        def kernel(A, B, out):
+            for i in range(len(out)):
+                out[i] = A[i] * escape[c] + B[i] * (1 - escape[c])
+                out[i] = out[i] * out[i] - escape[c] * A[i] / (B[i] + 1)
+            return out
+    return body
+
+def makejobs(n):
+    return [(make_kernel, (ast.Num(k),)) for k in range(n)]
+
+def serial(jobs):
+    return [astcompile(func(*args), cache=False) for func, args in jobs]
+
+@benchmark('parallel.serial', number=1)
+def bench_serial():
+    jobs = makejobs(500)
+    return lambda: serial(jobs)
+
+@benchmark('parallel.processes', number=1)
+def bench_processes():
+    jobs = makejobs(500)
+    return lambda: stage_parallel(jobs, multiprocessing.cpu_count())
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def main(n=2000):
+    jobs = makejobs(n)
+    compile_cache.enabled = False
+    try:
+        baseline = timed(lambda: serial(jobs)) / n
+        report("serial (per kernel)", baseline)
+        for processes in sorted(set([1, 2, multiprocessing.cpu_count()])):
+            seconds = timed(lambda: stage_parallel(jobs, processes)) / n
+            report("%d processes (per kernel)" % processes, seconds,
+                   baseline)
+    finally:
+        compile_cache.enabled = True
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmarks for each stage of the staging pipeline, on a staging
+function with a few quotation and escape sites:
+
+    getsource -> ast.parse -> findquotes/bindings -> process
+              -> escape_ast -> astcompile -> exec
+
+and for the runtime operations on the staged result: building quotations
+(eagerly, or lazily and hashing them), replace, run and unparse.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import ast
+
+from pystaging import staging, quote, escape, run
+from pystaging.utils import getsource
+from pystaging.astutils import astcompile, escape_ast, unparse
+from pystaging.visitors import findquotes, bindings, replace
+from pystaging.quotation import process
+from pystaging.benchmarks import benchmark
+
+def sample(op, n):
+    with quote as body:
+        for i in range(escape[n]):
+            out[i] = escape[op(quote[A[i]], quote[B[i]])] * scale + offset
+            total = total + out[i] * (x - y) / (z + 1.5)
+    return body
+
+original = sample
+
+def plus(a, b):
+    return quote[escape[a] + escape[b]]
+
+original_plus = plus
+add = staging(original_plus)
+
+@staging
+def make_expr():
+    return add(quote[a], quote[b * 2])
+
+def environment():
+    return {'globals': globals(), 'quotation_level': 0,
+            'auto_escape': False, 'hygienic': False, 'templates': False,
+            'constants': {}, 'volatile': False}
+
+def trees(count):
+    """Fresh parse trees for the stages that rewrite in place"""
+    source = getsource(original)
+    return iter([ast.parse(source) for i in range(count)])
+
+@benchmark('pipeline.getsource', number=1000)
+def bench_getsource():
+    return lambda: getsource(original)
+
+@benchmark('pipeline.parse', number=1000)
+def bench_parse():
+    source = getsource(original)
+    return lambda: ast.parse(source)
+
+@benchmark('pipeline.findquotes', number=1000)
+def bench_findquotes():
+    tree = ast.parse(getsource(original))
+    return lambda: findquotes(tree, None)
+
+@benchmark('pipeline.bindings', number=1000)
+def bench_bindings():
+    tree = ast.parse(getsource(original))
+    quotes, escapes = findquotes(tree, None)
+    return lambda: bindings(tree, quotes | escapes)
+
+@benchmark('pipeline.process', number=100)
+def bench_process():
+    fresh = trees(100 * 3)
+    return lambda: process(next(fresh), environment())
+
+@benchmark('pipeline.escape_ast', number=1000)
+def bench_escape_ast():
+    tree = ast.parse("out[i] = A[i] * scale + offset").body[0]
+    return lambda: escape_ast(tree)
+
+@benchmark('pipeline.astcompile', number=1000)
+def bench_astcompile():
+    tree, _ = process(ast.parse(getsource(original)), environment())
+    return lambda: astcompile(tree)
+
+@benchmark('pipeline.astcompile_cached', number=1000)
+def bench_astcompile_cached():
+    tree, _ = process(ast.parse(getsource(original)), environment())
+    return lambda: astcompile(tree, cache=True)
+
+@benchmark('pipeline.decorator', number=100)
+def bench_decorator():
+    # Measure staging, not loading from the disk cache
+    os.environ.pop('PYSTAGING_CACHE_DIR', None)
+    return lambda: staging(original)
+
+@benchmark('runtime.quote', number=1000)
+def bench_quote():
+    staged = staging(original)
+    n = ast.Num(10)
+    return lambda: staged(add, n)
+
+@benchmark('runtime.quote_lazy', number=1000)
+def bench_quote_lazy():
+    staged = staging(original, lazy=True)
+    lazy_add = staging(original_plus, lazy=True)
+    n = ast.Num(10)
+    return lambda: hash(staged(lazy_add, n))
+
+@benchmark('runtime.replace', number=1000)
+def bench_replace():
+    tree = staging(original)(add, ast.Num(10))
+    replacements = {tree.body[0].iter.args[0]: ast.Num(20)}
+    return lambda: replace(tree, replacements)
+
+@benchmark('runtime.run', number=1000)
+def bench_run():
+    expr = make_expr()
+    env = {'a': 1, 'b': 2}
+    return lambda: run(expr, env)
+
+@benchmark('runtime.unparse', number=1000)
+def bench_unparse():
+    tree = staging(original)(add, ast.Num(10))
+    return lambda: unparse(tree)
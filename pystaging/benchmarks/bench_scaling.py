@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure how staging time scales with the number of quote and escape sites,
+on synthetic functions with thousands of (nested) sites:
+
+    def f(x):
+        r0 = quote[a0 + escape[quote[escape[x] * b0]]]
+        r1 = ...
+
+Staging is linear if the time per site stays constant as functions grow.
+The collections triggered by the many live AST nodes make it superlinear
+unless the cyclic garbage collector is paused, with staging(pausegc=True).
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import imp
+import shutil
+import tempfile
+
+from pystaging import staging
+from pystaging.benchmarks import bench, report, benchmark
+
+def site(n, depth):
+    expr = "escape[x]"
+    for level in range(depth):
+        expr = "escape[quote[%s * b%d]]" % (expr, level)
+    return "    r%d = quote[a%d + %s]" % (n, n, expr)
+
+def synthetic(nsites, depth):
+    lines = ["from pystaging import *", "def f(x):"]
+    lines.extend(site(n, depth) for n in range(nsites))
+    lines.append("    return r0")
+    return "\n".join(lines) + "\n"
+
+def load(directory, nsites, depth):
+    name = 'synthetic_%d_%d' % (nsites, depth)
+    path = os.path.join(directory, name + '.py')
+    with open(path, 'w') as f:
+        f.write(synthetic(nsites, depth))
+    return imp.load_source(name, path).f
+
+def scaling(nsites, depth, pausegc=False):
+    """Set up staging a synthetic function, for the benchmark registry"""
+    os.environ.pop('PYSTAGING_CACHE_DIR', None)
+    directory = tempfile.mkdtemp()
+    try:
+        f = load(directory, nsites, depth)
+        # Keep the source in the linecache once the file is gone
+        staging(f)
+    finally:
+        shutil.rmtree(directory)
+    return lambda: staging(f, pausegc=pausegc)
+
+@benchmark('scaling.sites.1000', number=1)
+def bench_flat():
+    return scaling(1000, 0)
+
+@benchmark('scaling.nested.1000', number=1)
+def bench_nested():
+    return scaling(1000, 4)
+
+@benchmark('scaling.nested.1000.pausegc', number=1)
+def bench_nested_pausegc():
+    return scaling(1000, 4, pausegc=True)
+
+def main(sizes=(250, 500, 1000, 2000, 4000), depths=(0, 4)):
+    # Measure rewriting, not loading from the disk cache
+    os.environ.pop('PYSTAGING_CACHE_DIR', None)
+    directory = tempfile.mkdtemp()
+    try:
+        for depth in depths:
+            baseline = None
+            for nsites in sizes:
+                f = load(directory, nsites, depth)
+                seconds = bench(lambda: staging(f), number=1) / nsites
+                baseline = baseline or seconds
+                report("%5d sites, depth %d (per site)" % (nsites, depth),
+                       seconds, baseline)
+                paused = bench(lambda: staging(f, pausegc=True),
+                               number=1) / nsites
+                report("  with pausegc", paused, baseline)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare building an unrolled kernel from a generator of quotations as a
+single function, which holds the whole body in memory and compiles it at
+once, with compiling it in chunks with a StreamCompiler. The registered
+benchmarks report the peak memory of each in a fresh process:
+
+    python runbenchmarks.py 'streaming.*'
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging import (staging, quote, escape, CompilationUnit,
+                       StreamCompiler)
+from pystaging.benchmarks import bench, report, benchmark
+
+size = 20000
+
+@staging
+def unrolled(n):
+    for i in range(n):
+        with quote as body:
+            out[escape[i]] = A[escape[i]] * scale + B[escape[i]] - offset
+            total = total + out[escape[i]] * out[escape[i]]
+        yield body
+
+def whole(n):
+    """Compile the body as a single function"""
+    body = ast.parse("total = 0").body
+    for stmts in unrolled(n):
+        body.extend(stmts.body)
+    body.append(ast.parse("return total").body[0])
+    args = ast.arguments([ast.Name(name, ast.Param()) for name in
+                          ('A', 'B', 'out', 'scale', 'offset')],
+                         None, None, [])
+    unit = CompilationUnit()
+    unit.add(ast.FunctionDef('kernel', args, body, []))
+    return unit.run({})[0]
+
+def streamed(n, chunksize=1000):
+    """Compile the body in chunks of chunksize statements"""
+    stream = StreamCompiler('kernel', ['A', 'B', 'out', 'scale', 'offset'],
+                            chunksize=chunksize)
+    stream.add(ast.parse("total = 0"))
+    stream.extend(unrolled(n))
+    stream.add(ast.parse("return total"))
+    return stream.function()
+
+@benchmark('streaming.whole', number=1, repeat=1)
+def bench_whole():
+    return lambda: whole(size)
+
+@benchmark('streaming.chunked', number=1, repeat=1)
+def bench_chunked():
+    return lambda: streamed(size)
+
+def main(sizes=(1000, 10000, 100000)):
+    for n in sizes:
+        baseline = bench(lambda: whole(n), number=1, repeat=1)
+        report("single function, %d statements" % (2 * n), baseline)
+        report("chunked, %d statements" % (2 * n),
+               bench(lambda: streamed(n), number=1, repeat=1), baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare building quotations through escape_ast constructor calls with
+instantiating compiled templates.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging import staging, quote, escape
+from pystaging.benchmarks import bench, report, benchmark
+
+@staging
+def make_escaped(op):
+    with quote as body:
+        out[i] = escape[op] * (A[i] + B[i]) - (C[i] * D[i] + E[i])
+        acc = acc + out[i] * (x - y) / (z + 1.5)
+    return body
+
+@staging(templates=True)
+def make_template(op):
+    with quote as body:
+        out[i] = escape[op] * (A[i] + B[i]) - (C[i] * D[i] + E[i])
+        acc = acc + out[i] * (x - y) / (z + 1.5)
+    return body
+
+@benchmark('templates.escape_ast')
+def bench_escaped():
+    op = ast.Num(2)
+    return lambda: make_escaped(op)
+
+@benchmark('templates.instantiate')
+def bench_template():
+    op = ast.Num(2)
+    return lambda: make_template(op)
+
+def main():
+    op = ast.Num(2)
+    baseline = bench(lambda: make_escaped(op))
+    report("escape_ast", baseline)
+    report("templates", bench(lambda: make_template(op)), baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""
+The ufunc generator of the README at several sizes: generate a ufunc that
+evaluates a chain of n additions per element, and apply it to lists of
+1000 elements.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging import staging, quote, escape, run
+from pystaging.benchmarks import benchmark
+
+@staging
+def add(a, b):
+    return quote[escape[a] + escape[b]]
+
+@staging
+def chain(op, n):
+    expr = quote[A[i]]
+    for k in range(n):
+        expr = op(expr, quote[B[i]])
+    return expr
+
+@staging
+def make_ufunc(op, n):
+    with quote as body:
+        def ufunc(A, B):
+            out = [0] * len(A)
+            for i in range(len(A)):
+                out[i] = escape[chain(op, n)]
+            return out
+    return body
+
+def generate(n):
+    namespace = {}
+    run(make_ufunc(add, n), namespace)
+    return namespace['ufunc']
+
+def register(n):
+    @benchmark('ufunc.generate.%d' % n, number=max(1, 200 // n))
+    def bench_generate():
+        return lambda: generate(n)
+
+    @benchmark('ufunc.apply.%d' % n, number=20)
+    def bench_apply():
+        ufunc = generate(n)
+        A, B = range(1000), range(1000)
+        return lambda: ufunc(A, B)
+
+for n in (1, 8, 64):
+    register(n)
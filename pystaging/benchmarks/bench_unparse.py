@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare unparsing a large generated module with the built-in unparser and
+with the meta package, if installed.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging.astutils import unparse
+from pystaging.benchmarks import bench, report, benchmark
+
+try:
+    import meta
+except ImportError:
+    meta = None
+
+def generated(nfuncs=200):
+    """Source of a module of unrolled elementwise kernels"""
+    lines = []
+    for n in range(nfuncs):
+        lines.append("def kernel%d(A, B, out, i):" % n)
+        for k in range(8):
+            lines.append("    out[i + %d] = A[i + %d] * (B[i + %d] - %d.5) "
+                         "if A[i] > 0 else -B[i + %d]" % (k, k, k, n, k))
+        lines.append("    return out")
+    return "\n".join(lines) + "\n"
+
+@benchmark('unparse.builtin', number=10)
+def bench_unparse():
+    tree = ast.parse(generated())
+    return lambda: unparse(tree)
+
+def main():
+    tree = ast.parse(generated())
+    baseline = None
+    if meta is not None:
+        baseline = bench(lambda: meta.dump_python_source(tree), number=10)
+        report("meta.dump_python_source", baseline)
+    else:
+        print("meta is not installed, skipping")
+    report("astutils.unparse", bench(lambda: unparse(tree), number=10),
+           baseline)
+
+if __name__ == '__main__':
+    main()
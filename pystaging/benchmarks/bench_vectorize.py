@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare a generated scalar elementwise loop with its vectorized version on
+10**6 element arrays. Requires numpy.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import numpy as np
+
+from pystaging import staging, quote, escape, run
+from pystaging.optimize import fold
+from pystaging.vectorize import vectorize
+from pystaging.benchmarks import bench, report, benchmark
+
+@staging
+def add(a, b):
+    return quote[escape[a] + escape[b]]
+
+@staging
+def make_kernel(op):
+    with quote as body:
+        for i in range(A.shape[0]):
+            out[i] = escape[op(quote[A[i]], quote[B[i]])]
+    return body
+
+def setup(n):
+    scalar = fold(make_kernel(add))
+    vectorized = vectorize(scalar)
+    env = {'A': np.arange(n, dtype=np.float64),
+           'B': np.arange(n, dtype=np.float64), 'out': np.empty(n)}
+    return scalar, vectorized, env
+
+@benchmark('vectorize.scalar', number=1)
+def bench_scalar():
+    scalar, vectorized, env = setup(10**5)
+    return lambda: run(scalar, env)
+
+@benchmark('vectorize.numpy', number=100)
+def bench_numpy():
+    scalar, vectorized, env = setup(10**5)
+    return lambda: run(vectorized, env)
+
+def main(n=10**6):
+    scalar, vectorized, env = setup(n)
+
+    baseline = bench(lambda: run(scalar, env), number=1)
+    report("scalar loop (n=%d)" % n, baseline)
+    report("vectorized (n=%d)" % n,
+           bench(lambda: run(vectorized, env), number=10), baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the registered benchmarks of all bench_* modules, reporting the best
+time per call and the peak memory (maximum resident set size) of each.
+Every benchmark runs in a fresh process, so that its peak memory is its
+own. Results can be saved as JSON and compared with a previous run, which
+flags benchmarks that got slower or bigger than the threshold:
+
+    python runbenchmarks.py [pattern] [--save FILE] [--compare FILE]
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import sys
+import json
+import Queue
+import fnmatch
+import pkgutil
+import platform
+import argparse
+import importlib
+import multiprocessing
+
+import pystaging
+from pystaging import benchmarks
+
+skipped = {} # module name -> import error
+
+def load():
+    """
+    Import the benchmark modules, skipping those missing dependencies (see
+    skipped)
+    """
+    for _, name, _ in pkgutil.iter_modules(benchmarks.__path__):
+        if name.startswith('bench_'):
+            try:
+                importlib.import_module('pystaging.benchmarks.' + name)
+            except ImportError as e:
+                skipped[name] = str(e)
+    return benchmarks.benchmarks
+
+def peakmemory():
+    """Peak resident set size of this process in kilobytes"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024 # bytes on OS X
+    return peak
+
+def measure(name):
+    """Run a benchmark, returning its time per call and peak memory"""
+    seconds = benchmarks.benchmarks[name].run()
+    return {'seconds': seconds, 'peak_kb': peakmemory()}
+
+def measureinto(name, queue):
+    try:
+        queue.put((measure(name), None))
+    except Exception as e:
+        queue.put((None, "%s: %s" % (type(e).__name__, e)))
+
+def isolated(name):
+    """
+    Run a benchmark in a fresh process. This is not a pool worker, so that
+    benchmarks may start processes of their own.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measureinto, args=(name, queue))
+    process.start()
+    try:
+        while True:
+            try:
+                result, error = queue.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError("benchmark process exited with code "
+                                       "%s" % process.exitcode)
+    finally:
+        process.join()
+    if error is not None:
+        raise RuntimeError(error)
+    return result
+
+def run(pattern='*', isolate=True):
+    """
+    Run the benchmarks matching pattern, returning a results dict. Failing
+    benchmarks are reported and left out.
+    """
+    results = {}
+    load()
+    for module, error in sorted(skipped.iteritems()):
+        print("skipping %s: %s" % (module, error), file=sys.stderr)
+    for name in benchmarks.benchmarks:
+        if fnmatch.fnmatch(name, pattern):
+            try:
+                results[name] = isolated(name) if isolate else measure(name)
+            except Exception as e:
+                print("%-40s failed: %s: %s" % (name, type(e).__name__, e))
+            else:
+                report(name, results[name])
+    return results
+
+def ratios(results, previous):
+    """
+    The (name, time ratio, memory ratio) of each result with a previous
+    one, in name order
+    """
+    rows = []
+    for name in sorted(results):
+        if name in previous:
+            old, new = previous[name], results[name]
+            rows.append((name, new['seconds'] / old['seconds'],
+                         new['peak_kb'] / old['peak_kb']))
+    return rows
+
+def compare(results, previous, threshold=0.2):
+    """
+    Return the names of the results that regressed by more than threshold
+    from a previous one, in time or memory.
+    """
+    return [name for name, time, memory in ratios(results, previous)
+            if time > 1 + threshold or memory > 1 + threshold]
+
+def reportcomparison(results, previous, threshold=0.2, file=None):
+    """Print the ratios of results to previous ones, flagging regressions"""
+    regressions = set(compare(results, previous, threshold))
+    for name, time, memory in ratios(results, previous):
+        flag = "  REGRESSION" if name in regressions else ""
+        print("%-40s %8.2fx time %8.2fx memory%s" % (name, time, memory,
+                                                     flag), file=file)
+
+def report(name, result):
+    print("%-40s %10.2f us %10.1f MB" % (name, result['seconds'] * 1e6,
+                                         result['peak_kb'] / 1024))
+
+def metadata():
+    return {'pystaging': pystaging.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('pattern', nargs='?', default='*',
+                        help="glob pattern of the benchmarks to run")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the results as JSON")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with results saved by --save")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative slowdown that counts as a "
+                             "regression (default 0.2)")
+    parser.add_argument('--inprocess', action='store_true',
+                        help="run all benchmarks in this process")
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern, isolate=not args.inprocess)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'metadata': metadata(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        print()
+        reportcomparison(results, previous, args.threshold)
+        if compare(results, previous, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
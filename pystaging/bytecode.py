@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+
+"""
+A bytecode backend for generated code. bytecompile() lowers quotations
+straight to CPython 2.7 code objects with a small assembler, skipping
+fix_locations() and the conversion of the tree for compile():
+
+    code = bytecompile(kernel)
+
+The assembler handles the subset of Python that kernels are usually
+generated in:
+
+    - expressions: numbers, strings, names, arithmetic, unary and boolean
+      operators, single comparisons, conditional expressions, attributes,
+      subscripts (not slices), calls, tuples, lists and dicts
+    - statements: expressions, assignments, augmented assignments, del,
+      for loops (with break and continue), if, pass, return, and
+      module-level function definitions without closures
+
+Trees with other nodes, or any tree on other Python versions, are compiled
+by astcompile() instead. stats counts the trees compiled either way.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+import sys
+import dis
+import bisect
+import types
+import __future__
+
+from pystaging.astutils import astcompile, materialize, is_expr, Persisted
+
+class Unsupported(Exception):
+    """A node the assembler has no lowering for"""
+
+stats = {'assembled': 0, 'fallbacks': 0}
+
+def bytecompile(tree, filename="<string>", flags=0, fallback=True):
+    """
+    Compile an AST with the assembler. Trees it does not support are
+    compiled with astcompile(), or raise Unsupported if fallback is False.
+    """
+    tree = materialize(tree)
+    try:
+        code = assemble(tree, filename, flags)
+    except Unsupported:
+        if not fallback:
+            raise
+        stats['fallbacks'] += 1
+        return astcompile(tree, filename, flags, cache=False)
+    stats['assembled'] += 1
+    return code
+
+def assemble(tree, filename="<string>", flags=0):
+    """Assemble an AST into a code object, or raise Unsupported"""
+    if sys.version_info[:2] != (2, 7):
+        raise Unsupported(tree)
+    if is_expr(tree):
+        if isinstance(tree, ast.Expression):
+            tree = tree.body
+        return Assembler(filename, flags).expression(tree)
+    if isinstance(tree, (ast.Module, ast.Suite, ast.Interactive)):
+        tree = tree.body
+    elif not isinstance(tree, list):
+        tree = [tree]
+    return Assembler(filename, flags).module(tree)
+
+# ______________________________________________________________________
+
+op = dis.opmap
+hasjrel = frozenset(dis.hasjrel)
+
+EXTENDED_ARG = dis.EXTENDED_ARG
+LOAD_CONST, LOAD_NAME, LOAD_FAST, LOAD_GLOBAL, LOAD_ATTR = (
+    op['LOAD_CONST'], op['LOAD_NAME'], op['LOAD_FAST'], op['LOAD_GLOBAL'],
+    op['LOAD_ATTR'])
+STORE_NAME, STORE_FAST, STORE_ATTR, STORE_SUBSCR, STORE_MAP = (
+    op['STORE_NAME'], op['STORE_FAST'], op['STORE_ATTR'], op['STORE_SUBSCR'],
+    op['STORE_MAP'])
+DELETE_NAME, DELETE_FAST, DELETE_ATTR, DELETE_SUBSCR = (
+    op['DELETE_NAME'], op['DELETE_FAST'], op['DELETE_ATTR'],
+    op['DELETE_SUBSCR'])
+POP_TOP, DUP_TOP, DUP_TOPX, ROT_TWO, ROT_THREE = (
+    op['POP_TOP'], op['DUP_TOP'], op['DUP_TOPX'], op['ROT_TWO'],
+    op['ROT_THREE'])
+BINARY_SUBSCR, COMPARE_OP, UNPACK_SEQUENCE = (
+    op['BINARY_SUBSCR'], op['COMPARE_OP'], op['UNPACK_SEQUENCE'])
+BUILD_TUPLE, BUILD_LIST, BUILD_MAP = (
+    op['BUILD_TUPLE'], op['BUILD_LIST'], op['BUILD_MAP'])
+SETUP_LOOP, POP_BLOCK, GET_ITER, FOR_ITER, BREAK_LOOP = (
+    op['SETUP_LOOP'], op['POP_BLOCK'], op['GET_ITER'], op['FOR_ITER'],
+    op['BREAK_LOOP'])
+JUMP_ABSOLUTE, JUMP_FORWARD, POP_JUMP_IF_FALSE = (
+    op['JUMP_ABSOLUTE'], op['JUMP_FORWARD'], op['POP_JUMP_IF_FALSE'])
+JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP = (
+    op['JUMP_IF_FALSE_OR_POP'], op['JUMP_IF_TRUE_OR_POP'])
+MAKE_FUNCTION, CALL_FUNCTION, RETURN_VALUE = (
+    op['MAKE_FUNCTION'], op['CALL_FUNCTION'], op['RETURN_VALUE'])
+
+CO_OPTIMIZED, CO_NEWLOCALS, CO_VARARGS, CO_VARKEYWORDS = 1, 2, 4, 8
+CO_NOFREE = 0x40
+CO_FUTURE_DIVISION = __future__.division.compiler_flag
+future_flags = 0
+for feature in __future__.all_feature_names:
+    future_flags |= getattr(__future__, feature).compiler_flag
+
+binops = {
+    ast.Add: 'ADD', ast.Sub: 'SUBTRACT', ast.Mult: 'MULTIPLY',
+    ast.Div: 'DIVIDE', ast.FloorDiv: 'FLOOR_DIVIDE', ast.Mod: 'MODULO',
+    ast.Pow: 'POWER', ast.LShift: 'LSHIFT', ast.RShift: 'RSHIFT',
+    ast.BitOr: 'OR', ast.BitXor: 'XOR', ast.BitAnd: 'AND',
+}
+binary = dict((cls, op['BINARY_' + name]) for cls, name in binops.items())
+inplace = dict((cls, op['INPLACE_' + name]) for cls, name in binops.items())
+# Under from __future__ import division
+true_binary = dict(binary)
+true_binary[ast.Div] = op['BINARY_TRUE_DIVIDE']
+true_inplace = dict(inplace)
+true_inplace[ast.Div] = op['INPLACE_TRUE_DIVIDE']
+
+unary = {ast.UAdd: op['UNARY_POSITIVE'], ast.USub: op['UNARY_NEGATIVE'],
+         ast.Not: op['UNARY_NOT'], ast.Invert: op['UNARY_INVERT']}
+
+cmpops = {
+    ast.Lt: '<', ast.LtE: '<=', ast.Eq: '==', ast.NotEq: '!=', ast.Gt: '>',
+    ast.GtE: '>=', ast.In: 'in', ast.NotIn: 'not in', ast.Is: 'is',
+    ast.IsNot: 'is not',
+}
+compare = dict((cls, dis.cmp_op.index(name)) for cls, name in cmpops.items())
+
+class Label(object):
+    __slots__ = ('offset',)
+
+    def __init__(self):
+        self.offset = None
+
+class Assembler(object):
+    """
+    Emits the bytecode of one code object.
+
+        funcdef: the FunctionDef being assembled, or None at module level
+    """
+
+    def __init__(self, filename, flags=0):
+        self.filename = filename
+        self.flags = flags
+        self.funcdef = None
+        if flags & CO_FUTURE_DIVISION:
+            self.binary, self.inplace = true_binary, true_inplace
+        else:
+            self.binary, self.inplace = binary, inplace
+        self.code = []
+        self.consts, self.constindex = [], {}
+        self.names, self.nameindex = [], {}
+        self.varnames, self.localindex = [], {}
+        self.jumps = [] # (end offset of the jump, relative, label)
+        self.lines = [] # (offset, lineno)
+        self.loops = [] # start label of the enclosing loops
+        self.depth = self.maxdepth = 0
+
+    # Code objects
+
+    def module(self, body):
+        if body and isinstance(body[0], ast.Expr) and \
+                isinstance(body[0].value, ast.Str):
+            # The module docstring
+            self.emit(LOAD_CONST, self.const(body[0].value.s), 1)
+            self.emit(STORE_NAME, self.name('__doc__'), -1)
+            body = body[1:]
+        self.body(body)
+        self.emit(LOAD_CONST, self.const(None), 1)
+        self.emit(RETURN_VALUE, None, -1)
+        return self.finish('<module>', CO_NOFREE)
+
+    def expression(self, node):
+        self.expr(node)
+        self.emit(RETURN_VALUE, None, -1)
+        return self.finish('<module>', CO_NOFREE)
+
+    def function(self, node):
+        self.funcdef = node
+        args = node.args
+        for arg in args.args:
+            if type(arg) is not ast.Name:
+                raise Unsupported(arg) # tuple parameters
+            self.local(arg.id)
+        flags = CO_OPTIMIZED | CO_NEWLOCALS | CO_NOFREE
+        if args.vararg:
+            self.local(args.vararg)
+            flags |= CO_VARARGS
+        if args.kwarg:
+            self.local(args.kwarg)
+            flags |= CO_VARKEYWORDS
+        for name in assigned(node.body):
+            self.local(name)
+
+        # The first constant of a function is its docstring, or None
+        body = node.body
+        if body and isinstance(body[0], ast.Expr) and \
+                isinstance(body[0].value, ast.Str):
+            self.const(body[0].value.s)
+            body = body[1:]
+        else:
+            self.const(None)
+        self.body(body)
+        self.emit(LOAD_CONST, self.const(None), 1)
+        self.emit(RETURN_VALUE, None, -1)
+        return self.finish(node.name, flags, len(args.args))
+
+    def finish(self, name, flags, argcount=0):
+        """Resolve the jumps and make the code object"""
+        if len(self.code) > 0xffff and self.jumps:
+            self.widen()
+        code = self.code
+        for end, relative, label in self.jumps:
+            target = label.offset - end if relative else label.offset
+            if target > 0xffff:
+                code[end - 5] = (target >> 16) & 0xff
+                code[end - 4] = target >> 24
+            code[end - 2] = target & 0xff
+            code[end - 1] = (target >> 8) & 0xff
+
+        firstlineno, lnotab = linetable(self.lines)
+        return types.CodeType(
+            argcount, len(self.varnames), self.maxdepth,
+            flags | (self.flags & future_flags), str(bytearray(code)),
+            tuple(self.consts), tuple(self.names), tuple(self.varnames),
+            self.filename, name, firstlineno, lnotab, (), ())
+
+    def widen(self):
+        """
+        Give every jump an EXTENDED_ARG prefix, for targets beyond 64K,
+        moving the code and labels after each one.
+        """
+        starts = [end - 3 for end, relative, label in self.jumps]
+        moved = lambda offset: offset + 3 * bisect.bisect_left(starts, offset)
+
+        code, self.code = self.code, []
+        last = 0
+        for start in starts:
+            self.code.extend(code[last:start])
+            self.code.extend((EXTENDED_ARG, 0, 0))
+            last = start
+        self.code.extend(code[last:])
+
+        for label in set(label for end, relative, label in self.jumps):
+            label.offset = moved(label.offset)
+        self.jumps = [(moved(end - 3) + 6, relative, label)
+                      for end, relative, label in self.jumps]
+        self.lines = [(moved(offset), lineno) for offset, lineno in self.lines]
+
+    # Tables
+
+    def const(self, value):
+        if isinstance(value, (float, complex)):
+            key = type(value), repr(value) # keep 0.0 and -0.0 apart
+        else:
+            key = type(value), value
+        index = self.constindex.get(key)
+        if index is None:
+            index = self.constindex[key] = len(self.consts)
+            self.consts.append(value)
+        return index
+
+    def name(self, name):
+        index = self.nameindex.get(name)
+        if index is None:
+            index = self.nameindex[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def local(self, name):
+        if name not in self.localindex:
+            self.localindex[name] = len(self.varnames)
+            self.varnames.append(name)
+
+    # Emission
+
+    def emit(self, opcode, arg=None, effect=0):
+        """Emit an instruction that changes the stack depth by effect"""
+        code = self.code
+        if arg is None:
+            code.append(opcode)
+        elif arg > 0xffff:
+            code.extend((EXTENDED_ARG, (arg >> 16) & 0xff, arg >> 24,
+                         opcode, arg & 0xff, (arg >> 8) & 0xff))
+        else:
+            code.extend((opcode, arg & 0xff, arg >> 8))
+        self.depth += effect
+        if self.depth > self.maxdepth:
+            self.maxdepth = self.depth
+
+    def jump(self, opcode, label, effect=0):
+        """Emit a jump to label, resolved by finish()"""
+        code = self.code
+        code.extend((opcode, 0, 0))
+        self.jumps.append((len(code), opcode in hasjrel, label))
+        self.depth += effect
+        if self.depth > self.maxdepth:
+            self.maxdepth = self.depth
+
+    def mark(self, label):
+        label.offset = len(self.code)
+
+    # Statements
+
+    def body(self, stmts):
+        for stmt in stmts:
+            self.stmt(stmt)
+
+    def stmt(self, node):
+        lineno = getattr(node, 'lineno', None)
+        if lineno is not None:
+            self.lines.append((len(self.code), lineno))
+        try:
+            method = statements[type(node)]
+        except KeyError:
+            raise Unsupported(node)
+        method(self, node)
+
+    def stmt_Expr(self, node):
+        self.expr(node.value)
+        self.emit(POP_TOP, None, -1)
+
+    def stmt_Pass(self, node):
+        pass
+
+    def stmt_Assign(self, node):
+        self.expr(node.value)
+        targets = node.targets
+        for target in targets[:-1]:
+            self.emit(DUP_TOP, None, 1)
+            self.store(target)
+        self.store(targets[-1])
+
+    def stmt_AugAssign(self, node):
+        target, opcode = node.target, self.inplace[type(node.op)]
+        if isinstance(target, ast.Name):
+            self.load(target.id)
+            self.expr(node.value)
+            self.emit(opcode, None, -1)
+            self.store(target)
+        elif isinstance(target, ast.Subscript):
+            self.expr(target.value)
+            self.index(target.slice)
+            self.emit(DUP_TOPX, 2, 2)
+            self.emit(BINARY_SUBSCR, None, -1)
+            self.expr(node.value)
+            self.emit(opcode, None, -1)
+            self.emit(ROT_THREE)
+            self.emit(STORE_SUBSCR, None, -3)
+        elif isinstance(target, ast.Attribute):
+            self.expr(target.value)
+            self.emit(DUP_TOP, None, 1)
+            self.emit(LOAD_ATTR, self.name(target.attr))
+            self.expr(node.value)
+            self.emit(opcode, None, -1)
+            self.emit(ROT_TWO)
+            self.emit(STORE_ATTR, self.name(target.attr), -2)
+        else:
+            raise Unsupported(target)
+
+    def stmt_Delete(self, node):
+        for target in node.targets:
+            cls = type(target)
+            if cls is ast.Name:
+                if self.funcdef is None:
+                    self.emit(DELETE_NAME, self.name(target.id))
+                else:
+                    self.emit(DELETE_FAST, self.localindex[target.id])
+            elif cls is ast.Subscript:
+                self.expr(target.value)
+                self.index(target.slice)
+                self.emit(DELETE_SUBSCR, None, -2)
+            elif cls is ast.Attribute:
+                self.expr(target.value)
+                self.emit(DELETE_ATTR, self.name(target.attr), -1)
+            else:
+                raise Unsupported(target)
+
+    def stmt_For(self, node):
+        start, cleanup, end = Label(), Label(), Label()
+        self.jump(SETUP_LOOP, end)
+        self.expr(node.iter)
+        self.emit(GET_ITER)
+        depth = self.depth
+        self.mark(start)
+        self.jump(FOR_ITER, cleanup, 1)
+        self.store(node.target)
+        self.loops.append(start)
+        self.body(node.body)
+        self.loops.pop()
+        self.jump(JUMP_ABSOLUTE, start)
+        self.mark(cleanup)
+        self.depth = depth - 1 # FOR_ITER popped the iterator
+        self.emit(POP_BLOCK)
+        self.body(node.orelse)
+        self.mark(end)
+
+    def stmt_Break(self, node):
+        if not self.loops:
+            raise Unsupported(node)
+        self.emit(BREAK_LOOP)
+
+    def stmt_Continue(self, node):
+        if not self.loops:
+            raise Unsupported(node)
+        self.jump(JUMP_ABSOLUTE, self.loops[-1])
+
+    def stmt_If(self, node):
+        orelse, end = Label(), Label()
+        self.expr(node.test)
+        self.jump(POP_JUMP_IF_FALSE, orelse, -1)
+        self.body(node.body)
+        if node.orelse:
+            self.jump(JUMP_FORWARD, end)
+        self.mark(orelse)
+        self.body(node.orelse)
+        self.mark(end)
+
+    def stmt_Return(self, node):
+        if self.funcdef is None:
+            raise Unsupported(node)
+        if node.value is None:
+            self.emit(LOAD_CONST, self.const(None), 1)
+        else:
+            self.expr(node.value)
+        self.emit(RETURN_VALUE, None, -1)
+
+    def stmt_FunctionDef(self, node):
+        if self.funcdef is not None:
+            raise Unsupported(node) # would need closures
+        for decorator in node.decorator_list:
+            self.expr(decorator)
+        for default in node.args.defaults:
+            self.expr(default)
+        code = Assembler(self.filename, self.flags).function(node)
+        self.emit(LOAD_CONST, self.const(code), 1)
+        ndefaults = len(node.args.defaults)
+        self.emit(MAKE_FUNCTION, ndefaults, -ndefaults)
+        for decorator in node.decorator_list:
+            self.emit(CALL_FUNCTION, 1, -1)
+        self.storename(node.name)
+
+    # Stores
+
+    def store(self, target):
+        cls = type(target)
+        if cls is ast.Name:
+            self.storename(target.id)
+        elif cls is ast.Subscript:
+            self.expr(target.value)
+            self.index(target.slice)
+            self.emit(STORE_SUBSCR, None, -3)
+        elif cls is ast.Attribute:
+            self.expr(target.value)
+            self.emit(STORE_ATTR, self.name(target.attr), -2)
+        elif cls is ast.Tuple or cls is ast.List:
+            n = len(target.elts)
+            self.emit(UNPACK_SEQUENCE, n, n - 1)
+            for elt in target.elts:
+                self.store(elt)
+        else:
+            raise Unsupported(target)
+
+    def storename(self, name):
+        if name == 'None':
+            raise Unsupported(name)
+        if self.funcdef is None:
+            self.emit(STORE_NAME, self.name(name), -1)
+        else:
+            self.emit(STORE_FAST, self.localindex[name], -1)
+
+    # Expressions
+
+    def expr(self, node):
+        try:
+            method = expressions[type(node)]
+        except KeyError:
+            raise Unsupported(node)
+        method(self, node)
+
+    def load(self, name):
+        if name == 'None':
+            self.emit(LOAD_CONST, self.const(None), 1)
+        elif self.funcdef is None:
+            self.emit(LOAD_NAME, self.name(name), 1)
+        elif name in self.localindex:
+            self.emit(LOAD_FAST, self.localindex[name], 1)
+        else:
+            self.emit(LOAD_GLOBAL, self.name(name), 1)
+
+    def index(self, slice):
+        if type(slice) is not ast.Index:
+            raise Unsupported(slice)
+        self.expr(slice.value)
+
+    def expr_Num(self, node):
+        self.emit(LOAD_CONST, self.const(node.n), 1)
+
+    def expr_Str(self, node):
+        self.emit(LOAD_CONST, self.const(node.s), 1)
+
+    def expr_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            raise Unsupported(node)
+        self.load(node.id)
+
+    def expr_BinOp(self, node):
+        self.expr(node.left)
+        self.expr(node.right)
+        self.emit(self.binary[type(node.op)], None, -1)
+
+    def expr_UnaryOp(self, node):
+        self.expr(node.operand)
+        self.emit(unary[type(node.op)])
+
+    def expr_BoolOp(self, node):
+        end = Label()
+        if isinstance(node.op, ast.And):
+            opcode = JUMP_IF_FALSE_OR_POP
+        else:
+            opcode = JUMP_IF_TRUE_OR_POP
+        for value in node.values[:-1]:
+            self.expr(value)
+            self.jump(opcode, end, -1)
+        self.expr(node.values[-1])
+        self.mark(end)
+
+    def expr_Compare(self, node):
+        if len(node.ops) != 1:
+            raise Unsupported(node) # chained comparison
+        self.expr(node.left)
+        self.expr(node.comparators[0])
+        self.emit(COMPARE_OP, compare[type(node.ops[0])], -1)
+
+    def expr_IfExp(self, node):
+        orelse, end = Label(), Label()
+        self.expr(node.test)
+        self.jump(POP_JUMP_IF_FALSE, orelse, -1)
+        self.expr(node.body)
+        self.jump(JUMP_FORWARD, end)
+        self.mark(orelse)
+        self.depth -= 1 # the body value is not on the stack here
+        self.expr(node.orelse)
+        self.mark(end)
+
+    def expr_Attribute(self, node):
+        self.expr(node.value)
+        self.emit(LOAD_ATTR, self.name(node.attr))
+
+    def expr_Subscript(self, node):
+        self.expr(node.value)
+        self.index(node.slice)
+        self.emit(BINARY_SUBSCR, None, -1)
+
+    def expr_Call(self, node):
+        self.expr(node.func)
+        for arg in node.args:
+            self.expr(arg)
+        for keyword in node.keywords:
+            self.emit(LOAD_CONST, self.const(keyword.arg), 1)
+            self.expr(keyword.value)
+        name = 'CALL_FUNCTION'
+        popped = len(node.args) + 2 * len(node.keywords)
+        if node.starargs is not None:
+            self.expr(node.starargs)
+            name += '_VAR'
+            popped += 1
+        if node.kwargs is not None:
+            self.expr(node.kwargs)
+            name += '_KW'
+            popped += 1
+        self.emit(op[name], len(node.keywords) << 8 | len(node.args),
+                  -popped)
+
+    def expr_Tuple(self, node):
+        self.sequence(BUILD_TUPLE, node)
+
+    def expr_List(self, node):
+        self.sequence(BUILD_LIST, node)
+
+    def sequence(self, opcode, node):
+        if not isinstance(node.ctx, ast.Load):
+            raise Unsupported(node)
+        for elt in node.elts:
+            self.expr(elt)
+        self.emit(opcode, len(node.elts), 1 - len(node.elts))
+
+    def expr_Dict(self, node):
+        self.emit(BUILD_MAP, min(len(node.keys), 0xffff), 1)
+        for key, value in zip(node.keys, node.values):
+            self.expr(value)
+            self.expr(key)
+            self.emit(STORE_MAP, None, -2)
+
+statements = {}
+expressions = {Persisted: Assembler.expr_Name}
+for name, method in vars(Assembler).items():
+    if name.startswith('stmt_'):
+        statements[getattr(ast, name[5:])] = method
+    elif name.startswith('expr_'):
+        expressions[getattr(ast, name[5:])] = method
+
+def assigned(stmts):
+    """
+    The names assigned or deleted by a list of statements, in order, which
+    are the local variables of a function body of supported statements.
+    """
+    names = []
+    stack = list(reversed(stmts))
+    while stack:
+        stmt = stack.pop()
+        cls = type(stmt)
+        if cls is ast.Assign:
+            targets = list(stmt.targets)
+        elif cls is ast.AugAssign:
+            targets = [stmt.target]
+        elif cls is ast.Delete:
+            targets = list(stmt.targets)
+        elif cls is ast.For:
+            targets = [stmt.target]
+            stack.extend(reversed(stmt.body + stmt.orelse))
+        elif cls is ast.If:
+            targets = []
+            stack.extend(reversed(stmt.body + stmt.orelse))
+        else:
+            continue
+        while targets:
+            target = targets.pop(0)
+            if type(target) is ast.Name:
+                names.append(target.id)
+            elif type(target) in (ast.Tuple, ast.List):
+                targets[:0] = target.elts
+    return names
+
+def linetable(lines):
+    """The first line number and co_lnotab of (offset, lineno) pairs"""
+    if not lines:
+        return 1, ''
+    firstlineno = lastline = lines[0][1]
+    lastoffset = 0
+    table = []
+    for offset, lineno in lines:
+        if lineno <= lastline:
+            continue # lnotab line increments are unsigned
+        addr, line = offset - lastoffset, lineno - lastline
+        while addr > 255:
+            table.extend((255, 0))
+            addr -= 255
+        while line > 255:
+            table.extend((addr, 255))
+            addr, line = 0, line - 255
+        table.extend((addr, line))
+        lastoffset, lastline = offset, lineno
+    return firstlineno, str(bytearray(table))
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch compilation of quotations. A CompilationUnit collects many quoted
+expressions, function definitions and statements, and compiles and runs
+them as a single module:
+
+    unit = CompilationUnit()
+    for op in ops:
+        unit.add(make_kernel(op))
+    kernels = unit.run()
+
+which costs a single compile() and exec instead of one per quotation. With
+backend='bytecode', large units are assembled by pystaging.bytecode instead
+of compile().
+
+An IncrementalCompiler instead compiles statement lists one top-level
+statement at a time, and reuses the code of statements it compiled before.
+Together with staging(incremental=True), which returns the same statement
+nodes for statements whose escaped values did not change, re-staging after
+a change to one escaped input only recompiles the statements using it.
+
+A StreamCompiler builds a function from a stream of quoted statements,
+e.g. those yielded by a generator, without holding the whole body in
+memory: every chunksize statements are compiled into a helper function,
+and the function calls the helpers in sequence.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+import sys
+import __builtin__
+
+from pystaging.utils import LRUCache
+from pystaging.bytecode import bytecompile
+from pystaging.astutils import (astcompile, copynode, is_expr, materialize,
+                                Persisted, boundnames)
+from pystaging.quotation import (symbol, optimizer, issuite, constants,
+                                 compilecode, runcode)
+from pystaging.optimize import Rewriter
+
+def unwrap(tree):
+    """
+    Unwrap a quotation into an expression, a statement or a list of
+    statements.
+    """
+    tree = materialize(tree)
+    if isinstance(tree, (ast.Module, ast.Expression, ast.Interactive,
+                         ast.Suite)):
+        tree = tree.body
+    if issuite(tree):
+        tree = tree.body
+    if isinstance(tree, list) and len(tree) == 1:
+        tree = tree[0]
+    return tree
+
+class CompilationUnit(object):
+    """
+    A batch of quotations compiled into one module.
+
+        filename: the filename of the compiled module
+        optimize: called with the module AST before compilation, as for
+                  run()
+        backend:  'compile' to compile the module with compile(), or
+                  'bytecode' to assemble it with bytecode.bytecompile(),
+                  which falls back to compile() for unsupported nodes
+    """
+
+    backends = ('compile', 'bytecode')
+
+    def __init__(self, filename="<unit>", optimize=None, backend='compile'):
+        if backend not in self.backends:
+            raise ValueError("Unknown backend %r, expected one of %s" % (
+                backend, ", ".join(self.backends)))
+        self.filename = filename
+        self.optimize = optimizer(optimize)
+        self.backend = backend
+        self.body = []
+        self.names = [] # result name of each added tree, or None
+        self.bound = set()
+
+    def add(self, tree, name=None):
+        """
+        Add a quoted tree to the unit and return the name its result will
+        be bound to:
+
+            - expressions are assigned to name, or to a fresh symbol
+            - function and class definitions are bound to their own name,
+              or to a fresh symbol if a previous tree already bound it,
+              in which case the references to it in the definition are
+              renamed as well
+            - other statements have no result, and None is returned.
+              Definitions among them are renamed in the same way, along
+              with the references to them in the statements.
+        """
+        tree = unwrap(tree)
+        if is_expr(tree):
+            name = name or symbol('value').name
+            stmts = [ast.Assign([ast.Name(name, ast.Store())], tree)]
+        elif isinstance(tree, (ast.FunctionDef, ast.ClassDef)):
+            name = name or tree.name
+            if name in self.bound:
+                name = symbol(tree.name).name
+            if name != tree.name:
+                tree = Rename(tree.name, name).visit(tree)
+            stmts = [tree]
+        else:
+            name = None
+            stmts = self.suite(tree if isinstance(tree, list) else [tree])
+
+        if name is not None:
+            self.bound.add(name)
+        self.bound.update(boundnames(stmts))
+        self.body.extend(stmts)
+        self.names.append(name)
+        return name
+
+    def suite(self, stmts):
+        """
+        Rename the function and class definitions in a list of statements
+        whose names a previous tree bound, and the references to them
+        """
+        renames = [(stmt.name, symbol(stmt.name).name) for stmt in stmts
+                   if isinstance(stmt, (ast.FunctionDef, ast.ClassDef)) and
+                      stmt.name in self.bound]
+        for old, new in dict(renames).iteritems():
+            stmts = Rename(old, new).visitlist(stmts)
+        return stmts
+
+    def __len__(self):
+        return len(self.names)
+
+    def module(self):
+        """Return the module AST of the unit"""
+        module = ast.Module(list(self.body))
+        if self.optimize is not None:
+            module = self.optimize(module)
+        return module
+
+    def compile(self, module=None):
+        """Compile the unit into a code object (see quotation.compilecode)"""
+        module = module or self.module()
+        # Persisted objects are loaded from closure cells, which the
+        # assembler does not lower
+        if self.backend == 'bytecode' and not constants(module):
+            return bytecompile(module, self.filename)
+        return compilecode(module, self.filename)
+
+    def run(self, globals=None):
+        """
+        Run the unit in globals, defaulting to the globals of the caller,
+        and return the result of each added tree in order (None for plain
+        statements).
+        """
+        if globals is None:
+            globals = sys._getframe(1).f_globals
+        module = self.module()
+        runcode(self.compile(module), constants(module), globals)
+        return [globals[name] if name is not None else None
+                for name in self.names]
+
+class Rename(Rewriter):
+    """
+    Rename a global name: the definitions binding it and the references
+    to it, except in functions where it is a local.
+    """
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def visit_Name(self, node):
+        if node.id == self.old:
+            return copynode(node, id=self.new)
+        return node
+
+    def visit_FunctionDef(self, node):
+        if node.name == self.old:
+            node = copynode(node, name=self.new)
+        if not self.islocal(node.args, node.body):
+            return self.generic_visit(node)
+        # Only the decorators and defaults run in the enclosing scope
+        args = copynode(node.args, defaults=self.visitlist(node.args.defaults))
+        return copynode(node, args=args,
+                        decorator_list=self.visitlist(node.decorator_list))
+
+    def visit_ClassDef(self, node):
+        if node.name == self.old:
+            node = copynode(node, name=self.new)
+        return self.generic_visit(node)
+
+    def visit_Lambda(self, node):
+        if not self.islocal(node.args, [node.body]):
+            return self.generic_visit(node)
+        args = copynode(node.args, defaults=self.visitlist(node.args.defaults))
+        return copynode(node, args=args)
+
+    def islocal(self, args, body):
+        """Whether the name is local to a function"""
+        if any(isinstance(stmt, ast.Global) and self.old in stmt.names
+               for node in body for stmt in ast.walk(node)):
+            return False
+        return (self.old in (args.vararg, args.kwarg) or
+                self.old in boundnames(args.args) or
+                self.old in boundnames(body))
+
+class IncrementalCompiler(object):
+    """
+    Compiles quoted statements one top-level statement at a time. The code
+    of each statement is kept, keyed by the identity of the statement node.
+
+        filename: the filename of the compiled code
+        maxsize:  the number of statements to keep the code of
+    """
+
+    def __init__(self, filename="<incremental>", maxsize=256):
+        self.filename = filename
+        self.cache = LRUCache(maxsize) # id(stmt) -> (stmt, code)
+
+    def compile(self, tree):
+        """
+        Return the code objects of the statements of a quotation (see
+        quotation.compilecode)
+        """
+        return [code for code, constants in self.entries(unwrap(tree))]
+
+    def entries(self, tree):
+        """The code and constant table of each statement of a quotation"""
+        if is_expr(tree):
+            return [(compilecode(tree, self.filename), constants(tree))]
+        entries = []
+        for stmt in tree if isinstance(tree, list) else [tree]:
+            entry = self.cache.get(id(stmt))
+            if entry is None or entry[0] is not stmt:
+                entry = (stmt, compilecode(stmt, self.filename),
+                         constants(stmt))
+                self.cache[id(stmt)] = entry
+            entries.append(entry[1:])
+        return entries
+
+    def run(self, tree, globals=None):
+        """
+        Run a quotation in globals, defaulting to the globals of the caller.
+        Returns the value of expressions, and the globals for statements.
+        """
+        if globals is None:
+            globals = sys._getframe(1).f_globals
+        tree = unwrap(tree)
+        entries = self.entries(tree)
+        if is_expr(tree):
+            return runcode(entries[0][0], entries[0][1], globals)
+        for code, table in entries:
+            runcode(code, table, globals)
+        return globals
+
+    def stats(self):
+        return self.cache.stats()
+
+class StreamCompiler(object):
+    """
+    Compiles a function body from a stream of quoted statements, in
+    chunks of at most chunksize top-level statements:
+
+        stream = StreamCompiler('kernel', ['A', 'out'])
+        stream.extend(unrolled(n)) # a generator of quotations
+        kernel = stream.function()
+
+    Each chunk is compiled into a helper function as soon as it is full,
+    after which its AST is dropped, so staging memory is proportional to
+    chunksize rather than to the size of the body. The function calls the
+    helpers in sequence. They share the local variables of the function
+    through a dict: a helper loads the variables it uses that earlier
+    helpers or the parameters bind, and stores its locals() back, without
+    the ones it deleted. A return statement in any chunk returns from the
+    function.
+
+    The other names a helper uses are locals of the function if a later
+    helper binds them, and unbound until then, as in a single function.
+    Otherwise they are globals, which are looked up when the helper starts.
+
+        name:      the name of the function
+        params:    the names of its parameters
+        chunksize: the number of top-level statements per helper
+        globals:   the globals of the function, defaults to the globals of
+                   the caller
+        backend:   'compile' or 'bytecode', as for CompilationUnit
+    """
+
+    def __init__(self, name, params, chunksize=1000, globals=None,
+                 filename="<stream>", backend='compile'):
+        if backend not in CompilationUnit.backends:
+            raise ValueError("Unknown backend %r, expected one of %s" % (
+                backend, ", ".join(CompilationUnit.backends)))
+        if globals is None:
+            globals = sys._getframe(1).f_globals
+        self.name = name
+        self.params = list(params)
+        self.chunksize = chunksize
+        self.globals = globals
+        self.filename = filename
+        self.backend = backend
+        self.env = symbol('env').name
+        self.known = set(self.params) # names bound by earlier chunks
+        self.pending = []
+        self.chunks = []
+        self.free = [] # names each chunk uses that are not bound before
+
+    def add(self, tree):
+        """Add the statements of a quotation to the body"""
+        tree = unwrap(tree)
+        if is_expr(tree):
+            tree = ast.Expr(tree)
+        pending = self.pending
+        pending.extend(tree if isinstance(tree, list) else [tree])
+        if len(pending) >= self.chunksize:
+            full = len(pending) - len(pending) % self.chunksize
+            for start in range(0, full, self.chunksize):
+                self.compilechunk(pending[start:start + self.chunksize])
+            self.pending = pending[full:]
+
+    def extend(self, trees):
+        for tree in trees:
+            self.add(tree)
+
+    def flush(self):
+        """Compile the pending statements"""
+        if self.pending:
+            chunk, self.pending = self.pending, []
+            self.compilechunk(chunk)
+
+    def compilechunk(self, stmts):
+        """Compile statements into the next helper function"""
+        bound, referenced, table = scopenames(stmts)
+        # Globals or locals bound by later chunks, decided by runchunks()
+        free = referenced - bound - self.known - set(table) - constant_names
+        deleted = set(node.id for stmt in stmts for node in ast.walk(stmt)
+                      if isinstance(node, ast.Name) and
+                         isinstance(node.ctx, ast.Del))
+        env = lambda: ast.Name(self.env, ast.Load())
+        body = []
+        for name in sorted(referenced & self.known | free):
+            # name = env.get('name', env); if name is env: del name
+            body.append(ast.Assign(
+                [ast.Name(name, ast.Store())],
+                ast.Call(ast.Attribute(env(), 'get', ast.Load()),
+                         [ast.Str(name), env()], [], None, None)))
+            body.append(ast.If(
+                ast.Compare(ast.Name(name, ast.Load()), [ast.Is()], [env()]),
+                [ast.Delete([ast.Name(name, ast.Del())])], []))
+        body.extend(stmts)
+        for name in sorted(deleted):
+            # env.pop('name', None)
+            body.append(ast.Expr(ast.Call(
+                ast.Attribute(env(), 'pop', ast.Load()),
+                [ast.Str(name), ast.Name('None', ast.Load())], [], None,
+                None)))
+        # env.update(locals()); del env['env']; return env
+        body.append(ast.Expr(ast.Call(
+            ast.Attribute(env(), 'update', ast.Load()),
+            [ast.Call(ast.Name('locals', ast.Load()), [], [], None, None)],
+            [], None, None)))
+        body.append(ast.Delete([ast.Subscript(env(), ast.Index(
+            ast.Str(self.env)), ast.Del())]))
+        body.append(ast.Return(env()))
+        self.known |= bound
+        self.free.append(frozenset(free))
+
+        name = '%s.chunk%d' % (self.name, len(self.chunks))
+        params = ast.arguments([ast.Name(self.env, ast.Param())], None,
+                               None, [])
+        func = ast.FunctionDef(name, params, body, [])
+        if table:
+            # Load the persisted objects from closure cells
+            code = compilecode(func, self.filename, cache=False, result=name)
+            self.chunks.append(runcode(code, table, self.globals))
+            return
+        if self.backend == 'bytecode':
+            code = bytecompile(func, self.filename)
+        else:
+            code = astcompile(func, self.filename, cache=False)
+        namespace = {}
+        exec code in self.globals, namespace
+        self.chunks.append(namespace[name])
+
+    def function(self):
+        """
+        Compile the pending statements and return the function, which
+        runs all chunks added so far.
+        """
+        self.flush()
+        load = lambda name: ast.Name(name, ast.Load())
+        # return runchunks(chunks, {'param': param, ...})
+        args = ast.Dict([ast.Str(name) for name in self.params],
+                        [load(name) for name in self.params])
+        body = [ast.Return(ast.Call(load('runchunks'),
+                                    [load('chunks'), args], [], None, None))]
+        params = ast.arguments([ast.Name(name, ast.Param())
+                                    for name in self.params], None, None, [])
+        tree = ast.FunctionDef(self.name, params, body, [])
+        # Free names that no chunk binds are globals
+        chunks = [(chunk, sorted(free - self.known))
+                  for chunk, free in zip(self.chunks, self.free)]
+        namespace = {'runchunks': runchunks, 'chunks': chunks}
+        exec astcompile(tree, self.filename, cache=False) in namespace
+        return namespace[self.name]
+
+# Names that cannot be assigned, and are never locals
+constant_names = frozenset(['None', 'True', 'False', '__debug__'])
+
+def runchunks(chunks, env):
+    """
+    Call the helpers of a streamed function in sequence, with the values of
+    the globals each one uses in env. A helper returns env to continue, any
+    other value is a return value of the function.
+    """
+    for chunk, names in chunks:
+        if names:
+            loadglobals(env, names, chunk.func_globals)
+        result = chunk(env)
+        if result is not env:
+            return result
+    return None
+
+def loadglobals(env, names, globals):
+    """Look names up in globals and builtins, into env"""
+    builtins = globals.get('__builtins__', __builtin__)
+    builtins = getattr(builtins, '__dict__', builtins)
+    for name in names:
+        if name in globals:
+            env[name] = globals[name]
+        elif name in builtins:
+            env[name] = builtins[name]
+        else:
+            env.pop(name, None)
+
+# Nodes that start a new scope
+scopes = (ast.FunctionDef, ast.ClassDef, ast.Lambda, ast.GeneratorExp,
+          ast.SetComp, ast.DictComp)
+
+def scopenames(stmts):
+    """
+    The names that statements in a function body bind in the scope of the
+    function, all names they reference, including in nested scopes, and
+    their constant table (see quotation.constants).
+    """
+    bound, referenced, table = set(), set(), {}
+    scope, nested = list(stmts), []
+    for stack in scope, nested:
+        pop, push, extend = stack.pop, stack.append, stack.extend
+        while stack:
+            node = pop()
+            cls = type(node)
+            if cls is ast.Name:
+                referenced.add(node.id)
+                if stack is scope and type(node.ctx) is not ast.Load:
+                    bound.add(node.id)
+                continue
+            elif cls is Persisted:
+                referenced.add(node.id)
+                table[node.id] = node.value
+                continue
+            elif cls is ast.Global:
+                raise SyntaxError("global statements are not supported in "
+                                  "streamed functions")
+            elif not isinstance(node, ast.AST):
+                continue
+            elif stack is scope:
+                if cls in scopes:
+                    if cls is ast.FunctionDef or cls is ast.ClassDef:
+                        bound.add(node.name)
+                    nested.append(node)
+                    continue
+                elif cls is ast.Import or cls is ast.ImportFrom:
+                    bound.update(alias.asname or alias.name.split('.')[0]
+                                 for alias in node.names)
+
+            attrs = node.__dict__
+            for field in node._fields:
+                value = attrs.get(field)
+                if isinstance(value, list):
+                    extend(value)
+                elif isinstance(value, ast.AST):
+                    push(value)
+    return bound, referenced, table
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of staged code.
+
+The module-level code generated by the staging decorator is stored as a
+marshalled code object, together with picklable information such as the
+constants bound into the globals of the generated code (e.g. quotation
+templates). Entries are keyed by the
+source of the staged function, its module file, the pystaging and Python
+versions and the decorator options. Each file starts with a header holding
+the full key, which is validated before anything is unpickled.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import imp
+import struct
+import hashlib
+import marshal
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+caches = {} # directory -> DiskCache
+
+# Entry files: magic, the length of the key header, repr(key), the pickle
+magic = 'pystaging-cache-2\n'
+lengthformat = '<Q'
+
+def diskcache(directory):
+    """
+    Get the disk cache for directory, or None if directory is None or
+    empty (e.g. PYSTAGING_CACHE_DIR set to the empty string)
+    """
+    if not directory:
+        return None
+    directory = os.path.abspath(directory)
+    if directory not in caches:
+        caches[directory] = DiskCache(directory)
+    return caches[directory]
+
+def cachekey(func, source, filename, options):
+    """Build a disk cache key for a staged function"""
+    from pystaging import __version__
+    return (func.__name__, filename, source, __version__, sys.version,
+            imp.get_magic(), tuple(sorted(options.iteritems())))
+
+class DiskCache(object):
+    """
+    Directory of cached staged code. Loading counts hits, misses and invalid
+    entries, which are treated as misses and overwritten.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = self.misses = self.invalid = self.stores = 0
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, "%s-%s.staged" % (key[0], digest))
+
+    def load(self, key):
+        """Load the entry dict for key, or None"""
+        header = repr(key)
+        try:
+            with open(self.path(key), 'rb') as f:
+                if not self.checkheader(f, header):
+                    self.invalid += 1
+                    return None
+                entry = pickle.load(f)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        except Exception:
+            self.invalid += 1
+            return None
+
+        if not isinstance(entry, dict) or entry.get('key') != key:
+            self.invalid += 1
+            return None
+
+        try:
+            entry['code'] = marshal.loads(entry['code'])
+        except (KeyError, EOFError, ValueError, TypeError):
+            self.invalid += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+    def checkheader(self, f, header):
+        """Read the header of an entry file, and check that it is header"""
+        if f.read(len(magic)) != magic:
+            return False
+        size = struct.calcsize(lengthformat)
+        data = f.read(size)
+        if len(data) != size:
+            return False
+        length, = struct.unpack(lengthformat, data)
+        return length == len(header) and f.read(length) == header
+
+    def store(self, key, code, **info):
+        """
+        Store a code object and additional picklable info for key. Returns
+        whether it succeeded.
+        """
+        entry = dict(info, key=key, code=marshal.dumps(code))
+        try:
+            data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return False
+
+        header = repr(key)
+        tmpname = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(magic)
+                f.write(struct.pack(lengthformat, len(header)))
+                f.write(header)
+                f.write(data)
+            os.rename(tmpname, self.path(key))
+            tmpname = None
+        except (IOError, OSError):
+            return False
+        finally:
+            if tmpname is not None:
+                try:
+                    os.remove(tmpname)
+                except OSError:
+                    pass
+
+        self.stores += 1
+        return True
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    invalid=self.invalid, stores=self.stores)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+Guarded specialization of runtime functions:
+
+    @guarded(A=(dtype, ndim), n=value)
+    @staging
+    def kernel(A, n):
+        ...
+        return quoted_function
+
+The staging function is called with the runtime arguments and returns a
+function specialized on them: a callable, a quoted function definition, or
+a quoted expression that evaluates to one. The guards declare what the
+specialization assumes about its arguments. guarded() generates a
+dispatcher with the signature of the staging function:
+
+    def kernel(A, n):
+        key = (dtype(A), ndim(A), value(n))
+        try:
+            function = variants[key]
+        except KeyError:
+            function = miss(key, A, n)
+        return function(A, n)
+
+with fresh names for all but the arguments. It stages a new specialization
+whenever the guards of the arguments differ from those of every cached
+one. At most maxvariants specializations are kept, after that the oldest
+one is evicted, or the fallback function is called instead of staging
+more. kernel.dispatcher.stats() reports the
+guard hits and misses.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+import sys
+import inspect
+import collections
+
+from pystaging.astutils import astcompile, materialize, is_expr
+from pystaging.quotation import (symbol, run, issuite, constants,
+                                 compilecode, runcode)
+
+# ______________________________________________________________________
+# Guards
+
+typeof = type
+
+def value(x):
+    """Guard on the value of a hashable argument"""
+    return x
+
+def dtype(x):
+    """Guard on the dtype of an array, or the type of other arguments"""
+    return getattr(x, 'dtype', type(x))
+
+def ndim(x):
+    return getattr(x, 'ndim', 0)
+
+def shape(x):
+    return getattr(x, 'shape', ())
+
+def contiguous(x):
+    """Whether x is a C-contiguous array"""
+    flags = getattr(x, 'flags', None)
+    return flags is not None and flags.c_contiguous
+
+# ______________________________________________________________________
+
+def guarded(maxvariants=16, fallback=None, **guards):
+    """
+    Dispatch calls to specializations made by a staging function, keyed on
+    the guards of the arguments.
+
+        maxvariants: the maximum number of specializations to keep
+        fallback:    function to call instead of staging once there are
+                     maxvariants specializations, the oldest one is
+                     evicted if None
+        guards:      argument name -> a guard function or a tuple of guard
+                     functions, which compute a hashable value from the
+                     argument that the specialization depends on
+    """
+    globals = sys._getframe(1).f_globals
+
+    def decorator(func):
+        return Dispatcher(func, guards, maxvariants, fallback,
+                          globals).function
+
+    return decorator
+
+class Dispatcher(object):
+    """
+    The specializations of a guarded staging function.
+
+        variants: {guard key: specialized function}
+        function: the generated dispatcher function
+    """
+
+    def __init__(self, func, guards, maxvariants=16, fallback=None,
+                 globals=None):
+        self.func = func
+        self.maxvariants = maxvariants
+        self.fallback = fallback
+        self.globals = globals if globals is not None else {}
+        self.variants = {}
+        self.order = collections.deque() # keys in staging order
+        self.calls = [0]
+        self.misses = self.evictions = self.fallbacks = 0
+        self.function = self.generate(guards)
+        self.function.dispatcher = self
+
+    def generate(self, guards):
+        """Generate the dispatcher function"""
+        spec = inspect.getargspec(getattr(self.func, '__wrapped__',
+                                          self.func))
+        unknown = set(guards) - set(spec.args)
+        if unknown:
+            raise TypeError("Guards for unknown arguments: %s" %
+                            ", ".join(sorted(unknown)))
+
+        load = lambda name: ast.Name(name, ast.Load())
+        store = lambda name: ast.Name(name, ast.Store())
+        call = lambda func, args, starargs=None, kwargs=None: ast.Call(
+            func, args, [], starargs, kwargs)
+
+        # Fresh names, which cannot clash with the parameters
+        key, function, variants, miss, calls, keyerror = [
+            symbol(name).name for name in
+                ('key', 'function', 'variants', 'miss', 'calls', 'KeyError')]
+        namespace = {variants: self.variants, miss: self.miss,
+                     calls: self.calls, keyerror: KeyError}
+        keys = []
+        for name in spec.args:
+            checks = guards.get(name, ())
+            if not isinstance(checks, tuple):
+                checks = checks,
+            for check in checks:
+                guard = symbol('guard').name
+                namespace[guard] = check
+                keys.append(call(load(guard), [load(name)]))
+
+        args = map(load, spec.args)
+        starargs = spec.varargs and load(spec.varargs)
+        kwargs = spec.keywords and load(spec.keywords)
+        body = [
+            # calls[0] += 1
+            ast.AugAssign(ast.Subscript(load(calls), ast.Index(ast.Num(0)),
+                                        ast.Store()),
+                          ast.Add(), ast.Num(1)),
+            ast.Assign([store(key)], ast.Tuple(keys, ast.Load())),
+            ast.TryExcept(
+                [ast.Assign([store(function)],
+                            ast.Subscript(load(variants),
+                                          ast.Index(load(key)),
+                                          ast.Load()))],
+                [ast.ExceptHandler(load(keyerror), None, [
+                    ast.Assign([store(function)],
+                               call(load(miss), [load(key)] + args,
+                                    starargs, kwargs))])],
+                []),
+            ast.Return(call(load(function), args, starargs, kwargs)),
+        ]
+        params = ast.arguments([ast.Name(name, ast.Param())
+                                    for name in spec.args],
+                               spec.varargs, spec.keywords, [])
+        name = self.func.__name__
+        tree = ast.FunctionDef(name, params, body, [])
+
+        exec astcompile(tree, "<dispatch %s>" % name) in namespace
+        dispatch = namespace[name]
+        dispatch.func_defaults = spec.defaults
+        dispatch.__doc__ = self.func.__doc__
+        dispatch.__module__ = self.func.__module__
+        return dispatch
+
+    def miss(self, key, *args, **kwargs):
+        """Stage, or fall back, for arguments without a specialization"""
+        self.misses += 1
+        if len(self.variants) >= self.maxvariants:
+            if self.fallback is not None:
+                self.fallbacks += 1
+                return self.fallback
+            del self.variants[self.order.popleft()]
+            self.evictions += 1
+
+        function = specialization(self.func(*args, **kwargs), self.globals)
+        self.variants[key] = function
+        self.order.append(key)
+        return function
+
+    def clear(self):
+        self.variants.clear()
+        self.order.clear()
+        self.calls[0] = self.misses = self.evictions = self.fallbacks = 0
+
+    def stats(self):
+        return dict(hits=self.calls[0] - self.misses, misses=self.misses,
+                    evictions=self.evictions, fallbacks=self.fallbacks,
+                    size=len(self.variants), maxsize=self.maxvariants)
+
+def specialization(result, globals):
+    """
+    The function returned by a staging function: a callable, a quoted
+    function definition, or a quoted expression evaluating to a function.
+    Quotations run in globals.
+    """
+    if callable(result):
+        return result
+    tree = materialize(result)
+    if issuite(tree):
+        tree = tree.body
+    if isinstance(tree, list) and len(tree) == 1:
+        tree = tree[0]
+
+    if isinstance(tree, ast.FunctionDef):
+        # Return the definition rather than binding it in the globals
+        code = compilecode(tree, result=tree.name)
+        return runcode(code, constants(tree), globals)
+    elif is_expr(tree):
+        return run(tree, globals)
+    raise TypeError("Staging function returned %r, expected a function "
+                    "or a quoted function" % (result,))
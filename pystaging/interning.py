@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hash-consed AST nodes.
+
+An InternTable maps the structure of a node to a single shared instance,
+so that structurally identical interned subtrees are the same object:
+
+    >>> t = InternTable()
+    >>> a = t.intern(ast.parse("A[i] + 1", mode='eval').body)
+    >>> b = t.intern(ast.parse("A[i] + 1", mode='eval').body)
+    >>> a is b
+    True
+
+Interned nodes have their structural key (see astutils.structkey)
+precomputed with a cached hash, so structural comparisons and lookups in
+caches keyed on the structure of a tree (memoization) share the key of the
+tree instead of building a new one. Identical interned trees are the same
+object, so they also share their code in the compile cache, which is keyed
+by identity. Source locations are not part of the structure, an interned
+node keeps the location of the first node interned or compiled.
+
+Interned nodes are shared and should not be mutated. The passes in
+pystaging.optimize copy the nodes they change. Keys are kept in a table
+beside the nodes rather than in them, so copies of interned nodes do not
+inherit them, and a node is checked to still have the children it was
+interned with before it or its key is reused: a node modified in place is
+dropped from its table. Tables keep their nodes alive, clear() them
+between unrelated generation runs, or bound them with maxsize.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging.utils import hashedtuple
+from pystaging.astutils import (structkey, fieldkey, snapshot, unchanged,
+                                keycache, Persisted)
+
+class InternTable(object):
+    """
+    Table of interned AST nodes. Nodes are looked up by their type and the
+    identities of their (interned) children.
+
+        maxsize: the number of nodes at which the table is cleared, or None
+                 for an unbounded table
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.nodes = {} # (type, child ids and constants) -> node
+        self.interned = set() # ids of the nodes in the table
+        self.hits = self.misses = self.evictions = 0
+
+    def node(self, type, *fields):
+        """
+        Return the interned node of the given type with the given field
+        values, which must be interned already. A node is only allocated
+        if no structurally identical one exists.
+        """
+        key = (type,) + tuple(map(fieldkey, fields))
+        node = self.nodes.get(key)
+        if node is not None and not unchanged(node, keycache[id(node)][1]):
+            # Modified in place since it was interned
+            self.drop(key, node)
+            node = None
+        if node is None:
+            self.misses += 1
+            if self.maxsize is not None and len(self.nodes) >= self.maxsize:
+                self.flush()
+                self.evictions += 1
+            node = type(*fields)
+            self.nodes[key] = node
+            self.interned.add(id(node))
+            keycache[id(node)] = (node, snapshot(fields), hashedtuple(
+                                     (type,) + tuple(map(structkey, fields))))
+        else:
+            self.hits += 1
+        return node
+
+    def intern(self, obj):
+        """Return the interned version of an AST, list or constant"""
+        if isinstance(obj, ast.AST):
+            if self.isinterned(obj) or isinstance(obj, Persisted):
+                # Persisted names hold their object outside their fields
+                return obj
+            fields = [self.intern(getattr(obj, field, None))
+                      for field in obj._fields]
+            return self.node(type(obj), *fields)
+        elif isinstance(obj, list):
+            return map(self.intern, obj)
+        return obj
+
+    def isinterned(self, node):
+        """
+        Whether node is the interned instance of its structure, with the
+        children it was interned with
+        """
+        return (id(node) in self.interned and
+                unchanged(node, keycache[id(node)][1]))
+
+    def drop(self, key, node):
+        del self.nodes[key]
+        self.interned.discard(id(node))
+        keycache.pop(id(node), None)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def clear(self):
+        self.flush()
+        self.hits = self.misses = self.evictions = 0
+
+    def flush(self):
+        """Drop all nodes, keeping the statistics"""
+        for node in self.nodes.itervalues():
+            keycache.pop(id(node), None)
+        self.nodes.clear()
+        self.interned.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self),
+                    evictions=self.evictions, maxsize=self.maxsize)
+
+    # Tables are pickled empty, their nodes are only shared within a process
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+# The default table of staging(intern=True)
+table = InternTable(maxsize=100000)
+
+def intern_ast(tree):
+    """Intern an AST in the default table"""
+    return table.intern(tree)
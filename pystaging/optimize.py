@@ -0,0 +1,1082 @@
+# -*- coding: utf-8 -*-
+
+"""
+Optimizations of generated code:
+
+    - fold: constant folding, dead branch elimination and algebraic
+            simplification
+    - unroll: loop unrolling of for loops over range()
+    - cse: common subexpression elimination
+    - hoist: bind the globals used by generated functions as closure cells
+    - deadstores: dead store and unused expression elimination
+
+Passes take an AST and return an optimized AST, they do not modify their
+input (quotations may be shared, e.g. through staging(memoize=True)).
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+import operator
+import collections
+from functools import partial
+from fnmatch import fnmatchcase
+
+from pystaging.astutils import is_expr, structkey, copynode, materialize
+from pystaging.quotation import symbol, suite
+from pystaging.visitors import bindings
+
+#===------------------------------------------------------------------===
+# Pipeline
+#===------------------------------------------------------------------===
+
+def optimize(tree, passes=None):
+    """Run optimization passes over an AST, by default constant folding"""
+    tree = materialize(tree)
+    for optimization in (default_passes if passes is None else passes):
+        tree = optimization(tree)
+    return tree
+
+def pipeline(*passes):
+    """Create an optimizer running the given passes in order"""
+    return partial(optimize, passes=passes)
+
+class Rewriter(object):
+    """
+    Copy-on-write AST transformer. Like ast.NodeTransformer, visitors for
+    statements may return a list of statements to inline or None to remove
+    the statement, but nodes are copied instead of modified.
+    """
+
+    def visit(self, node):
+        method = 'visit_' + node.__class__.__name__
+        return getattr(self, method, self.generic_visit)(node)
+
+    def generic_visit(self, node):
+        fields = {}
+        for field in node._fields:
+            old = getattr(node, field, None)
+            if isinstance(old, list):
+                new = self.visitlist(old)
+                if not new and old and field in ('body', 'finalbody'):
+                    new = [ast.Pass()]
+                if len(new) != len(old) or any(a is not b
+                                               for a, b in zip(new, old)):
+                    fields[field] = new
+            elif isinstance(old, ast.AST):
+                new = self.visit(old)
+                if new is not old:
+                    fields[field] = new
+
+        if fields:
+            return copynode(node, **fields)
+        return node
+
+    def visitlist(self, nodes):
+        result = []
+        for node in nodes:
+            if isinstance(node, ast.AST):
+                node = self.visit(node)
+            if isinstance(node, list):
+                result.extend(node)
+            elif node is not None:
+                result.append(node)
+        return result
+
+def single(result):
+    """Turn the result of visiting a statement into a single node"""
+    if isinstance(result, list):
+        return result[0] if len(result) == 1 else ast.Module(result)
+    return result
+
+def assign(name, value):
+    return ast.Assign([ast.Name(name, ast.Store())], value)
+
+#===------------------------------------------------------------------===
+# Constant folding
+#===------------------------------------------------------------------===
+
+def fold(tree, identities=True):
+    """
+    Fold constant expressions and eliminate branches with constant
+    conditions, including the 'if 1:' wrappers of quoted statements.
+    With identities, x - 0, x * 1 and x ** 1 are simplified to x if x is
+    known to be a number, and x + 0 if it is known to be an integer: a
+    literal, a call to int(), float() or len(), or arithmetic on those.
+    Constant powers, shifts and string repetitions are only folded if the
+    result stays small.
+    """
+    tree = materialize(tree)
+    return single(Folder(identities).visit(tree))
+
+binops = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod, ast.Pow: operator.pow,
+    ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_, ast.BitXor: operator.xor,
+    ast.BitAnd: operator.and_,
+}
+
+unaryops = {
+    ast.UAdd: operator.pos, ast.USub: operator.neg,
+    ast.Invert: operator.invert, ast.Not: operator.not_,
+}
+
+cmpops = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+    ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.Is: operator.is_, ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+
+numeric = (int, long, float, complex)
+
+# Limits on folded results: bits of integers and length of strings
+maxbits = 128
+maxlength = 256
+
+def isconst(node):
+    return (isinstance(node, (ast.Num, ast.Str)) or
+            isinstance(node, ast.Name) and node.id == 'None')
+
+def constvalue(node):
+    if isinstance(node, ast.Num):
+        return node.n
+    elif isinstance(node, ast.Str):
+        return node.s
+    return None
+
+def literal(value):
+    """Build a literal for a folded value, or None if it is not worth it"""
+    if value is None:
+        return ast.Name('None', ast.Load())
+    elif isinstance(value, (int, long)) and abs(value).bit_length() > maxbits:
+        return None
+    elif isinstance(value, numeric):
+        return ast.Num(value)
+    elif isinstance(value, basestring) and len(value) <= maxlength:
+        return ast.Str(value)
+    return None
+
+def bounded(op, left, right):
+    """
+    Whether folding a binary operation on constants gives a small result
+    without first computing a huge one, e.g. 10 ** 10 ** 8 or 'a' * 10 ** 9
+    """
+    isint = lambda value: isinstance(value, (int, long))
+    if op is ast.Pow and isint(left) and isint(right) and right > 1:
+        return abs(left) <= 1 or abs(left).bit_length() * right <= maxbits
+    elif op is ast.LShift and isint(left) and isint(right):
+        return left == 0 or abs(left).bit_length() + right <= maxbits
+    elif op is ast.Mult:
+        for seq, n in ((left, right), (right, left)):
+            if isinstance(seq, basestring) and isint(n):
+                return len(seq) * n <= maxlength
+    return True
+
+int_ops = (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod, ast.LShift,
+           ast.RShift, ast.BitOr, ast.BitXor, ast.BitAnd)
+number_ops = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+              ast.Pow)
+number_calls = {'int': int, 'len': int, 'float': float}
+
+def numbertype(node):
+    """
+    The type of number an expression is known to evaluate to: int, float
+    (which includes complex numbers), or None if it may not be a number
+    """
+    if isinstance(node, ast.Num):
+        return int if isinstance(node.n, (int, long)) else float
+    elif isinstance(node, ast.UnaryOp) and not isinstance(node.op, ast.Not):
+        return numbertype(node.operand)
+    elif isinstance(node, ast.BinOp):
+        left, right = numbertype(node.left), numbertype(node.right)
+        if left is int and right is int and isinstance(node.op, int_ops):
+            return int
+        elif left and right and isinstance(node.op, number_ops):
+            return float
+    elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+              len(node.args) == 1 and not (node.keywords or node.starargs or
+                                           node.kwargs)):
+        return number_calls.get(node.func.id)
+    return None
+
+class Folder(Rewriter):
+
+    def __init__(self, identities=True):
+        self.identities = identities
+
+    def fold(self, node, func, *args):
+        try:
+            value = func(*args)
+        except Exception:
+            return node
+        return literal(value) or node
+
+    # __________________________________________________________________
+    # Expressions
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        op = type(node.op)
+        if isconst(node.left) and isconst(node.right):
+            left, right = constvalue(node.left), constvalue(node.right)
+            if op is ast.Div and not (isinstance(left, float) or
+                                      isinstance(right, float)):
+                # The result depends on the division future flag
+                return node
+            if not bounded(op, left, right):
+                return node
+            return self.fold(node, binops[op], left, right)
+        elif self.identities:
+            return self.simplify(node, op)
+        return node
+
+    def simplify(self, node, op):
+        isnum = lambda node, n: (isinstance(node, ast.Num) and
+                                 type(node.n) in numeric and node.n == n)
+        if op in (ast.Add, ast.Sub, ast.Mult, ast.Pow):
+            unit = 1 if op in (ast.Mult, ast.Pow) else 0
+            # -0.0 + 0 is 0.0, so only integers are unchanged by adding 0
+            known = lambda operand: (numbertype(operand) is int
+                                     if op is ast.Add else
+                                     numbertype(operand) is not None)
+            if isnum(node.right, unit) and known(node.left):
+                return node.left
+            if (op in (ast.Add, ast.Mult) and isnum(node.left, unit) and
+                    known(node.right)):
+                return node.right
+        return node
+
+    def visit_UnaryOp(self, node):
+        node = self.generic_visit(node)
+        if isconst(node.operand):
+            value = constvalue(node.operand)
+            return self.fold(node, unaryops[type(node.op)], value)
+        return node
+
+    def visit_Compare(self, node):
+        node = self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        if not all(map(isconst, operands)):
+            return node
+
+        values = map(constvalue, operands)
+        def compare():
+            return all(cmpops[type(op)](a, b)
+                       for op, a, b in zip(node.ops, values, values[1:]))
+        return self.fold(node, compare)
+
+    def visit_BoolOp(self, node):
+        node = self.generic_visit(node)
+        values = list(node.values)
+        isand = isinstance(node.op, ast.And)
+        while len(values) > 1 and isconst(values[0]):
+            if bool(constvalue(values[0])) != isand:
+                # 'false and x' or 'true or x'
+                return values[0]
+            values.pop(0)
+
+        if len(values) == 1:
+            return values[0]
+        elif len(values) != len(node.values):
+            return copynode(node, values=values)
+        return node
+
+    def visit_IfExp(self, node):
+        node = self.generic_visit(node)
+        if isconst(node.test):
+            return node.body if constvalue(node.test) else node.orelse
+        return node
+
+    # __________________________________________________________________
+    # Statements
+
+    def visit_If(self, node):
+        node = self.generic_visit(node)
+        if isconst(node.test):
+            return node.body if constvalue(node.test) else node.orelse
+        return node
+
+    def visit_While(self, node):
+        node = self.generic_visit(node)
+        if isconst(node.test) and not constvalue(node.test):
+            return node.orelse
+        return node
+
+#===------------------------------------------------------------------===
+# Loop unrolling
+#===------------------------------------------------------------------===
+
+def unroll(tree, factor=4, limit=16):
+    """
+    Unroll for loops over range() or xrange() with a constant positive step.
+    Loops with a constant trip count of at most limit are unrolled fully,
+    substituting the induction variable. Other loops are unrolled factor
+    times, followed by a remainder loop:
+
+        for i in range(n):      start = 0; stop = n
+            body                mainstop = start + (stop - start) // 4 * 4
+                          ->    for t in range(start, mainstop, 4):
+                                    i = t
+                                    body
+                                    ...
+                                    i = t + 3
+                                    body
+                                for i in range(mainstop, stop):
+                                    body
+
+    where start, stop, mainstop and t are fresh symbols. Loops containing
+    break, continue or nested scopes are left alone.
+    """
+    tree = materialize(tree)
+    return single(Unroller(factor, limit).visit(tree))
+
+range_names = ('range', 'xrange')
+
+loop_types = (ast.For, ast.While)
+
+nested_scope_types = (ast.FunctionDef, ast.ClassDef, ast.Lambda,
+                      ast.GeneratorExp, ast.SetComp, ast.DictComp)
+
+def jumps(stmts):
+    """Whether a loop body may break, continue or define a nested scope"""
+    stack = list(stmts)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.Break, ast.Continue) + nested_scope_types):
+            return True
+        elif isinstance(node, loop_types):
+            # break and continue in a nested loop body are local to it
+            stack.extend(node.orelse)
+        else:
+            stack.extend(ast.iter_child_nodes(node))
+    return False
+
+def rebinds(name, stmts):
+    """Whether name is assigned or deleted in a list of statements"""
+    for stmt in stmts:
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name) and node.id == name:
+                if not isinstance(node.ctx, ast.Load):
+                    return True
+            elif isinstance(node, ast.alias):
+                if (node.asname or node.name) == name:
+                    return True
+            elif isinstance(node, ast.Global) and name in node.names:
+                return True
+    return False
+
+def constint(node):
+    return (isinstance(node, ast.Num) and isinstance(node.n, (int, long)) and
+            not isinstance(node.n, bool))
+
+class Substitute(Rewriter):
+    """Substitute loads of a variable by an expression"""
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def visit_Name(self, node):
+        if node.id == self.name and isinstance(node.ctx, ast.Load):
+            return copynode(self.value)
+        return node
+
+class Unroller(Rewriter):
+
+    def __init__(self, factor=4, limit=16):
+        self.factor = factor
+        self.limit = limit
+
+    def visit_For(self, node):
+        node = self.generic_visit(node)
+        bounds = self.rangeargs(node)
+        if (bounds is None or not isinstance(node.target, ast.Name) or
+                jumps(node.body)):
+            return node
+
+        start, stop, step = bounds
+        if constint(start) and constint(stop):
+            indices = range(start.n, stop.n, step)
+            if len(indices) <= self.limit:
+                return self.full(node, indices)
+        if self.factor > 1:
+            return self.partial(node, start, stop, step)
+        return node
+
+    def rangeargs(self, node):
+        """Return (start, stop, step) of a loop over range(), or None"""
+        call = node.iter
+        if not (isinstance(call, ast.Call) and
+                isinstance(call.func, ast.Name) and
+                call.func.id in range_names and
+                1 <= len(call.args) <= 3 and
+                not (call.keywords or call.starargs or call.kwargs)):
+            return None
+
+        args = list(call.args)
+        if len(args) == 1:
+            args.insert(0, ast.Num(0))
+        if len(args) == 2:
+            args.append(ast.Num(1))
+
+        start, stop, step = args
+        if not constint(step) or step.n <= 0:
+            return None
+        return start, stop, step.n
+
+    def full(self, node, indices):
+        """Fully unroll a loop for the given induction variable values"""
+        name = node.target.id
+        substitute = not rebinds(name, node.body)
+        result = []
+        for index in indices:
+            if substitute:
+                result.extend(Substitute(name, ast.Num(index)).visitlist(
+                                                                node.body))
+            else:
+                result.append(assign(name, ast.Num(index)))
+                result.extend(node.body)
+
+        if indices and substitute:
+            result.append(assign(name, ast.Num(indices[-1])))
+        return result + node.orelse
+
+    def partial(self, node, start, stop, step):
+        """Unroll a loop self.factor times, followed by a remainder loop"""
+        name = node.target.id
+        chunk = ast.Num(self.factor * step)
+        rangefunc = node.iter.func.id
+        startvar, stopvar = symbol('start'), symbol('stop')
+        mainstop, index = symbol('mainstop'), symbol(name)
+
+        # mainstop = start + (stop - start + step - 1) // chunk * chunk
+        count = ast.BinOp(ast.BinOp(stopvar.load, ast.Sub(), startvar.load),
+                          ast.Add(), ast.Num(step - 1))
+        extent = ast.BinOp(ast.BinOp(count, ast.FloorDiv(), chunk),
+                           ast.Mult(), chunk)
+        result = [
+            assign(startvar.name, start),
+            assign(stopvar.name, stop),
+            assign(mainstop.name, ast.BinOp(startvar.load, ast.Add(), extent)),
+            ast.If(ast.Compare(mainstop.load, [ast.Lt()], [startvar.load]),
+                   [assign(mainstop.name, startvar.load)], []),
+        ]
+
+        body = []
+        for i in range(self.factor):
+            value = index.load
+            if i:
+                value = ast.BinOp(value, ast.Add(), ast.Num(i * step))
+            body.append(assign(name, value))
+            body.extend(node.body)
+
+        rangecall = lambda args: ast.Call(ast.Name(rangefunc, ast.Load()),
+                                          args, [], None, None)
+        result.append(ast.For(index.store,
+                              rangecall([startvar.load, mainstop.load, chunk]),
+                              body, []))
+        result.append(copynode(node, iter=rangecall([mainstop.load,
+                                                     stopvar.load,
+                                                     ast.Num(step)])))
+        return result
+
+#===------------------------------------------------------------------===
+# Purity
+#===------------------------------------------------------------------===
+
+def dotted(node):
+    """Return the dotted name of a Name or Attribute chain, or None"""
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        value = dotted(node.value)
+        return value and value + '.' + node.attr
+    return None
+
+pure_types = (
+    ast.Num, ast.Str, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+    ast.IfExp, ast.Tuple, ast.Index, ast.Slice, ast.ExtSlice, ast.Ellipsis,
+    ast.keyword, ast.operator, ast.unaryop, ast.cmpop, ast.boolop,
+    ast.expr_context,
+)
+
+pure_builtins = ('abs', 'len', 'min', 'max', 'float', 'int', 'round',
+                 'math.*')
+
+class Purity(object):
+    """
+    Purity policy, deciding which expressions may be evaluated once instead
+    of several times.
+
+        calls:      fnmatch patterns of dotted names of pure functions
+        attributes: whether attribute loads are pure
+        subscripts: whether subscript loads are pure
+    """
+
+    def __init__(self, calls=pure_builtins, attributes=True, subscripts=True):
+        self.calls = tuple(calls)
+        self.attributes = attributes
+        self.subscripts = subscripts
+
+    def pure(self, node):
+        """Whether the operation of node (not its children) is pure"""
+        if isinstance(node, ast.Call):
+            return self.purecall(node)
+        elif isinstance(node, ast.Attribute):
+            return self.attributes and isinstance(node.ctx, ast.Load)
+        elif isinstance(node, ast.Subscript):
+            return self.subscripts and isinstance(node.ctx, ast.Load)
+        elif isinstance(node, ast.Name):
+            return isinstance(node.ctx, ast.Load)
+        return isinstance(node, pure_types)
+
+    def purecall(self, node):
+        name = dotted(node.func)
+        return (name is not None and not node.starargs and not node.kwargs and
+                any(fnmatchcase(name, pattern) for pattern in self.calls))
+
+default_purity = Purity()
+
+#===------------------------------------------------------------------===
+# Common subexpression elimination
+#===------------------------------------------------------------------===
+
+def cse(tree, purity=None):
+    """
+    Eliminate common subexpressions. Repeated pure subexpressions of a
+    statement are assigned to fresh temporaries before the statement:
+
+        x = (a + 2) * (a + 2)   ->   staged.temp.cse = a + 2
+                                     x = staged.temp.cse * staged.temp.cse
+
+    Bare expressions have no statement to bind temporaries before, they
+    bind them in a list comprehension instead (see CSE.expression).
+    """
+    tree = materialize(tree)
+    eliminator = CSE(purity or default_purity)
+    if isinstance(tree, ast.Expression):
+        body = eliminator.expression(tree.body)
+        return tree if body is tree.body else copynode(tree, body=body)
+    elif is_expr(tree):
+        return eliminator.expression(tree)
+    elif isinstance(tree, list):
+        return eliminator.block(tree)
+    elif isinstance(tree, (ast.Module, ast.Suite)):
+        return copynode(tree, body=eliminator.block(tree.body))
+
+    stmts = eliminator.statement(tree)
+    if len(stmts) == 1:
+        return stmts[0]
+    return suite(stmts)
+
+# Expression fields evaluated once when executing a statement
+header_fields = {
+    ast.Expr: ('value',),
+    ast.Assign: ('targets', 'value'),
+    ast.AugAssign: ('target', 'value'),
+    ast.Return: ('value',),
+    ast.Print: ('dest', 'values'),
+    ast.Raise: ('type', 'inst', 'tback'),
+    ast.If: ('test',),
+    ast.For: ('iter',),
+    ast.With: ('context_expr',),
+}
+
+# Expressions worth hoisting
+candidate_types = (
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Subscript, ast.Attribute, ast.Call,
+)
+
+# Expressions introducing a scope
+scope_types = (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp,
+               ast.DictComp)
+
+class CSE(object):
+    """
+    Common subexpression elimination by value numbering. Only the
+    unconditionally evaluated parts of an expression are considered, e.g.
+    not the right operand of 'and', the branches of 'a if b else c' or the
+    comparators after the first of 'a < b < c'.
+    If a statement calls impure functions, attribute and subscript loads
+    are not hoisted past them.
+    """
+
+    def __init__(self, purity):
+        self.purity = purity
+
+    # __________________________________________________________________
+    # Statements
+
+    def block(self, stmts):
+        result = []
+        for stmt in stmts:
+            result.extend(self.statement(stmt))
+        return result
+
+    def statement(self, stmt):
+        """Return a list of statements: the hoisted assignments and stmt"""
+        names = header_fields.get(type(stmt), ())
+        prelude, values = self.eliminate([getattr(stmt, name)
+                                          for name in names])
+        fields = dict(zip(names, values))
+        for name in ('body', 'orelse', 'finalbody'):
+            if isinstance(getattr(stmt, name, None), list):
+                fields[name] = self.block(getattr(stmt, name))
+        if isinstance(stmt, ast.TryExcept):
+            fields['handlers'] = [copynode(handler,
+                                           body=self.block(handler.body))
+                                  for handler in stmt.handlers]
+        return prelude + [copynode(stmt, **fields)]
+
+    def expression(self, expr):
+        """
+        Eliminate common subexpressions of a bare expression. The
+        temporaries are bound by a list comprehension, which in Python 2
+        runs in the enclosing scope, so the expression sees the same names:
+
+            (a + 2) * (a + 2)   ->   [staged.temp.cse * staged.temp.cse
+                                         for staged.temp.cse in [a + 2]][0]
+        """
+        prelude, (expr,) = self.eliminate([expr])
+        if not prelude:
+            return expr
+        generators = [ast.comprehension(assign.targets[0],
+                                        ast.List([assign.value], ast.Load()),
+                                        [])
+                      for assign in prelude]
+        return ast.Subscript(ast.ListComp(expr, generators),
+                             ast.Index(ast.Num(0)), ast.Load())
+
+    # __________________________________________________________________
+    # Expressions
+
+    def eliminate(self, roots):
+        """Eliminate common subexpressions, return (assignments, roots)"""
+        self.numbers = {}   # key -> value number
+        self.info = {}      # id(node) -> (number, pure, heap)
+        for root in roots:
+            self.analyze(root)
+
+        self.heap = not any(isinstance(node, ast.Call) and
+                            not self.purity.purecall(node)
+                                for root in roots
+                                    for node in self.walk(root))
+
+        total, seen = collections.Counter(), collections.Counter()
+        for root in roots:
+            self.count(root, total)
+        for root in roots:
+            self.count(root, seen, total)
+
+        self.hoist = set(num for num, count in seen.iteritems() if count > 1)
+        self.temps = {}
+        self.prelude = []
+        roots = [self.rewrite(root) for root in roots]
+        return self.prelude, roots
+
+    def walk(self, node):
+        if isinstance(node, list):
+            for item in node:
+                for child in self.walk(item):
+                    yield child
+        elif isinstance(node, ast.AST):
+            for child in ast.walk(node):
+                yield child
+
+    def analyze(self, node):
+        """Compute (value number, pure, reads heap) bottom-up"""
+        if isinstance(node, list):
+            children = map(self.analyze, node)
+            key = (list,) + tuple(num for num, pure, heap in children)
+        elif isinstance(node, ast.AST):
+            children = [self.analyze(getattr(node, field, None))
+                        for field in node._fields]
+            key = (type(node),) + tuple(num for num, pure, heap in children)
+        else:
+            return self.number(structkey(node)), True, False
+
+        pure = all(pure for num, pure, heap in children)
+        heap = any(heap for num, pure, heap in children)
+        if isinstance(node, ast.AST):
+            pure = pure and self.purity.pure(node)
+            heap = heap or isinstance(node, (ast.Attribute, ast.Subscript))
+
+        info = self.number(key), pure, heap
+        self.info[id(node)] = info
+        return info
+
+    def number(self, key):
+        return self.numbers.setdefault(key, len(self.numbers))
+
+    def candidate(self, node):
+        if not isinstance(node, candidate_types):
+            return False
+        if isinstance(node, ast.UnaryOp) and isinstance(node.operand, ast.Num):
+            return False
+        num, pure, heap = self.info[id(node)]
+        return pure and (self.heap or not heap)
+
+    def children(self, node):
+        """The unconditionally evaluated children of node"""
+        if isinstance(node, ast.BoolOp):
+            return node.values[:1]
+        elif isinstance(node, ast.IfExp):
+            return [node.test]
+        elif isinstance(node, ast.Compare):
+            return [node.left] + node.comparators[:1]
+        elif isinstance(node, scope_types):
+            return []
+        return [getattr(node, field, None) for field in node._fields]
+
+    def count(self, node, counts, total=None):
+        """
+        Count candidate occurrences. Given the total counts, do not descend
+        into repeated occurrences, as they will be replaced entirely.
+        """
+        if isinstance(node, list):
+            for item in node:
+                self.count(item, counts, total)
+            return
+        elif not isinstance(node, ast.AST):
+            return
+
+        if self.candidate(node):
+            num = self.info[id(node)][0]
+            counts[num] += 1
+            if total is not None and counts[num] > 1 and total[num] > 1:
+                return
+
+        for child in self.children(node):
+            self.count(child, counts, total)
+
+    def rewrite(self, node):
+        if isinstance(node, list):
+            return [self.rewrite(item) for item in node]
+        elif not isinstance(node, ast.AST):
+            return node
+
+        num = self.info[id(node)][0]
+        hoist = self.candidate(node) and num in self.hoist
+        if hoist and num in self.temps:
+            return self.temps[num].load
+
+        node = self.rewritechildren(node)
+        if hoist:
+            temp = symbol('cse')
+            self.prelude.append(ast.Assign([temp.store], node))
+            self.temps[num] = temp
+            return temp.load
+        return node
+
+    def rewritechildren(self, node):
+        if isinstance(node, ast.BoolOp):
+            fields = {'values': [self.rewrite(node.values[0])] +
+                                node.values[1:]}
+        elif isinstance(node, ast.IfExp):
+            fields = {'test': self.rewrite(node.test)}
+        elif isinstance(node, ast.Compare):
+            fields = {'left': self.rewrite(node.left),
+                      'comparators': self.rewrite(node.comparators[:1]) +
+                                     node.comparators[1:]}
+        elif isinstance(node, scope_types):
+            return node
+        else:
+            fields = dict((field, self.rewrite(getattr(node, field)))
+                          for field in node._fields if hasattr(node, field))
+
+        changed = any(value != getattr(node, field)
+                          for field, value in fields.iteritems())
+        if changed:
+            return copynode(node, **fields)
+        return node
+
+#===------------------------------------------------------------------===
+# Global hoisting
+#===------------------------------------------------------------------===
+
+def hoist(tree, names=None, attributes=False):
+    """
+    Bind the global names that generated functions load once, when the
+    function is defined, so that they are closure cells instead of global
+    lookups:
+
+        def f(n):                       def staged.temp.hoist(math.sqrt,
+            for i in range(n):      ->                        range):
+                math.sqrt(i)                def f(n):
+                                                for i in range(n):
+                                                    math.sqrt(i)
+                                            return f
+                                        f = staged.temp.hoist(math.sqrt,
+                                                              range)
+
+    With attributes, attribute chains on global names (math.sqrt) are bound
+    as well, unless the function stores, deletes or augments the chain or
+    a prefix of it. Only names in names are hoisted if given, names bound
+    at the top level of the tree never are. The names must be defined when
+    the function definition runs, and later changes to them are not seen.
+    """
+    tree = materialize(tree)
+    if is_expr(tree):
+        return tree
+    module = tree if isinstance(tree, ast.Module) else ast.Module([tree])
+    maps = bindings(module)
+    exclude = set(maps[module][0]) | set(['None', 'True', 'False'])
+    hoister = Hoister(maps, exclude, names, attributes)
+    return single(hoister.visit(tree))
+
+def globalnames(func, maps):
+    """
+    The Name nodes in func and its nested functions that load globals,
+    from the bindings() of func.
+    """
+    nodes = []
+    def collect(func, enclosing):
+        bound, free = maps[func]
+        for name, refs in free.iteritems():
+            if name not in enclosing:
+                nodes.extend(ref for ref in refs
+                             if isinstance(ref.ctx, ast.Load))
+        enclosing = enclosing | set(bound)
+        for child in nestedfunctions(func):
+            collect(child, enclosing)
+    collect(func, frozenset())
+    return nodes
+
+def nestedfunctions(node):
+    """The functions defined directly in node"""
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, ast.FunctionDef):
+            yield child
+        else:
+            for func in nestedfunctions(child):
+                yield func
+
+class Hoister(Rewriter):
+    """Wraps top-level function definitions in factories"""
+
+    def __init__(self, maps, exclude, names=None, attributes=False):
+        self.maps = maps
+        self.exclude = exclude
+        self.names = names
+        self.attributes = attributes
+
+    def visit_FunctionDef(self, node):
+        declared = set(name for stmt in ast.walk(node)
+                       if isinstance(stmt, ast.Global)
+                       for name in stmt.names)
+        refs = [ref for ref in globalnames(node, self.maps)
+                if ref.id not in self.exclude and ref.id not in declared and
+                   (self.names is None or ref.id in self.names)]
+        if not refs:
+            return node
+
+        chains = {}
+        if self.attributes:
+            written = set(dotted(attr) for attr in ast.walk(node)
+                          if isinstance(attr, ast.Attribute) and
+                             not isinstance(attr.ctx, ast.Load))
+            node = Localizer(set(refs), chains, written).visit(node)
+        params = sorted(set(ref.id for ref in refs)) + sorted(chains)
+
+        factory = symbol('hoist')
+        args = ast.arguments([ast.Name(name, ast.Param()) for name in params],
+                             None, None, [])
+        body = [node, ast.Return(ast.Name(node.name, ast.Load()))]
+        values = [chains.get(name) or ast.Name(name, ast.Load())
+                  for name in params]
+        return [ast.FunctionDef(factory.name, args, body, []),
+                assign(node.name, ast.Call(factory.load, values, [],
+                                           None, None))]
+
+    def visit_ClassDef(self, node):
+        return node
+
+    def visit_Lambda(self, node):
+        return node
+
+class Localizer(Rewriter):
+    """
+    Replaces attribute chains on global names by local names, except chains
+    the function writes to: those in written, and their extensions
+    """
+
+    def __init__(self, refs, chains, written=frozenset()):
+        self.refs = refs # global Name nodes
+        self.chains = chains # local name -> attribute chain
+        self.written = written # dotted names of stored attributes
+
+    def visit_Attribute(self, node):
+        base = node
+        while isinstance(base, ast.Attribute):
+            base = base.value
+        if isinstance(node.ctx, ast.Load) and base in self.refs:
+            name = dotted(node)
+            if not self.iswritten(name):
+                self.chains[name] = node
+                return ast.Name(name, ast.Load())
+        return self.generic_visit(node)
+
+    def iswritten(self, name):
+        """Whether name or a prefix of it is written"""
+        while name not in self.written:
+            if '.' not in name:
+                return False
+            name = name.rsplit('.', 1)[0]
+        return True
+
+#===------------------------------------------------------------------===
+# Dead store elimination
+#===------------------------------------------------------------------===
+
+def deadstores(tree, prefix='staged.temp.', stats=None):
+    """
+    Remove assignments to temporaries (names starting with prefix) in
+    functions that never load them, and expression statements whose value
+    is unused and cannot raise:
+
+        def f(staged.temp.x):                 def f(staged.temp.x):
+            staged.temp.y = staged.temp.x  ->     return staged.temp.x
+            (staged.temp.x, 1)
+            return staged.temp.x
+
+    Only literals, tuples and lists of them, and parameters of the function
+    that it never deletes are known not to raise; stores of other values
+    are kept as expression statements, so that e.g. a[10] still raises
+    IndexError. Stores at module level are kept, they are visible in the
+    globals. The number of removed statements is added to stats['removed']
+    if given.
+    """
+    tree = materialize(tree)
+    if is_expr(tree):
+        return tree
+    eliminator = DeadStores(prefix)
+    while True:
+        module = tree if isinstance(tree, ast.Module) else ast.Module([tree])
+        eliminator.dead = deadnames(bindings(module), prefix)
+        eliminator.changed = False
+        tree = single(eliminator.visit(tree))
+        if not eliminator.changed:
+            break
+    if stats is not None:
+        stats['removed'] = stats.get('removed', 0) + eliminator.removed
+    return tree
+
+def deadnames(maps, prefix):
+    """
+    Map each function to the temporaries it binds but never loads, from
+    the bindings() of a module. Temporaries that are free in a nested
+    function are closure variables and live.
+    """
+    dead = {}
+    for node, (bound, free) in maps.iteritems():
+        if not isinstance(node, ast.FunctionDef) or dynamic(node):
+            continue
+        closed, augmented = set(), set()
+        for child in ast.walk(node):
+            if child is not node and child in maps:
+                closed.update(maps[child][1])
+            elif isinstance(child, ast.AugAssign):
+                augmented.add(child.target) # loads its target
+        dead[node] = set(
+            name for name, refs in bound.iteritems()
+            if name.startswith(prefix) and name not in closed and
+               all(isinstance(ref, ast.Name) and ref not in augmented and
+                   isinstance(ref.ctx, (ast.Store, ast.Param))
+                   for ref in refs))
+    return dead
+
+def dynamic(func):
+    """Whether func may access its locals by name, or declares globals"""
+    for node in ast.walk(func):
+        if isinstance(node, (ast.Exec, ast.Global, ast.ImportFrom)):
+            return True
+        elif (isinstance(node, ast.Name) and
+                  node.id in ('locals', 'vars', 'eval', 'dir')):
+            return True
+    return False
+
+def cannotraise(expr, bound):
+    """
+    Whether evaluating expr cannot raise: it is built from literals, tuples
+    and lists, and loads of the names in bound
+    """
+    for node in ast.walk(expr):
+        if isinstance(node, ast.Name):
+            if not (isinstance(node.ctx, ast.Load) and node.id in bound):
+                return False
+        elif not isinstance(node, safe_types):
+            return False
+    return True
+
+safe_types = (ast.Num, ast.Str, ast.Tuple, ast.List, ast.expr_context)
+
+constant_names = frozenset(['None', 'True', 'False'])
+
+def parameters(func):
+    """The parameters of a function that it never deletes"""
+    names = set(node.id for node in ast.walk(func.args)
+                if isinstance(node, ast.Name))
+    names.update(name for name in (func.args.vararg, func.args.kwarg) if name)
+    names.difference_update(node.id for node in ast.walk(func)
+                            if isinstance(node, ast.Name) and
+                               isinstance(node.ctx, ast.Del))
+    return names
+
+class DeadStores(Rewriter):
+    """Removes the dead stores of each function, see deadstores()"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.dead = {} # function -> dead temporaries
+        self.current = frozenset()
+        self.bound = constant_names # names known to be bound
+        self.changed = False
+        self.removed = 0
+
+    def visit_FunctionDef(self, node):
+        current, bound = self.current, self.bound
+        self.current = self.dead.get(node, frozenset())
+        self.bound = constant_names | parameters(node)
+        try:
+            return self.generic_visit(node)
+        finally:
+            self.current, self.bound = current, bound
+
+    def visit_ClassDef(self, node):
+        current, bound = self.current, self.bound
+        self.current, self.bound = frozenset(), constant_names
+        try:
+            return self.generic_visit(node)
+        finally:
+            self.current, self.bound = current, bound
+
+    def visit_Assign(self, node):
+        targets = [target for target in node.targets
+                   if not (isinstance(target, ast.Name) and
+                           target.id in self.current)]
+        if len(targets) == len(node.targets):
+            return node
+        self.changed = True
+        if targets:
+            return copynode(node, targets=targets)
+        elif cannotraise(node.value, self.bound):
+            self.removed += 1
+            return None
+        return ast.copy_location(ast.Expr(node.value), node)
+
+    def visit_Expr(self, node):
+        # Keep docstrings and other constants, the compiler drops them
+        if (not isinstance(node.value, (ast.Str, ast.Num)) and
+                cannotraise(node.value, self.bound)):
+            self.changed = True
+            self.removed += 1
+            return None
+        return node
+
+# ______________________________________________________________________
+
+default_passes = (fold,)
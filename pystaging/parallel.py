@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parallel staging in a process pool:
+
+    jobs = [(make_kernel, (op,)) for op in ops]
+    codes = stage_parallel(jobs)
+
+Each job calls a staging function in a worker process. Quotations it
+returns are compiled there, and the code objects are marshalled back to the
+parent.
+
+Temporary names are made deterministic and unique across the batch by
+giving each job its own namescope(), staged.temp.batch<N>.<job>.<name>. The
+names a job generates therefore depend only on the job and the batch, not
+on which worker ran it or what that worker ran before.
+
+Objects persisted in the quotations (see quotation.persist) are pickled
+back with the code, and bound in the globals of the caller.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+import sys
+import marshal
+import multiprocessing
+
+from pystaging import quotation
+from pystaging.astutils import astcompile, materialize
+
+def stage_parallel(jobs, processes=None, pool=None, globals=None):
+    """
+    Run staging jobs in a process pool and return their results in order.
+
+        jobs:      (func, args) or (func, args, kwargs) tuples, with func a
+                   module-level staging function and picklable arguments
+        processes: the number of worker processes, defaults to the number
+                   of CPUs
+        pool:      a multiprocessing.Pool or a concurrent.futures process
+                   executor to use instead of a new pool
+        globals:   the globals to bind persisted objects in, defaults to
+                   the globals of the caller
+
+    Quotations are returned as code objects to eval() or exec, other
+    results as they are, which must be picklable.
+    """
+    if globals is None:
+        globals = sys._getframe(1).f_globals
+
+    batch = quotation.temp('batch')
+    tasks = []
+    for n, job in enumerate(jobs):
+        func, args = job[:2]
+        kwargs = job[2] if len(job) > 2 else {}
+        tasks.append(('%s.%d.' % (batch, n), func, args, kwargs))
+
+    if pool is None:
+        workers = multiprocessing.Pool(processes)
+        try:
+            results = workers.map(stagejob, tasks)
+        finally:
+            workers.close()
+            workers.join()
+    else:
+        results = list(pool.map(stagejob, tasks))
+
+    return [unpackresult(result, globals) for result in results]
+
+def stagejob(task):
+    """Run a staging job in a worker, in the namespace of the job"""
+    namespace, func, args, kwargs = task
+    with quotation.namescope(namespace):
+        result = materialize(func(*args, **kwargs))
+    if isinstance(result, ast.AST):
+        code = astcompile(result, "<staged %s>" % namespace.rstrip('.'))
+        return 'code', marshal.dumps(code), quotation.constants(result)
+    return 'value', result, {}
+
+def unpackresult(result, globals):
+    kind, value, constants = result
+    for name, obj in constants.iteritems():
+        quotation.reserve(name)
+        quotation.bindconst(globals, name, obj)
+    if kind == 'code':
+        code = marshal.loads(value)
+        quotation.reserve(code)
+        return code
+    return value
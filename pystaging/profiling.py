@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+Profiling hooks for the staging pipeline.
+
+The staging decorator and the compile-time quote and escape operators
+report each stage they run: getsource, parse, bindings, process, optimize,
+compile and exec for every staged function, and quote, escape_ast (or
+template) and escape for every quotation site. Hooks registered with
+addhook() are called with a record of each stage:
+
+    stage:       the name of the stage
+    function:    module.name of the staged function
+    site:        filename:lineno of the quotation or escape, or None
+    seconds:     wall time, including nested stages
+    nodes:       the number of AST nodes produced, or None
+    allocations: net number of objects tracked by the garbage collector
+                 allocated, or None if a collection ran during the stage
+
+The Collector hook aggregates records into a table or JSON:
+
+    with collect() as collector:
+        @staging
+        def f(x):
+            ...
+    print(collector.table())
+
+Without hooks, stages cost a function call and an empty with block.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+import gc
+import json
+import timeit
+import linecache
+import contextlib
+import collections
+
+hooks = []
+
+def addhook(hook):
+    """Call hook with the record of every stage"""
+    hooks.append(hook)
+
+def removehook(hook):
+    hooks.remove(hook)
+
+@contextlib.contextmanager
+def profiled(hook):
+    """Register hook for the duration of a with block"""
+    addhook(hook)
+    try:
+        yield hook
+    finally:
+        removehook(hook)
+
+def collect():
+    """Collect the stages run in a with block in a new Collector"""
+    return profiled(Collector())
+
+# ______________________________________________________________________
+
+def stage(name, function=None, site=None):
+    """
+    Context manager that reports a stage to the hooks. Instrumented code
+    passes the tree it produced to the result() method of the stage.
+    """
+    if not hooks:
+        return nostage
+    return Stage(name, function, site)
+
+def sitestage(name, env, tree):
+    """Stage for the quotation or escape site of tree"""
+    if not hooks:
+        return nostage
+    return Stage(name, env.get('function'), sitename(env, tree))
+
+class NoStage(object):
+    """Stage that is not reported, while there are no hooks"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def result(self, tree):
+        pass
+
+nostage = NoStage()
+
+class Stage(object):
+
+    def __init__(self, name, function=None, site=None):
+        self.record = {'stage': name, 'function': function, 'site': site,
+                       'nodes': None}
+
+    def __enter__(self):
+        self.allocations = gc.get_count()[0]
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = timeit.default_timer() - self.start
+        allocations = gc.get_count()[0] - self.allocations
+        if exc_type is None:
+            self.record['seconds'] = seconds
+            if allocations < 0:
+                allocations = None # counts were reset by a collection
+            self.record['allocations'] = allocations
+            for hook in list(hooks):
+                hook(self.record)
+
+    def result(self, tree):
+        self.record['nodes'] = countnodes(tree)
+
+def countnodes(tree):
+    if isinstance(tree, list):
+        return sum(countnodes(node) for node in tree)
+    elif isinstance(tree, ast.AST):
+        return sum(1 for node in ast.walk(tree))
+    return None
+
+def funcname(func):
+    return '%s.%s' % (func.__module__, func.__name__)
+
+def sitename(env, tree):
+    """filename:lineno of a quotation or escape site"""
+    lineno = getattr(tree, 'lineno', None)
+    if lineno is None and getattr(tree, 'body', None):
+        lineno = getattr(tree.body[0], 'lineno', None)
+    filename = env['globals'].get('__file__')
+    if lineno is not None and 'firstlineno' in env:
+        # Parsed from the source of the function without its decorators
+        lineno += deflineno(filename, env['firstlineno']) - 1
+    return '%s:%s' % (filename, lineno)
+
+def deflineno(filename, firstlineno):
+    """Line number of the def of a function, skipping its decorators"""
+    lineno = firstlineno
+    while linecache.getline(filename, lineno).lstrip().startswith('@'):
+        lineno += 1
+    return lineno
+
+# ______________________________________________________________________
+
+class Collector(object):
+    """
+    Hook that keeps every record and aggregates them per function, stage
+    and site.
+    """
+
+    fields = ('calls', 'seconds', 'nodes', 'allocations')
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        del self.records[:]
+
+    def summary(self):
+        """
+        Return {(function, stage, site): totals} with totals a dict of
+        calls, seconds, nodes and allocations.
+        """
+        totals = collections.OrderedDict()
+        for record in self.records:
+            key = record['function'], record['stage'], record['site']
+            total = totals.setdefault(key, dict.fromkeys(self.fields, 0))
+            total['calls'] += 1
+            for field in self.fields[1:]:
+                total[field] += record[field] or 0
+        return totals
+
+    def table(self):
+        """Format the summary as a table, one row per stage and site"""
+        lines = ["%-50s %6s %10s %8s %8s" % ('function / stage / site',
+                                             'calls', 'ms', 'nodes',
+                                             'allocs')]
+        function = None
+        for (func, stage, site), total in self.summary().iteritems():
+            if func != function:
+                lines.append(str(func))
+                function = func
+            name = "  %s %s" % (stage, site or '')
+            lines.append("%-50s %6d %10.3f %8d %8d" % (
+                name, total['calls'], total['seconds'] * 1e3,
+                total['nodes'], total['allocations']))
+        return "\n".join(lines)
+
+    def json(self, records=False):
+        """Return the summary, and optionally the records, as JSON"""
+        summary = [dict(function=func, stage=stage, site=site, **total)
+                   for (func, stage, site), total
+                       in self.summary().iteritems()]
+        data = {'summary': summary}
+        if records:
+            data['records'] = self.records
+        return json.dumps(data, indent=2)
@@ -6,19 +6,62 @@ Support for multi-stage programming.
 
 from __future__ import print_function, division, absolute_import
 
+import os
 import ast
 import sys
-
-from .utils import getsource, make_temper
-from .astutils import astcompile, escape_ast, is_expr, is_stmt, wrap
-from .visitors import replace, bindings, findquotes, ExprKill
+import types
+import inspect
+import hashlib
+import marshal
+import threading
+import weakref
+import functools
+import contextlib
+import UserDict
+import __builtin__
+
+from .utils import (getsource, make_temper, hashable, gcpaused, gcresumed,
+                    BoundedCache, LRUCache)
+from .astutils import (astcompile, escape_ast, is_expr, is_stmt, wrap,
+                       structkey, unparse, materialize, Persisted, copytree,
+                       boundnames)
+from .visitors import (replace, rewrite, bindings, findquotes, stagednames,
+                       quotednames, isquote, ExprKill)
+from .templates import Template, LazyQuotation
+from . import interning
+from .profiling import stage, sitestage, funcname
+from .diskcache import diskcache, cachekey
 
 
 prefix = 'staged.temp.'
 temper = make_temper()
+scopes = threading.local()
 
 def temp(name):
-    return temper(prefix + name)
+    scope = getattr(scopes, 'current', None)
+    if scope is None:
+        return temper(prefix + name)
+    supply, namespace = scope
+    return supply(namespace + name)
+
+@contextlib.contextmanager
+def namescope(namespace=None):
+    """
+    Generate the temporary names of this thread from a counter of its own
+    in a separate namespace, e.g. for a staging session. The namespace
+    defaults to a fresh staged.temp.scope<N>. prefix.
+
+        with namescope():
+            tmp = symbol('tmp') # staged.temp.scope1.tmp
+    """
+    if namespace is None:
+        namespace = temp('scope') + '.'
+    outer = getattr(scopes, 'current', None)
+    scopes.current = make_temper(), namespace
+    try:
+        yield namespace
+    finally:
+        scopes.current = outer
 
 #===------------------------------------------------------------------===
 # Public interface
@@ -38,36 +81,152 @@ class symbol(object):
         return ast.Name(self.name, ast.Load())
 
 
-def staging(func=None, auto_escape=False, hygiene=False, debug=False):
+def staging(func=None, auto_escape=False, hygiene=False, debug=False,
+            templates=False, memoize=False, static=None, cache_dir=None,
+            optimize=None, intern=False, lazy=False, incremental=False,
+            asts=None, pausegc=False):
     """
     Define a staging function, i.e. one that uses quote, escape or run.
 
         auto_escape: auto escape free variables in quotations
         hygiene:     auto name-mangle bound variables in quotations, for
                      "safe" use in run(), eval() or exec
+        templates:   build quotations by instantiating compiled templates
+                     instead of replaying AST constructor calls
+        memoize:     cache results keyed by the static arguments. Either
+                     True, a maximum cache size, or a BoundedCache such as
+                     LRUCache, LFUCache or FIFOCache
+        static:      names of the arguments to key the cache on, defaults
+                     to the arguments used outside quotations or in escapes
+        cache_dir:   directory to persist the generated code in across
+                     processes, defaults to $PYSTAGING_CACHE_DIR. Functions
+                     that splice in escapes outside quotations are not
+                     persisted, nor is anything in debug mode.
+        optimize:    optimize the rewritten function before compilation,
+                     and the quotations it builds once their escapes are
+                     spliced in (lazy quotations only when they are run).
+                     True for the default passes of pystaging.optimize, or
+                     a function taking and returning an AST
+        intern:      build quotations from hash-consed nodes, so that
+                     identical fragments are shared. True for the default
+                     table of pystaging.interning, or an InternTable.
+                     Implies templates.
+        lazy:        return quotations as LazyQuotations, which record the
+                     template and the escaped values and only build the
+                     AST when it is needed. Implies templates.
+        incremental: rebuild only the statements of quoted statement lists
+                     whose escaped values changed since the last call, and
+                     reuse the others. Reused statement nodes are shared
+                     between the results of calls and must not be
+                     modified in place. Implies templates.
+        asts:        names of arguments or variables that always hold ASTs
+                     when they are escaped, so that their escapes splice
+                     them without a runtime check. Names that are only
+                     assigned quotations are found automatically.
+        pausegc:     pause the cyclic garbage collector while rewriting
+                     the function, which makes staging large functions
+                     faster. The collector is process wide, so it is off
+                     for all threads while any thread stages with pausegc.
     """
+    optimize = optimizer(optimize)
+    if intern is True:
+        intern = interning.table
+    elif intern is False:
+        intern = None
+    options = dict(auto_escape=auto_escape, hygiene=hygiene,
+                   templates=templates, optimize=optimizer_key(optimize),
+                   intern=intern is not None, lazy=lazy,
+                   incremental=incremental, asts=sorted(asts or ()))
+
     def decorator(f):
-        source = getsource(f)
-        tree = ast.parse(source)
+        function = funcname(f)
+        with stage('getsource', function):
+            source = getsource(f)
 
         env = {
             'globals': f.func_globals,
             'quotation_level': 0,
             'auto_escape': auto_escape, 'hygienic': hygiene,
+            'templates': templates, 'intern': intern, 'lazy': lazy,
+            'incremental': incremental, 'constants': {}, 'volatile': False,
+            'function': function, 'firstlineno': f.func_code.co_firstlineno,
+            'optimize': optimize,
         }
-        quotes, escapes = findquotes(tree, env)
-        exclude = quotes | escapes
-
-        bound, free = bindings(tree, exclude=exclude)[tree.body[0]]
-        env['locals'] = bound,
-
-        tree, _ = process(tree, env, quotes, escapes)
-        if debug:
-            print(string(tree))
-
-        code = astcompile(tree, env['globals']['__file__'])
-        exec code in env['globals'], env['globals']
-        return env['globals'][f.__name__]
+        filename = env['globals']['__file__']
+
+        cache = None
+        if not debug:
+            cache = diskcache(cache_dir or os.environ.get('PYSTAGING_CACHE_DIR'))
+
+        entry, table = None, {}
+        if cache is not None:
+            with stage('cache', function):
+                key = cachekey(f, source, filename, options)
+                entry = cache.load(key)
+
+        if entry is not None:
+            # Templates and the optimizer are loaded from closure cells of
+            # the code, so their names cannot clash with those of other
+            # staged functions in the same globals
+            code, names = entry['code'], entry['stagednames']
+            reserve(code)
+            for name, value in entry['constants'].iteritems():
+                reserve(name)
+                reserve(value)
+                if isinstance(value, Template) and value.table is not None:
+                    value.usetable(intern)
+                table[name] = builder(value)
+            if entry.get('optimizer') is not None:
+                table[entry['optimizer']] = optimizequote(optimize, intern)
+        else:
+            # Pause the collector for the traversals, not for user code
+            with gcpaused(pausegc):
+                with stage('parse', function) as s:
+                    tree = ast.parse(source)
+                    s.result(tree)
+                env['asts'] = quotednames(tree.body[0]) | set(asts or ())
+                names = None
+                if memoize not in (False, None) or cache is not None:
+                    names = stagednames(tree.body[0])
+
+                if auto_escape:
+                    # Quotations need the locals of the function up front
+                    with stage('bindings', function):
+                        quotes, escapes = findquotes(tree, env)
+                        bindingmap = bindings(tree, quotes | escapes)
+                        bound, free = bindingmap[tree.body[0]]
+                        env['locals'] = bound,
+
+                with stage('process', function) as s:
+                    tree, _ = process(tree, env)
+                    s.result(tree)
+            if optimize is not None:
+                with stage('optimize', function) as s:
+                    tree = optimize(tree)
+                    s.result(tree)
+            if debug:
+                print(string(tree))
+
+            # Objects spliced in at staging time are persisted in the code.
+            with stage('compile', function):
+                table = constants(tree)
+                code = compilecode(tree, filename)
+            if cache is not None and not env['volatile']:
+                optimizer = env.get('optimizer')
+                cache.store(key, code, constants=env['constants'],
+                            stagednames=names,
+                            optimizer=optimizer and optimizer.id)
+
+        with stage('exec', function):
+            runcode(code, table, env['globals'])
+        result = env['globals'][f.__name__]
+
+        if memoize not in (False, None):
+            keyed = static
+            if keyed is None and not auto_escape:
+                keyed = names
+            result = memoized(result, makecache(memoize), keyed)
+        return result
 
     if func is not None:
         return decorator(func)
@@ -77,14 +236,28 @@ def quote(tree, env=None):
     """Quote a piece of code, returning an AST"""
     if env is not None:
         # Compile time
-        env['quotation_level'] += 1
-
-        preprocess(tree, env)
-        tree, exclude = process(tree, env)
-        postprocess(tree, env, exclude=exclude)
-
-        env['quotation_level'] -= 1
-        return escape_ast(tree, exclude=exclude)
+        with sitestage('quote', env, tree) as s:
+            env['quotation_level'] += 1
+
+            preprocess(tree, env)
+            tree, replacements, bindingmap = rewritequotes(tree, env)
+            exclude = set(replacements.itervalues())
+            postprocess(tree, env, exclude=exclude, bindingmap=bindingmap)
+
+            env['quotation_level'] -= 1
+            if (env.get('templates') or env.get('lazy') or
+                    env.get('incremental') or env.get('intern') is not None):
+                with sitestage('template', env, tree) as t:
+                    result = template_ast(tree, env, exclude=exclude)
+                    t.result(result)
+            else:
+                with sitestage('escape_ast', env, tree) as t:
+                    result = escape_ast(tree, exclude=exclude)
+                    t.result(result)
+            if env.get('optimize') is not None and not env.get('lazy'):
+                result = optimize_ast(result, env)
+            s.result(result)
+        return result
     else:
         # Runtime, update AST locations
         ast.fix_missing_locations(tree)
@@ -92,23 +265,53 @@ def quote(tree, env=None):
 
 def ct_escape(tree, env, result_is_expr=True):
     """Compile-time escape operator"""
+    with sitestage('escape', env, tree) as s:
+        result = escape_site(tree, env, result_is_expr)
+        s.result(result)
+    return result
+
+def escape_site(tree, env, result_is_expr):
     result, _ = process(tree, env)
 
-    if result_is_expr:
+    if result_is_expr and env['quotation_level'] and splicesast(tree, env):
+        # Known to be an AST at staging time, splice it in directly
+        splicestats['elided'] += 1
+    elif result_is_expr:
         # Generate runtime verification call
+        splicestats['checked'] += 1
         escape_func = ast.Name('escape', ast.Load())
-        result = ast.Call(escape_func, [result], [], None, None)
+        keywords = []
+        if env.get('lazy'):
+            # Keep escaped lazy quotations lazy in the enclosing quotation
+            keywords.append(ast.keyword('lazy', ast.Name('True', ast.Load())))
+        result = ast.Call(escape_func, [result], keywords, None, None)
 
     if not env['quotation_level']:
         # Run escape code and splice in result, currently only
-        # expressions are supported
-        result = run(result, env['globals'], env['globals'])
+        # expressions are supported. The result depends on the state
+        # of the program, so the generated code cannot be persisted.
+        env['volatile'] = True
+        with gcresumed():
+            result = run(result, env['globals'], env['globals'])
         assert is_expr(result), "Can only splice expressions currently"
 
     assert isinstance(result, ast.AST), result
     return result
 
-def escape(tree, env=None, **kwds):
+def splicesast(tree, env):
+    """
+    Whether an escaped expression is known to evaluate to an AST: a
+    quotation, or a name only assigned quotations or declared in asts.
+    """
+    if isinstance(tree, ast.Name):
+        return tree.id in env.get('asts', ())
+    return isquote(tree)
+
+# The number of escapes in quotations compiled with and without a runtime
+# escape() check
+splicestats = {'checked': 0, 'elided': 0}
+
+def escape(tree, env=None, lazy=False, **kwds):
     """
     Escape operator. This evaluates in the local scope at the time it is
     encountered in a quotation statement. Additionally the escape may be
@@ -118,12 +321,19 @@ def escape(tree, env=None, **kwds):
         return ct_escape(tree, env, **kwds)
     else:
         # runtime, verify escaped result
+        if lazy and isinstance(tree, LazyQuotation):
+            return tree
+        tree = materialize(tree)
         if isinstance(tree, ast.Expression):
             tree = tree.body
-        return wrap(tree)
+        return wrap(tree, persist)
 
-def run(result, globals=None, locals=None):
-    """Run a quotation and return the result"""
+def run(result, globals=None, locals=None, optimize=None):
+    """
+    Run a quotation and return the result. If given, optimize is called
+    with the quotation and returns the tree to run, e.g. optimize.cse, or
+    True to run the default passes of pystaging.optimize.
+    """
     if globals is None:
         globals = sys._getframe(1).f_globals
     elif locals is None:
@@ -132,18 +342,187 @@ def run(result, globals=None, locals=None):
     if locals is None:
         locals = sys._getframe(1).f_locals
 
-    code = astcompile(result)
+    result = materialize(result)
+    optimize = optimizer(optimize)
+    if optimize is not None:
+        result = optimize(result)
+
+    table = constants(result)
+    scope = locals
+    if table and locals is not globals:
+        # Closure cells cannot reach separate locals, look the persisted
+        # objects up beside them instead
+        scope = ConstantLocals(locals, table)
+        code = astcompile(result)
+    else:
+        code = compilecode(result)
+    value = runcode(code, table, globals, scope)
     if is_expr(result):
-        return eval(code, globals, locals)
+        return value
+    assert is_stmt(result)
+    return globals, locals
+
+def string(expr, file=None):
+    """Stringify an ast, or write its source to a file object"""
+    if file is not None:
+        unparse(expr, file)
+    else:
+        return unparse(expr).strip()
+
+# ______________________________________________________________________
+# Optimization
+
+def optimizer(optimize):
+    """Resolve an optimize option to a function or None"""
+    if optimize is True:
+        from .optimize import optimize
+    elif optimize is False:
+        optimize = None
+    return optimize
+
+def optimizer_key(optimize):
+    """
+    Stable description of an optimizer for persistent cache keys. Functions
+    are described by their code, defaults and closure, so that lambdas and
+    redefined functions get keys of their own, and callable instances by
+    their class and attributes.
+    """
+    if isinstance(optimize, functools.partial):
+        keywords = optimize.keywords or {}
+        return (optimizer_key(optimize.func),
+                optimizer_key(optimize.args),
+                optimizer_key(sorted(keywords.iteritems())))
+    elif isinstance(optimize, (list, tuple)):
+        return tuple(map(optimizer_key, optimize))
+    elif isinstance(optimize, types.FunctionType):
+        cells = [cell.cell_contents for cell in optimize.func_closure or ()]
+        code = hashlib.sha1(marshal.dumps(optimize.func_code)).hexdigest()
+        return ('%s.%s' % (optimize.__module__, optimize.__name__), code,
+                optimizer_key(optimize.func_defaults or ()),
+                optimizer_key(cells))
+    elif isinstance(optimize, types.MethodType):
+        return optimizer_key(optimize.im_func), optimizer_key(optimize.im_self)
+    elif isinstance(optimize, types.BuiltinFunctionType):
+        return '%s.%s' % (optimize.__module__, optimize.__name__)
+    elif callable(optimize) and not isinstance(optimize, type):
+        cls = type(optimize)
+        state = sorted(getattr(optimize, '__dict__', {}).iteritems())
+        return '%s.%s' % (cls.__module__, cls.__name__), optimizer_key(state)
+    elif callable(optimize):
+        return '%s.%s' % (optimize.__module__, optimize.__name__)
+    return repr(optimize)
+
+def optimizequote(optimize, table=None):
+    """
+    Wrap an optimizer for the quotations built by staged code. Quoted
+    statement lists stay wrapped by suite(), and with an InternTable the
+    optimized quotation is interned again.
+    """
+    def optimizer(tree):
+        if issuite(tree):
+            result = optimize(ast.Module(tree.body))
+            body = result.body if isinstance(result, ast.Module) else [result]
+            result = ast.copy_location(suite(body or [ast.Pass()]), tree)
+        else:
+            result = optimize(tree)
+        if table is not None:
+            result = table.intern(result)
+        return result
+    return optimizer
+
+# ______________________________________________________________________
+# Specialization cache
+
+def makecache(memoize):
+    """Create a specialization cache for staging(memoize=...)"""
+    if isinstance(memoize, BoundedCache):
+        return memoize
+    elif memoize is True:
+        return LRUCache()
     else:
-        assert is_stmt(result)
-        exec code in globals, locals
-        return globals, locals
+        return LRUCache(memoize)
+
+class Unkeyable(Exception):
+    """An argument that memoized() cannot key the cache on"""
 
-def string(expr):
-    """Stringify an ast"""
-    import meta
-    return meta.dump_python_source(expr).strip()
+def argkey(value, refs):
+    """
+    Cache key for an argument of a memoized staging function. ASTs are keyed
+    by structure, lists, tuples, dicts and sets by their items, other values
+    by type and value, or else by identity. For identity keys a weak
+    reference to the value is appended to refs, the entry is dropped when
+    the value dies. Raises Unkeyable for values without weak references.
+    """
+    if isinstance(value, ast.AST):
+        return structkey(value)
+    elif isinstance(value, (list, tuple)):
+        return (type(value),) + tuple(argkey(item, refs) for item in value)
+    elif isinstance(value, dict):
+        return (dict,) + tuple(sorted((argkey(k, refs), argkey(v, refs))
+                                      for k, v in value.iteritems()))
+    elif isinstance(value, (set, frozenset)):
+        return (type(value),) + tuple(sorted(argkey(item, refs)
+                                             for item in value))
+    elif hashable(value):
+        return type(value), value
+    try:
+        refs.append(weakref.ref(value))
+    except TypeError:
+        raise Unkeyable(value)
+    return 'id', id(value)
+
+def memoized(func, cache, keyed=None):
+    """
+    Memoize a staging function on the arguments named in keyed (all
+    arguments if None). Cache entries do not keep their arguments alive:
+    entries keyed on the identity of an argument are dropped when it dies,
+    and calls with arguments that cannot be keyed are not cached.
+
+    Every call returns a fresh copy of the cached AST, so callers may
+    modify their result.
+    """
+    spec = inspect.getargspec(func)
+    defaults = dict(zip(spec.args[len(spec.args) - len(spec.defaults or ()):],
+                        spec.defaults or ()))
+    keyed = set(keyed if keyed is not None else spec.args +
+                                                [spec.varargs, spec.keywords])
+    argnames = [name for name in spec.args if name in keyed]
+    varargs, keywords = spec.varargs in keyed, spec.keywords in keyed
+    nargs = len(spec.args)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = dict(zip(spec.args, args))
+        bound.update(kwargs)
+        refs = []
+        try:
+            key = tuple(argkey(bound.get(name, defaults.get(name, wrapper)),
+                               refs)
+                            for name in argnames)
+            if varargs:
+                key += tuple(argkey(arg, refs) for arg in args[nargs:])
+            if keywords:
+                key += tuple(sorted((name, argkey(value, refs))
+                                        for name, value in kwargs.iteritems()
+                                            if name not in spec.args))
+        except Unkeyable:
+            return func(*args, **kwargs)
+
+        entry = cache.get(key)
+        if entry is None:
+            # Drop the entry when an argument keyed by identity dies
+            drop = lambda ref, key=key: cache.pop(key)
+            refs = [weakref.ref(ref(), drop) for ref in refs]
+            entry = (refs, func(*args, **kwargs))
+            cache[key] = entry
+        result = entry[-1]
+        if isinstance(result, (ast.AST, list)):
+            return copytree(result)
+        return result
+
+    wrapper.cache = cache
+    wrapper.__wrapped__ = func
+    return wrapper
 
 # ______________________________________________________________________
 # Rewriting utilities
@@ -151,37 +530,223 @@ def string(expr):
 # compile() does not accept ast.Suite()
 suite = lambda body: ast.If(ast.Num(1), body, [])
 
+def issuite(tree):
+    """Whether tree is a statement list wrapped by suite()"""
+    return (isinstance(tree, ast.If) and isinstance(tree.test, ast.Num) and
+            tree.test.n == 1 and not tree.orelse)
+
 def preprocess(tree, env):
     """Pre-process a quoted tree"""
     if env['auto_escape']:
         bindingmap = bindings(tree, env)
         bindfree(tree, env, bindingmap)
 
-def process(tree, env, quotes=None, escapes=None):
+def process(tree, env):
     """
     Rewrite quotes in an AST. Returns a transformed AST and a set of new nodes.
     """
-    replacements = {}
+    tree, replacements, _ = rewritequotes(tree, env)
+    return tree, set(replacements.itervalues())
+
+def rewritequotes(tree, env):
+    """
+    Rewrite quotes and escapes in a single pass over tree, returning the
+    transformed AST, the replacement map and the bindings outside of the
+    replaced nodes.
+    """
     globals = env['globals']
-    if quotes is None:
-        quotes, escapes = findquotes(tree, env)
 
-    # Process quotes and escaped and build replacement map
-    for node in quotes | escapes:
+    def stage(node):
         if isinstance(node, ast.Subscript):
-            replacements[node] = globals[node.value.id](node.slice.value, env)
-        else:
-            metasuite = globals['quote'](suite(node.body), env)
-            replacements[node] = ast.Assign(
-                [ast.Name(node.optional_vars.id, ast.Store())], metasuite)
+            return globals[node.value.id](node.slice.value, env)
+        metasuite = globals['quote'](suite(node.body), env)
+        return ast.Assign([ast.Name(node.optional_vars.id, ast.Store())],
+                          metasuite)
 
-    tree = replace(tree, replacements)
-    return tree, set(replacements.itervalues())
+    return rewrite(tree, stage)
 
-def postprocess(tree, env, exclude=None):
-    """Post-process a quoted tree"""
+def template_ast(tree, env, exclude=frozenset()):
+    """
+    Capture a quoted tree as a template and return a call that instantiates
+    it with a tuple of the excluded subtrees as hole values.
+    """
+    template = Template(tree, exclude, table=env.get('intern'),
+                        lazy=env.get('lazy', False),
+                        incremental=env.get('incremental', False))
+    name = temp('template')
+    env['constants'][name] = template
+    func = Persisted(name, builder(template))
+    holes = ast.Tuple(template.holes, ast.Load())
+    return ast.Call(func, [holes], [], None, None)
+
+def optimize_ast(result, env):
+    """
+    Wrap the code building a quotation in a call to the optimizer of the
+    staging function, which optimizes the quotation once its escapes are
+    spliced in
+    """
+    node = env.get('optimizer')
+    if node is None:
+        # Rebound by the staging decorator when loading persisted code
+        node = env['optimizer'] = Persisted(
+            temp('optimize'), optimizequote(env['optimize'], env.get('intern')))
+    func = Persisted(node.id, node.value)
+    return ast.Call(func, [result], [], None, None)
+
+def builder(value):
+    """The object generated code calls for a staging time constant"""
+    if isinstance(value, Template):
+        return value.deferred if value.lazy else value.build
+    return value
+
+def bindconst(globals, name, value):
+    """Bind a staging time constant in the globals of generated code"""
+    globals[name] = builder(value)
+
+def persist(obj):
+    """
+    Persist an object in generated code, returning a name that references
+    it. The object is not copied into the AST. The name is derived from
+    the identity of the object, so code persisting the same objects is
+    structurally identical.
+    """
+    scope = getattr(scopes, 'current', None)
+    namespace = prefix if scope is None else scope[1]
+    return Persisted('%sconst_%x' % (namespace, id(obj)), obj)
+
+def constants(tree):
+    """The constant table of generated code: {name: persisted object}"""
+    table = {}
+    stack = list(tree) if isinstance(tree, list) else [tree]
+    pop, push, extend = stack.pop, stack.append, stack.extend
+    while stack:
+        node = pop()
+        if isinstance(node, Persisted):
+            table[node.id] = node.value
+        elif isinstance(node, ast.AST):
+            attrs = node.__dict__
+            for field in node._fields:
+                value = attrs.get(field)
+                if isinstance(value, list):
+                    extend(value)
+                elif isinstance(value, ast.AST):
+                    push(value)
+    return table
+
+def compilecode(tree, filename="<staged>", cache=False, result=None):
+    """
+    Compile a quotation for runcode(). Persisted objects are bound per
+    code object, not in the globals the code runs in: code that persists
+    objects is compiled as a function without parameters, nested in one
+    taking the objects, that loads them from closure cells. The function
+    returns the value of an expression, and runs statements with the
+    names they bind declared global. If result names a definition among
+    the statements, the function returns it instead of binding it.
+    With cache=True the code is kept in the compile cache, keyed by the
+    identity of tree (see astutils.CompileCache).
+    """
+    tree = original = materialize(tree)
+    if not constants(tree) and result is None:
+        return astcompile(tree, filename, cache=cache)
+
+    if is_expr(tree):
+        if isinstance(tree, ast.Expression):
+            tree = tree.body
+        body = [ast.Return(tree)]
+    else:
+        if isinstance(tree, (ast.Module, ast.Interactive, ast.Suite)):
+            tree = tree.body
+        body = list(tree) if isinstance(tree, list) else [tree]
+        names = sorted(boundnames(body) - set([result]))
+        if names:
+            body.insert(0, ast.Global(names))
+        if result is not None:
+            body.append(ast.Return(ast.Name(result, ast.Load())))
+
+    noargs = ast.arguments([], None, None, [])
+    params = ast.arguments([ast.Name(name, ast.Param())
+                                for name in sorted(constants(tree))],
+                           None, None, [])
+    func = ast.FunctionDef('<staged>', noargs, body, [])
+    scope = ast.FunctionDef('<closure>', params, [func], [])
+    code = astcompile(ast.Module([scope]), filename,
+                      cache=cache and result is None, key=original)
+    for name in '<closure>', '<staged>':
+        code, = [const for const in code.co_consts
+                       if isinstance(const, types.CodeType) and
+                          const.co_name == name]
+    return code
+
+def runcode(code, table, globals, locals=None):
+    """
+    Run code from compilecode() in globals, with the persisted objects of
+    the constant table of its quotation, and return the value of an
+    expression or of the result definition (None for other statements).
+    locals apply to code without persisted objects.
+    """
+    if code.co_flags & inspect.CO_OPTIMIZED:
+        # As exec does, give the globals builtins
+        globals.setdefault('__builtins__', __builtin__)
+        cells = tuple(makecell(table[name]) for name in code.co_freevars)
+        return types.FunctionType(code, globals, code.co_name, None, cells)()
+    return eval(code, globals, globals if locals is None else locals)
+
+def makecell(value):
+    """A closure cell holding value"""
+    return (lambda: value).func_closure[0]
+
+class ConstantLocals(UserDict.DictMixin):
+    """
+    The locals of code run with locals separate from its globals: the
+    given locals, falling back to the persisted objects of the code. As
+    with other locals, functions defined by the code do not see them.
+    """
+
+    def __init__(self, locals, table):
+        self.locals = locals
+        self.table = table
+
+    def __getitem__(self, name):
+        try:
+            return self.locals[name]
+        except KeyError:
+            return self.table[name]
+
+    def __setitem__(self, name, value):
+        self.locals[name] = value
+
+    def __delitem__(self, name):
+        del self.locals[name]
+
+    def keys(self):
+        return self.locals.keys()
+
+def reserve(obj):
+    """Reserve the temporary names used by persisted code or constants"""
+    if isinstance(obj, types.CodeType):
+        for name in (obj.co_names + obj.co_varnames +
+                     obj.co_cellvars + obj.co_freevars):
+            reserve(name)
+        for const in obj.co_consts:
+            reserve(const)
+    elif isinstance(obj, Template):
+        for node in ast.walk(obj.prototype):
+            if isinstance(node, ast.Name):
+                reserve(node.id)
+    elif isinstance(obj, basestring) and obj.startswith(prefix):
+        # Reserve scope namespaces too, e.g. staged.temp.scope1
+        parts = obj[len(prefix):].split('.')
+        for i in range(1, len(parts) + 1):
+            temper.reserve(prefix + '.'.join(parts[:i]))
+
+def postprocess(tree, env, exclude=None, bindingmap=None):
+    """
+    Post-process a quoted tree. bindingmap may pass the bindings of the
+    tree if they are known, e.g. as computed by rewritequotes().
+    """
     if env['hygienic']:
-        bindingmap = bindings(tree, exclude)
+        if bindingmap is None:
+            bindingmap = bindings(tree, exclude)
         refreshbound(tree, env, bindingmap)
 
 # ______________________________________________________________________
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled quotation templates.
+
+A quoted tree is captured once as a frozen prototype in which every
+escape site is replaced by a numbered Hole. The prototype is compiled
+into a builder function that takes a tuple of the hole values (any number
+of them, unlike positional arguments) and performs a straight-line
+structural copy of the prototype:
+
+    quote[a + escape[b]]    ->  BinOp(Name('a', load), add, values[0])
+
+Field-less nodes (expression contexts and operators) are shared between
+instantiations, everything else is freshly allocated. Templates with an
+InternTable instead build interned nodes: subtrees without holes are
+interned once when the template is compiled, and the nodes enclosing holes
+are looked up in the table before allocating them.
+
+Lazy templates defer instantiation: they return a LazyQuotation of the
+template and the hole values, which builds the AST only when it is
+compiled, unparsed or inspected. Lazy quotations hash and compare by the
+structure they would build, so that candidates can be deduplicated or
+looked up without building them.
+
+Incremental templates instantiate statement lists one statement at a time,
+and return the statement built by the previous instantiation if the values
+of the holes in it are structurally unchanged. Code that changes a single
+escaped input then only rebuilds (and, with an IncrementalCompiler, only
+recompiles) the statements that depend on it.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging.utils import hashedtuple
+from pystaging.astutils import astcompile, structkey, copynode
+from pystaging.visitors import replace
+from pystaging import interning
+
+# ______________________________________________________________________
+
+class Hole(ast.AST):
+    """Numbered hole in a template prototype"""
+    _fields = ('n',)
+
+def shareable(node):
+    """Whether an AST node carries no state and can be shared"""
+    return not node._fields and not getattr(node, '_attributes', ())
+
+def findholes(tree, exclude):
+    """Find the excluded subtrees in tree in a deterministic order"""
+    holes = []
+    stack = [tree]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, list):
+            stack.extend(reversed(obj))
+        elif isinstance(obj, ast.AST):
+            if obj in exclude:
+                holes.append(obj)
+            else:
+                stack.extend(reversed([getattr(obj, field, None)
+                                       for field in obj._fields]))
+    return holes
+
+def holenumbers(tree):
+    """The numbers of the holes in tree, in order"""
+    return sorted(node.n for node in ast.walk(tree) if isinstance(node, Hole))
+
+def findenclosing(obj, enclosing):
+    """Add the nodes in obj that have a Hole in their subtree to enclosing"""
+    if isinstance(obj, Hole):
+        return True
+    elif isinstance(obj, ast.AST):
+        children = [findenclosing(getattr(obj, field, None), enclosing)
+                    for field in obj._fields]
+        if any(children):
+            enclosing.add(obj)
+            return True
+    elif isinstance(obj, (list, tuple)):
+        return any([findenclosing(item, enclosing) for item in obj])
+    return False
+
+class Template(object):
+    """
+    A quoted AST with numbered holes for its escape sites.
+
+        holes:       the hole expressions, in hole number order
+        prototype:   the quoted AST with Hole nodes at the escape sites
+        build:       builder function taking a tuple of the hole values
+        table:       InternTable to build interned nodes in, or None
+        lazy:        whether staged code calls deferred() rather than
+                     build()
+        incremental: whether build() reuses the statements of the
+                     previous instantiation whose holes did not change
+                     (see compileparts)
+    """
+
+    def __init__(self, tree, exclude=frozenset(), table=None, lazy=False,
+                 incremental=False):
+        self.holes = findholes(tree, exclude)
+        self.prototype = replace(tree, dict(
+            (node, Hole(n)) for n, node in enumerate(self.holes)))
+        self.table = table
+        self.lazy = lazy
+        self.incremental = incremental
+        self.build = self.builder()
+        self._key = None
+
+    def __call__(self, *args):
+        return self.build(args)
+
+    def instantiate(self, *args):
+        """Instantiate the template with a value for each hole"""
+        return self.build(args)
+
+    def defer(self, *args):
+        """Return a LazyQuotation that instantiates the template with args"""
+        return LazyQuotation(self, args)
+
+    def deferred(self, values):
+        """defer() taking a tuple of the hole values, as build() does"""
+        return LazyQuotation(self, values)
+
+    @property
+    def key(self):
+        """The structural key of the prototype"""
+        if self._key is None:
+            self._key = hashedtuple(structkey(self.prototype))
+        return self._key
+
+    # Templates are pickled as their prototype, the hole expressions are
+    # only needed at staging time. A custom InternTable is pickled empty
+    # (see InternTable.__getstate__), the default one by reference.
+
+    def __getstate__(self):
+        table = self.table
+        if table is interning.table:
+            table = 'default'
+        return {'prototype': self.prototype, 'table': table,
+                'lazy': self.lazy, 'incremental': self.incremental}
+
+    def __setstate__(self, state):
+        self.prototype = state['prototype']
+        self.holes = None
+        self.table = state.get('table')
+        if self.table == 'default':
+            self.table = interning.table
+        self.lazy = state.get('lazy', False)
+        self.incremental = state.get('incremental', False)
+        self.build = self.builder()
+        self._key = None
+
+    def usetable(self, table):
+        """
+        Build interned nodes in table, e.g. the table of the staging function
+        that loaded the template from its disk cache
+        """
+        if table is not self.table:
+            self.table = table
+            self.build = self.builder()
+
+    def builder(self):
+        """The builder function, taking a tuple of the hole values"""
+        if self.incremental:
+            build = self.compileparts()
+            if build is not None:
+                return build
+        return self.compile()
+
+    def compileparts(self):
+        """
+        Compile an incremental builder for the statement list in the body
+        of the prototype, or return None if there is no such list or there
+        are holes outside it.
+
+        The builder returns a fresh root node, but its statements whose hole
+        values did not change are the nodes returned by the previous call,
+        shared with every caller that received them. They are read-only:
+        callers must not modify them in place, but rewrite them copy on
+        write or copy them first (astutils.copytree).
+        """
+        root = self.prototype
+        body = getattr(root, 'body', None)
+        if not isinstance(body, list) or not body:
+            return None
+        parts = [(self.compile(stmt), holenumbers(stmt)) for stmt in body]
+        if sum(len(numbers) for build, numbers in parts) != len(
+                holenumbers(root)):
+            return None
+        built = [None] * len(parts) # (hole keys, statement) per statement
+
+        def instantiate(values):
+            stmts = []
+            for i, (build, numbers) in enumerate(parts):
+                keys = [lazykey(values[n]) for n in numbers]
+                last = built[i]
+                if last is None or last[0] != keys:
+                    last = built[i] = (keys, build(values))
+                stmts.append(last[1])
+            return copynode(root, body=stmts)
+
+        return instantiate
+
+    def compile(self, tree=None):
+        """
+        Compile the prototype, or a subtree of it, into a builder taking
+        the tuple of all hole values
+        """
+        if tree is None:
+            tree = self.prototype
+        consts = {} # id(obj) -> (name, obj)
+        table = self.table
+        enclosing = set() # nodes with holes in their subtree
+        if table is not None:
+            findenclosing(tree, enclosing)
+
+        def const(obj):
+            if id(obj) not in consts:
+                consts[id(obj)] = ('const%d' % len(consts), obj)
+            return ast.Name(consts[id(obj)][0], ast.Load())
+
+        def emit(obj):
+            if isinstance(obj, Hole):
+                hole = ast.Subscript(ast.Name('values', ast.Load()),
+                                     ast.Index(ast.Num(obj.n)), ast.Load())
+                if table is not None:
+                    return ast.Call(const(table.intern), [hole], [],
+                                    None, None)
+                return hole
+            elif (isinstance(obj, ast.AST) and table is not None and
+                      obj not in enclosing):
+                return const(table.intern(obj))
+            elif isinstance(obj, ast.AST) and table is not None:
+                args = [emit(getattr(obj, field)) for field in obj._fields]
+                return ast.Call(const(table.node), [const(type(obj))] + args,
+                                [], None, None)
+            elif isinstance(obj, ast.AST) and not shareable(obj):
+                args = [emit(getattr(obj, field)) for field in obj._fields]
+                return ast.Call(const(type(obj)), args, [], None, None)
+            elif isinstance(obj, list):
+                return ast.List(map(emit, obj), ast.Load())
+            elif isinstance(obj, tuple):
+                return ast.Tuple(map(emit, obj), ast.Load())
+            else:
+                return const(obj)
+
+        body = emit(tree)
+        names = ['values']
+        names.extend(name for name, obj in consts.itervalues())
+        args = ast.arguments([ast.Name(name, ast.Param()) for name in names],
+                             None, None,
+                             [ast.Name(name, ast.Load())
+                                  for name, obj in consts.itervalues()])
+        code = astcompile(ast.Expression(ast.Lambda(args, body)),
+                          "<template>")
+        return eval(code, dict(consts.itervalues()))
+
+# ______________________________________________________________________
+
+class LazyQuotation(object):
+    """
+    A quotation that is not built yet: a template and its hole values,
+    which may be lazy quotations themselves. The AST is built on first use
+    (materialize(), or any attribute of the tree) and kept.
+
+    Lazy quotations are equal if the trees they build are structurally
+    equal, as far as their templates and hole values tell. Hashing and
+    comparing them does not build the tree.
+    """
+
+    __slots__ = ('template', 'values', 'tree', '_key', '_hash')
+
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+        self.tree = None
+        self._key = self._hash = None
+
+    def materialize(self):
+        """Build and return the AST"""
+        if self.tree is None:
+            values = [value.materialize()
+                          if isinstance(value, LazyQuotation) else value
+                      for value in self.values]
+            self.tree = self.template.build(tuple(values))
+        return self.tree
+
+    @property
+    def key(self):
+        """Structural key of the quotation, without building it"""
+        if self._key is None:
+            self._key = (self.template.key,) + tuple(map(lazykey,
+                                                         self.values))
+        return self._key
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.key)
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, LazyQuotation):
+            return NotImplemented
+        return self is other or self.key == other.key
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __repr__(self):
+        state = "built" if self.tree is not None else "unbuilt"
+        return "<LazyQuotation %s, %d holes>" % (state, len(self.values))
+
+def lazykey(value):
+    """Structural key of a hole value"""
+    if isinstance(value, LazyQuotation):
+        return value.key
+    return structkey(value)
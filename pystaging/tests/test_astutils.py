@@ -0,0 +1,132 @@
+import ast
+import threading
+import unittest
+from StringIO import StringIO
+from pystaging.astutils import (astcompile, structkey, CompileCache,
+                                compile_cache, unparse)
+
+parse = lambda source: ast.parse(source, mode='eval')
+
+class TestCompileCache(unittest.TestCase):
+
+    def setUp(self):
+        compile_cache.clear()
+
+    def test_structkey(self):
+        self.assertEqual(structkey(parse("a + 1")), structkey(parse("a  +  1")))
+        self.assertNotEqual(structkey(parse("a + 1")), structkey(parse("a + 1.0")))
+        self.assertNotEqual(structkey(parse("a + 1")), structkey(parse("a - 1")))
+        self.assertNotEqual(structkey(parse("0.0")), structkey(parse("-0.0")))
+
+    def test_cache_hit(self):
+        tree = parse("a * 2")
+        code1 = astcompile(tree, cache=True)
+        code2 = astcompile(tree, cache=True)
+        self.assertIs(code1, code2)
+        self.assertEqual(eval(code2, {'a': 4}), 8)
+        stats = compile_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_cache_identity(self):
+        code1 = astcompile(parse("a * 2"), cache=True)
+        code2 = astcompile(parse("a * 2"), cache=True)
+        self.assertIsNot(code1, code2)
+        self.assertEqual(compile_cache.stats()['misses'], 2)
+
+    def test_cache_disabled(self):
+        tree = parse("a * 2")
+        code1 = astcompile(tree)
+        code2 = astcompile(tree)
+        self.assertIsNot(code1, code2)
+        self.assertEqual(len(compile_cache.cache), 0)
+
+    def test_cache_eviction(self):
+        cache = CompileCache(maxsize=2)
+        trees = dict((source, parse(source)) for source in "123")
+        for source in "1231":
+            cache.compile(trees[source], "<string>", "eval", 0)
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['misses'], 4)
+
+    def test_cache_threads(self):
+        cache = CompileCache(maxsize=8)
+        errors = []
+        trees = [parse("a + %d" % i) for i in range(16)]
+        def compile_many(offset):
+            try:
+                for i in range(500):
+                    tree = trees[(i + offset) % 16]
+                    code = cache.compile(tree, "<string>", "eval", 0)
+                    if eval(code, {'a': 0}) != (i + offset) % 16:
+                        errors.append(i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=compile_many, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 8 * 500)
+        self.assertLessEqual(stats['size'], 8)
+
+
+roundtrip_source = """
+from __future__ import division
+import os.path as path, sys
+from .. import x as y
+
+@decorator(1)
+class C(Base, object):
+    def f(self, (a, b), c=1, *args, **kwargs):
+        global g
+        print >>sys.stderr, a, b,
+        del a[1:2, ...], b[::2]
+        x = y = lambda z=1: (z if z else -1)
+        x **= 2 ** -(1) + ~x
+        yield
+        return [i for i in range(10) if i % 2 if i] or {k: v for k, v in d}
+    def g(self):
+        try:
+            exec "code" in {}, {}
+        except (ValueError, TypeError) as e:
+            raise e, None, None
+        except:
+            pass
+        else:
+            assert not a is not b < c in d, "msg"
+        finally:
+            while 1:
+                break
+            else:
+                continue
+        with f() as (a, b):
+            for x, in (1,), {1, 2}, {x for x in ()}, `x`, 1 .real, -1.5j:
+                if a: pass
+                elif b: f(*a, **b)
+                else: return (x for x in y), 1e400, -1e400, 'str', u'uni'
+"""
+
+class TestUnparse(unittest.TestCase):
+
+    def test_roundtrip(self):
+        tree = ast.parse(roundtrip_source)
+        self.assertEqual(ast.dump(ast.parse(unparse(tree))), ast.dump(tree))
+
+    def test_expression(self):
+        self.assertEqual(unparse(parse("a + b * 10")), "(a + (b * 10))")
+        self.assertEqual(unparse(parse("(1,)").body), "(1,)")
+
+    def test_deep(self):
+        tree = ast.Name('x', ast.Load())
+        for i in range(50000):
+            tree = ast.UnaryOp(ast.Not(), tree)
+        self.assertTrue(unparse(tree).endswith("x" + ")" * 50000))
+
+    def test_file(self):
+        f = StringIO()
+        unparse(ast.parse("def f(x):\n    return x\n"), f)
+        self.assertEqual(f.getvalue(), "def f(x):\n    return x\n")
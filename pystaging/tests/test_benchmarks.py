@@ -0,0 +1,46 @@
+import unittest
+from pystaging.benchmarks import benchmark, benchmarks
+from StringIO import StringIO
+from pystaging.benchmarks.runner import (compare, measure, reportcomparison,
+                                        load)
+
+@benchmark('test.noop', number=10, repeat=1)
+def bench_noop():
+    return lambda: None
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_measure(self):
+        result = measure('test.noop')
+        self.assertGreater(result['seconds'], 0)
+        self.assertGreater(result['peak_kb'], 0)
+
+    def test_compare(self):
+        previous = {'a': {'seconds': 1.0, 'peak_kb': 100},
+                    'b': {'seconds': 1.0, 'peak_kb': 100},
+                    'c': {'seconds': 1.0, 'peak_kb': 100}}
+        results = {'a': {'seconds': 1.05, 'peak_kb': 100},
+                   'b': {'seconds': 2.0, 'peak_kb': 100},
+                   'c': {'seconds': 1.0, 'peak_kb': 150},
+                   'd': {'seconds': 9.0, 'peak_kb': 900}}
+        self.assertEqual(compare(results, previous, threshold=0.1),
+                         ['b', 'c'])
+
+        out = StringIO()
+        reportcomparison(results, previous, threshold=0.1, file=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['a', 'b', 'c'])
+        self.assertEqual(['REGRESSION' in line for line in lines],
+                         [False, True, True])
+
+    def test_registered(self):
+        load()
+        for prefix in ('batch', 'interning', 'parallel', 'scaling',
+                       'templates', 'unparse'):
+            self.assertTrue(any(name.startswith(prefix + '.')
+                                for name in benchmarks), prefix)
+
+
+if __name__ == '__main__':
+    unittest.main()
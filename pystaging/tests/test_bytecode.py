@@ -0,0 +1,105 @@
+import ast
+import __future__
+import unittest
+from pystaging import *
+from pystaging import bytecode
+from pystaging.bytecode import bytecompile, Unsupported
+
+@staging
+def make_kernel(scale, offset):
+    with quote as body:
+        def kernel(A, B, out, n):
+            total = 0
+            for i in range(n):
+                if A[i] < 0:
+                    continue
+                out[i] = A[i] * escape[scale] + B[i] - escape[offset]
+                out[i] += 1
+                total = total + (out[i] if i % 2 else -out[i])
+                a, b = divmod(i, 3)
+                if total > 50 and a:
+                    break
+            return total, a, b, {'n': n}
+    return body
+
+source = '''
+def f(x, y=2, *args, **kwargs):
+    "doc"
+    x.attr += y / 2
+    table = {'a': 1, 'b': 2}
+    del table['a'], y
+    return [x.attr, ~x.attr, not args, args or None, sorted(kwargs), table]
+
+def box():
+    pass
+
+box.attr = 3
+result = f(box, 5, 1, key=1)
+'''
+
+
+class TestBytecode(unittest.TestCase):
+
+    def assertSame(self, tree, flags=0):
+        """Assemble tree and check that it runs like compile() output"""
+        expected, namespace = {}, {}
+        exec compile(tree, '<test>', 'exec', flags) in expected
+        exec bytecode.assemble(tree, '<test>', flags) in namespace
+        self.assertEqual(namespace['result'], expected['result'])
+        return namespace
+
+    def test_kernel(self):
+        results = []
+        assembled = bytecode.stats['assembled']
+        for backend in CompilationUnit.backends:
+            unit = CompilationUnit(backend=backend)
+            unit.add(make_kernel(ast.Num(2), ast.Num(1)))
+            kernel, = unit.run({})
+            out = [0] * 5
+            total = kernel([1, -1, 3, 40, 50], [1, 2, 3, 4, 5], out, 5)
+            results.append((total, out))
+        self.assertEqual(bytecode.stats['assembled'], assembled + 1)
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[0],
+                         ((72, 1, 0, {'n': 5}), [3, 0, 9, 84, 0]))
+
+    def test_statements(self):
+        namespace = self.assertSame(ast.parse(source))
+        self.assertEqual(namespace['f'].__doc__, "doc")
+        self.assertEqual(namespace['f'].func_defaults, (2,))
+
+    def test_division(self):
+        tree = ast.parse("result = [7 / 2, 7 // 2]")
+        self.assertSame(tree)
+        self.assertSame(tree, flags=__future__.division.compiler_flag)
+
+    def test_expression(self):
+        tree = ast.parse("x * 2 if x else -1", mode='eval')
+        self.assertEqual(eval(bytecode.assemble(tree), {'x': 3}), 6)
+
+    def test_large(self):
+        # Jumps across more than 64K of code take an EXTENDED_ARG
+        lines = ["def f(A, n):", "    t = 0", "    for i in range(n):"]
+        lines += ["        t = t + A[%d] * %d" % (k % 10, k)
+                  for k in range(10000)]
+        lines += ["    return t", "result = f(range(10), 3)"]
+        tree = ast.parse("\n".join(lines))
+        namespace = self.assertSame(tree)
+        self.assertGreater(len(namespace['f'].func_code.co_code), 0xffff)
+
+    def test_fallback(self):
+        tree = ast.parse("result = [x for x in range(3)]")
+        self.assertRaises(Unsupported, bytecompile, tree, fallback=False)
+        fallbacks = bytecode.stats['fallbacks']
+        namespace = {}
+        exec bytecompile(tree) in namespace
+        self.assertEqual(namespace['result'], [0, 1, 2])
+        self.assertEqual(bytecode.stats['fallbacks'], fallbacks + 1)
+
+    def test_closures(self):
+        tree = ast.parse("def f(x):\n    def g():\n        return x\n")
+        self.assertRaises(Unsupported, bytecompile, tree, fallback=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
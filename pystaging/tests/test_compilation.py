@@ -0,0 +1,186 @@
+import ast
+import unittest
+from pystaging import *
+
+@staging
+def make_kernel(c):
+    with quote as body:
+        def kernel(x):
+            return x * escape[c]
+    return body
+
+@staging
+def make_value(c):
+    return quote[offset + escape[c]]
+
+@staging(incremental=True)
+def make_module(scale, offset):
+    with quote as body:
+        def scaled(x):
+            return x * escape[scale]
+        def shifted(x):
+            return x + escape[offset]
+    return body
+
+@staging
+def unrolled(n, limit):
+    with quote as init:
+        total = 0
+    yield init
+    for i in range(n):
+        with quote as body:
+            out[escape[i]] = A[escape[i]] * 2
+            total = total + out[escape[i]]
+            if escape[i] == 3:
+                last = escape[i]
+        yield body
+        yield check(limit)
+    yield finish()
+
+@staging
+def check(limit):
+    with quote as body:
+        if total > escape[limit]:
+            return total, 'early'
+    return body
+
+@staging
+def finish():
+    with quote as body:
+        return total, last
+    return body
+
+
+class TestCompilationUnit(unittest.TestCase):
+
+    def test_batch(self):
+        unit = CompilationUnit()
+        names = [unit.add(make_kernel(ast.Num(n))) for n in range(3)]
+        names.append(unit.add(make_value(ast.Num(10))))
+        unit.add(ast.parse("bias = 5"))
+        self.assertEqual(len(unit), 5)
+        self.assertEqual(names[0], 'kernel')
+        self.assertEqual(len(set(names)), 4)
+
+        namespace = {'offset': 1}
+        k0, k1, k2, value, stmt = unit.run(namespace)
+        self.assertEqual([k(3) for k in (k0, k1, k2)], [0, 3, 6])
+        self.assertEqual(value, 11)
+        self.assertIsNone(stmt)
+        self.assertEqual(namespace['bias'], 5)
+
+    def test_name(self):
+        unit = CompilationUnit()
+        self.assertEqual(unit.add(make_value(ast.Num(2)), name='two'), 'two')
+        self.assertEqual(unit.run({'offset': 0}), [2])
+
+    def test_recursive_rename(self):
+        unit = CompilationUnit()
+        for n in (1, 2):
+            unit.add(ast.parse("def fact(n):\n"
+                               "    return %d if n <= 1 else n * fact(n - 1)"
+                               % n))
+        first, second = unit.run({})
+        self.assertEqual((first(4), second(4)), (24, 48))
+
+    def test_suite_rename(self):
+        unit = CompilationUnit()
+        unit.add(ast.parse("def helper(x):\n    return x + 1"))
+        unit.add(ast.parse("def helper(x):\n    return x * 10\n"
+                           "def apply(x, helper=helper):\n"
+                           "    return helper(x)\n"
+                           "result = helper(2)"))
+        namespace = {}
+        helper, stmts = unit.run(namespace)
+        self.assertEqual(helper(2), 3)
+        self.assertEqual(namespace['result'], 20)
+        self.assertEqual(namespace['apply'](3), 30)
+        self.assertIn('result', unit.bound)
+
+    def test_bytecode_backend(self):
+        unit = CompilationUnit(backend='bytecode')
+        for n in range(3):
+            unit.add(make_kernel(ast.Num(n)))
+        unit.add(make_value(ast.Num(10)))
+        kernels = unit.run({'offset': 1})
+        self.assertEqual([k(3) for k in kernels[:3]], [0, 3, 6])
+        self.assertEqual(kernels[3], 11)
+        self.assertRaises(ValueError, CompilationUnit, backend='llvm')
+
+
+class TestIncremental(unittest.TestCase):
+
+    def test_reuse(self):
+        first = make_module(ast.Num(2), ast.Num(1))
+        second = make_module(ast.Num(3), ast.Num(1))
+        self.assertIsNot(first.body[0], second.body[0])
+        self.assertIs(first.body[1], second.body[1])
+
+        compiler = IncrementalCompiler()
+        env = compiler.run(first, {})
+        self.assertEqual((env['scaled'](5), env['shifted'](5)), (10, 6))
+        env = compiler.run(second, {})
+        self.assertEqual((env['scaled'](5), env['shifted'](5)), (15, 6))
+        stats = compiler.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+
+    def test_expression(self):
+        compiler = IncrementalCompiler()
+        self.assertEqual(compiler.run(make_value(ast.Num(2)),
+                                      {'offset': 1}), 3)
+
+
+class TestStream(unittest.TestCase):
+
+    def stream(self, n, limit=1000, **kwds):
+        stream = StreamCompiler('kernel', ['A', 'out'], chunksize=4, **kwds)
+        stream.extend(unrolled(n, ast.Num(limit)))
+        return stream
+
+    def test_chunks(self):
+        for backend in CompilationUnit.backends:
+            stream = self.stream(10, backend=backend)
+            self.assertEqual(len(stream.chunks), 10) # of 42 statements
+            kernel = stream.function()
+            self.assertEqual(len(stream.chunks), 11)
+            out = [0] * 10
+            self.assertEqual(kernel(range(10), out), (90, 3))
+            self.assertEqual(out, range(0, 20, 2))
+
+    def test_return(self):
+        kernel = self.stream(10, limit=20).function()
+        self.assertEqual(kernel(range(10), [0] * 10), (30, 'early'))
+
+    def test_unbound(self):
+        # last is only bound by the statements for i == 3
+        kernel = self.stream(3).function()
+        self.assertRaises(UnboundLocalError, kernel, range(3), [0] * 3)
+
+    def chunked(self, *sources, **kwds):
+        stream = StreamCompiler('kernel', ['a'], chunksize=1, **kwds)
+        for source in sources:
+            stream.add(ast.parse(source))
+        return stream.function()
+
+    def test_deleted(self):
+        kernel = self.chunked("x = a", "del x", "return x")
+        self.assertRaises(UnboundLocalError, kernel, 5)
+
+    def test_bound_later(self):
+        # y is a local of the function, not the global
+        kernel = self.chunked("if a: return y", "y = 1", "return y",
+                              globals={'y': 5})
+        self.assertRaises(UnboundLocalError, kernel, 1)
+        self.assertEqual(kernel(0), 1)
+
+    def test_globals(self):
+        namespace = {'scale': 2}
+        kernel = self.chunked("x = a * scale", "return len(range(x))",
+                              globals=namespace)
+        self.assertEqual(kernel(3), 6)
+        namespace['scale'] = 3
+        self.assertEqual(kernel(3), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
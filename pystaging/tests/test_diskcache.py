@@ -0,0 +1,134 @@
+import os
+import sys
+import ast
+import shutil
+import subprocess
+import tempfile
+import unittest
+from pystaging import *
+from pystaging.diskcache import diskcache, DiskCache
+from pystaging.utils import make_temper
+
+def make_persisted(c):
+    return quote[x * escape[c]]
+
+def make_persisted_template(c):
+    return quote[x - escape[c]]
+
+originals = make_persisted, make_persisted_template
+
+expected = lambda source: ast.dump(ast.parse(source, mode='eval').body)
+
+unpickled = []
+
+def record():
+    unpickled.append(True)
+
+# Staged in a fresh interpreter: make_sum is staged without the disk cache
+# before make_product is loaded from it when FIRST is set
+cached_module = """
+import os
+from pystaging import staging, quote, escape, string
+
+def make_sum(c):
+    return quote[x + escape[c]]
+
+def make_product(c):
+    return quote[x * escape[c]]
+
+if os.environ.get('FIRST'):
+    make_sum = staging(make_sum, templates=True)
+make_product = staging(make_product, templates=True,
+                       cache_dir=os.environ['CACHE_DIR'])
+if os.environ.get('FIRST'):
+    print(string(make_sum(5)))
+print(string(make_product(5)))
+"""
+
+class Tracer(object):
+    """Records when it is unpickled"""
+
+    def __reduce__(self):
+        return record, ()
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = diskcache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persist(self):
+        for i in range(2):
+            f = staging(originals[0], cache_dir=self.directory)
+            self.assertEqual(ast.dump(f(3)), expected("x * 3"))
+        self.assertEqual(self.cache.stats()['stores'], 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_persist_templates(self):
+        for i in range(2):
+            f = staging(originals[1], templates=True, cache_dir=self.directory)
+            self.assertEqual(ast.dump(f(3)), expected("x - 3"))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_template_names_fresh_interpreter(self):
+        moduledir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, moduledir)
+        with open(os.path.join(moduledir, 'cachedmodule.py'), 'w') as f:
+            f.write(cached_module)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = dict(os.environ, CACHE_DIR=self.directory,
+                   PYTHONPATH=os.pathsep.join([moduledir, root]))
+        def run(**extra):
+            process = subprocess.Popen(
+                [sys.executable, '-c', 'import cachedmodule'],
+                env=dict(env, **extra), stdout=subprocess.PIPE)
+            output, _ = process.communicate()
+            self.assertEqual(process.returncode, 0)
+            return output.splitlines()
+        self.assertEqual(run(), ['(x * 5)'])
+        self.assertEqual(run(FIRST='1'), ['(x + 5)', '(x * 5)'])
+
+    def test_invalid_entry(self):
+        staging(originals[0], cache_dir=self.directory)
+        for filename in os.listdir(self.directory):
+            with open(os.path.join(self.directory, filename), 'wb') as f:
+                f.write("garbage")
+        f = staging(originals[0], cache_dir=self.directory)
+        self.assertEqual(ast.dump(f(4)), expected("x * 4"))
+        self.assertEqual(self.cache.stats()['invalid'], 1)
+
+    def test_key_checked_before_unpickling(self):
+        del unpickled[:]
+        self.assertTrue(self.cache.store(('a',), compile('1', '', 'eval'),
+                                         tracer=Tracer()))
+        self.cache.load(('a',))
+        self.assertEqual(unpickled, [True])
+        del unpickled[:]
+        # Another key whose entry file is at the same path
+        os.rename(self.cache.path(('a',)), self.cache.path(('b',)))
+        self.assertIsNone(self.cache.load(('b',)))
+        self.assertEqual(unpickled, [])
+        self.assertEqual(self.cache.stats()['invalid'], 1)
+
+    def test_failed_store(self):
+        key = ('f',)
+        os.mkdir(self.cache.path(key)) # rename() onto it fails
+        self.assertFalse(self.cache.store(key, compile('1', '', 'eval')))
+        self.assertEqual(os.listdir(self.directory),
+                         [os.path.basename(self.cache.path(key))])
+
+    def test_disabled(self):
+        self.assertIsNone(diskcache(None))
+        self.assertIsNone(diskcache(''))
+
+    def test_reserve(self):
+        temper = make_temper()
+        temper.reserve('t3')
+        temper.reserve('u')
+        self.assertEqual(temper('t'), 't4')
+        self.assertEqual(temper('u'), 'u1')
@@ -0,0 +1,66 @@
+import ast
+import unittest
+from pystaging import *
+from pystaging.guards import guarded, typeof, value
+
+
+@guarded(x=typeof, n=value)
+@staging
+def power(x, n):
+    body = quote[x]
+    for i in range(n - 1):
+        body = quote[escape[body] * x]
+    return quote[lambda x, n: escape[body]]
+
+def negative(x):
+    return -x
+
+@guarded(maxvariants=2, fallback=negative, x=value)
+@staging
+def negate(x):
+    with quote as body:
+        def negate(x):
+            return -escape[x]
+    return body
+
+@guarded(key=value, guard0=typeof)
+@staging
+def clashing(key, function, variants, miss, calls, KeyError, guard0):
+    return quote[lambda *args: sum(args)]
+
+
+class TestGuards(unittest.TestCase):
+
+    def test_dispatch(self):
+        power.dispatcher.clear()
+        self.assertEqual(power(3, 2), 9)
+        self.assertEqual(power(2, 2), 4)
+        self.assertEqual(power(2.0, 3), 8.0)
+        self.assertEqual(power(3, 3), 27)
+        stats = power.dispatcher.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+        self.assertEqual(len(power.dispatcher.variants), 3)
+
+    def test_fallback(self):
+        negate.dispatcher.clear()
+        self.assertEqual([negate(x) for x in (1, 2, 1, 3, 4)],
+                         [-1, -2, -1, -3, -4])
+        stats = negate.dispatcher.stats()
+        self.assertEqual(stats['fallbacks'], 2)
+        self.assertEqual(stats['size'], 2)
+
+    def test_eviction(self):
+        @guarded(maxvariants=2, x=value)
+        def const(x):
+            return lambda x: x
+        self.assertEqual([const(x) for x in (1, 2, 3, 1)], [1, 2, 3, 1])
+        stats = const.dispatcher.stats()
+        self.assertEqual((stats['evictions'], stats['size']), (2, 2))
+
+    def test_unknown_argument(self):
+        self.assertRaises(TypeError, guarded(y=value), lambda x: x)
+
+    def test_parameter_names(self):
+        self.assertEqual(clashing(1, 2, 3, 4, 5, 6, 7), 28)
+        self.assertEqual(clashing(1, 2, 3, 4, 5, 6, 7), 28)
+        self.assertEqual(clashing.dispatcher.stats()['hits'], 1)
@@ -0,0 +1,108 @@
+import ast
+import copy as copy_module
+import pickle
+import unittest
+from pystaging import *
+from pystaging import interning
+from pystaging.astutils import structkey, copynode
+from pystaging.interning import InternTable
+from pystaging.templates import Template
+
+table = InternTable()
+
+@staging(intern=table)
+def make_interned(c):
+    return quote[A[i] + B[i] * escape[c]]
+
+@staging(intern=table)
+def make_subscript():
+    return quote[A[i]]
+
+def parse(source):
+    return ast.parse(source, mode='eval').body
+
+
+class TestInterning(unittest.TestCase):
+
+    def test_intern_shares(self):
+        t = InternTable()
+        a = t.intern(parse("A[i] + f(x, 1)"))
+        b = t.intern(parse("A[i] + f(x, 1)"))
+        c = t.intern(parse("A[i] + f(x, 1.0)"))
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+        self.assertIs(a.left, c.left)
+        self.assertIs(t.intern(a), a)
+
+    def test_structkey_cached(self):
+        t = InternTable()
+        tree = parse("a * (b + 2)")
+        node = t.intern(tree)
+        self.assertIs(structkey(node), structkey(node))
+        self.assertEqual(structkey(node), structkey(tree))
+        self.assertEqual(hash(structkey(node)), hash(structkey(tree)))
+
+    def test_structkey_copied(self):
+        t = InternTable()
+        node = t.intern(parse("a * (b + 2)"))
+        copy = copy_module.deepcopy(node)
+        copy.right.right.n = 3
+        self.assertEqual(structkey(copy), structkey(parse("a * (b + 3)")))
+        self.assertEqual(structkey(node), structkey(parse("a * (b + 2)")))
+
+    def test_modified_in_place(self):
+        class Rename(ast.NodeTransformer):
+            def visit_Name(self, node):
+                return ast.Name('c', node.ctx)
+
+        t = InternTable()
+        node = t.intern(parse("a * (b + 2)"))
+        Rename().visit(node)
+        self.assertEqual(structkey(node), structkey(parse("c * (c + 2)")))
+        self.assertFalse(t.isinterned(node.right))
+        fresh = t.intern(parse("a * (b + 2)"))
+        self.assertEqual(ast.dump(fresh), ast.dump(parse("a * (b + 2)")))
+        self.assertEqual(eval(astcompile(ast.Expression(fresh)),
+                              {'a': 2, 'b': 1}), 6)
+
+    def test_maxsize(self):
+        t = InternTable(maxsize=8)
+        for i in range(10):
+            t.intern(parse("a + %d" % i))
+        self.assertLessEqual(len(t), 8)
+        self.assertGreater(t.stats()['evictions'], 0)
+        self.assertIsNotNone(interning.table.maxsize)
+
+    def test_copynode_not_interned(self):
+        t = InternTable()
+        node = t.intern(parse("a + b"))
+        copy = copynode(node, right=ast.Name('c', ast.Load()))
+        self.assertFalse(t.isinterned(copy))
+        self.assertNotEqual(structkey(copy), structkey(node))
+
+    def test_staging_intern(self):
+        e1, e2 = make_interned(ast.Num(2)), make_interned(ast.Num(2))
+        expected = ast.dump(parse("A[i] + B[i] * 2"))
+        self.assertEqual(ast.dump(e1), expected)
+        self.assertIs(e1, e2)
+        self.assertIs(e1.left, make_subscript())
+        self.assertIsNot(make_interned(ast.Num(3)), e1)
+        self.assertEqual(eval(astcompile(make_interned(ast.Num(3))),
+                              {'A': [1], 'B': [2], 'i': 0}), 7)
+
+    def test_pickle(self):
+        tree = parse("x + y")
+        template = Template(tree, frozenset([tree.right]), table=table)
+        loaded = pickle.loads(pickle.dumps(template))
+        self.assertIsNotNone(loaded.table)
+        self.assertIsNot(loaded.table, interning.table)
+        self.assertIs(loaded(ast.Num(1)), loaded(ast.Num(1)))
+
+        default = Template(tree, frozenset([tree.right]),
+                           table=interning.table)
+        loaded = pickle.loads(pickle.dumps(default))
+        self.assertIs(loaded.table, interning.table)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import ast
+import unittest
+from pystaging import *
+from pystaging.utils import LRUCache, LFUCache, FIFOCache
+
+calls = []
+
+@staging(memoize=True)
+def make_scaled(c, name):
+    calls.append(c)
+    return quote[x * escape[c]]
+
+@staging(memoize=LFUCache(2), static=['c'])
+def make_shifted(c, unused=None):
+    return quote[x + escape[c]]
+
+@staging(memoize=1)
+def make_square(e):
+    return quote[escape[e] * escape[e]]
+
+@staging(memoize=True)
+def make_weighted(weights):
+    return quote[x * escape[weights.factor]]
+
+@staging(memoize=True)
+def make_sum(values):
+    return quote[x + escape[sum(values)]]
+
+class Weights(object):
+    __hash__ = None
+
+    def __init__(self, factor):
+        self.factor = factor
+
+
+class TestMemoize(unittest.TestCase):
+
+    def test_memoize_static_args(self):
+        del calls[:]
+        make_scaled.cache.clear()
+        e1 = make_scaled(2, 'a')
+        e2 = make_scaled(2, 'b')
+        self.assertEqual(ast.dump(e1), ast.dump(e2))
+        self.assertEqual(calls, [2])
+        # 2 and 2.0 splice in different constants
+        make_scaled(2.0, 'a')
+        self.assertEqual(calls, [2, 2.0])
+        self.assertEqual(make_scaled.cache.stats()['hits'], 1)
+
+    def test_memoize_copies(self):
+        e1 = make_scaled(3, 'a')
+        e1.right.n = 4
+        self.assertEqual(make_scaled(3, 'a').right.n, 3)
+
+    def test_memoize_declared_static(self):
+        make_shifted(1, unused=[])
+        make_shifted(1, unused={})
+        self.assertEqual(make_shifted.cache.stats()['hits'], 1)
+
+    def test_memoize_ast_args(self):
+        make_square(ast.Name('y', ast.Load()))
+        make_square(ast.Name('y', ast.Load()))
+        self.assertEqual(make_square.cache.stats()['hits'], 1)
+        make_square(ast.Name('z', ast.Load()))
+        self.assertEqual(make_square.cache.stats()['evictions'], 1)
+
+    def test_memoize_identity_args(self):
+        weights = Weights(2)
+        make_weighted(weights)
+        make_weighted(weights)
+        self.assertEqual(make_weighted.cache.stats()['hits'], 1)
+        # Entries do not keep their arguments alive
+        del weights
+        self.assertEqual(len(make_weighted.cache), 0)
+
+    def test_memoize_containers(self):
+        make_sum([1, 2])
+        make_sum([1, 2])
+        make_sum((1, 2))
+        stats = make_sum.cache.stats()
+        self.assertEqual((stats['hits'], stats['size']), (1, 2))
+
+
+class TestCaches(unittest.TestCase):
+
+    def fill(self, cache):
+        cache[1] = 'a'
+        cache[2] = 'b'
+        cache.get(1)
+        cache.get(1)
+        cache[3] = 'c'
+        return sorted(cache.data)
+
+    def test_policies(self):
+        self.assertEqual(self.fill(LRUCache(2)), [1, 3])
+        self.assertEqual(self.fill(LFUCache(2)), [1, 3])
+        self.assertEqual(self.fill(FIFOCache(2)), [2, 3])
+
+    def test_empty(self):
+        for cache in LRUCache(0), LFUCache(0), FIFOCache(0):
+            self.assertEqual(self.fill(cache), [])
@@ -0,0 +1,105 @@
+import gc
+import threading
+import unittest
+from pystaging import *
+from pystaging import profiling
+from pystaging.utils import make_temper, gcpaused, gcresumed
+
+def first(x):
+    return quote[escape[x] + 1]
+
+def second(x):
+    return quote[escape[x] + 1]
+
+
+class TestNames(unittest.TestCase):
+
+    def test_threads(self):
+        temper = make_temper()
+        names = []
+        def allocate():
+            names.extend([temper('t') for i in range(2000)])
+        threads = [threading.Thread(target=allocate) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(names)), 8 * 2000)
+
+    def test_reserve(self):
+        temper = make_temper()
+        self.assertEqual(temper('t'), 't')
+        temper.reserve('t5')
+        self.assertEqual(temper('t'), 't6')
+
+    def test_namescope(self):
+        with namescope() as outer:
+            first = symbol('tmp').name
+            self.assertEqual(first, outer + 'tmp')
+            with namescope() as inner:
+                self.assertEqual(symbol('tmp').name, inner + 'tmp')
+            self.assertEqual(symbol('tmp').name, outer + 'tmp1')
+        self.assertFalse(symbol('tmp').name.startswith(outer))
+
+    def test_namescope_threads(self):
+        names = {}
+        def stage(n):
+            with namescope('staged.temp.session%d.' % n):
+                names[n] = [symbol('x').name for i in range(3)]
+        threads = [threading.Thread(target=stage, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n in range(4):
+            prefix = 'staged.temp.session%d.x' % n
+            self.assertEqual(names[n], [prefix, prefix + '1', prefix + '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestGC(unittest.TestCase):
+
+    def test_gcpaused(self):
+        self.assertTrue(gc.isenabled())
+        with gcpaused():
+            with gcpaused():
+                self.assertFalse(gc.isenabled())
+                with gcresumed():
+                    self.assertTrue(gc.isenabled())
+                self.assertFalse(gc.isenabled())
+            self.assertFalse(gc.isenabled())
+        self.assertTrue(gc.isenabled())
+
+    def test_gcpaused_threads(self):
+        # The collector stays off until the last thread leaves its block
+        entered, leave = threading.Event(), threading.Event()
+        def pause():
+            with gcpaused():
+                entered.set()
+                leave.wait()
+        thread = threading.Thread(target=pause)
+        thread.start()
+        entered.wait()
+        with gcpaused():
+            pass
+        self.assertFalse(gc.isenabled())
+        leave.set()
+        thread.join()
+        self.assertTrue(gc.isenabled())
+
+    def test_gcpaused_optin(self):
+        # Staging leaves the process wide collector alone unless asked
+        states = []
+        def hook(record):
+            if record['stage'] == 'process':
+                states.append(gc.isenabled())
+        with profiling.profiled(hook):
+            staging(first)
+            staging(second, pausegc=True)
+        self.assertEqual(states, [True, False])
+        self.assertTrue(gc.isenabled())
+        with gcpaused(False):
+            self.assertTrue(gc.isenabled())
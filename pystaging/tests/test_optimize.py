@@ -0,0 +1,333 @@
+import ast
+import math
+import unittest
+from pystaging import *
+from pystaging import optimize
+from pystaging.optimize import cse, fold, unroll, hoist, deadstores, Purity
+from pystaging.quotation import suite, optimizer_key
+from pystaging.astutils import astcompile
+
+@staging
+def square(x):
+    return quote[escape[x] * escape[x]]
+
+@staging(hygiene=True)
+def assign_square(x):
+    with quote as body:
+        squared = escape[square(x)]
+    return body
+
+@staging(lazy=True)
+def lazy_loop(n):
+    with quote as body:
+        for i in range(escape[n]):
+            total = total + (i + 1) * (i + 1)
+    return body
+
+parse = lambda source: ast.parse(source).body[0]
+count = lambda tree, type: sum(isinstance(node, type) for node in ast.walk(tree))
+
+
+class TestCSE(unittest.TestCase):
+
+    def test_cse_square(self):
+        body = assign_square(ast.parse("a + 2", mode='eval').body)
+        before = ast.dump(body)
+        self.assertEqual(count(cse(body), ast.Add), 1)
+        self.assertEqual(ast.dump(body), before)
+
+        env = {'a': 3}
+        run(body, env, optimize=cse)
+        self.assertEqual(env['staged.temp.squared'], 25)
+
+    def test_cse_expr(self):
+        expr = ast.parse("abs(a * b) + abs(a * b)", mode='eval')
+        self.assertEqual(count(cse(expr), ast.Mult), 1)
+        self.assertEqual(count(cse(expr.body), ast.Mult), 1)
+        self.assertEqual(count(expr, ast.Mult), 2)
+        # Locals stay visible to expressions run with optimize=True
+        self.assertEqual(run(expr, {'abs': abs}, {'a': 2, 'b': -3},
+                             optimize=True), 12)
+        expr = ast.parse("a * b + c", mode='eval')
+        self.assertIs(cse(expr), expr)
+
+    def test_cse_square_expr(self):
+        body = square(ast.parse("a + 2", mode='eval').body)
+        self.assertEqual(count(cse(body), ast.Add), 1)
+        self.assertEqual(run(body, {'a': 3}, optimize=cse), 25)
+        def f(a):
+            return eval(astcompile(cse(body)))
+        self.assertEqual(f(1), 9)
+
+    def test_cse_impure(self):
+        stmt = parse("x = f(a) + f(a) + a.b + a.b")
+        self.assertIs(type(cse(stmt)), ast.Assign)
+        stmt = parse("x = a.b + a.b")
+        self.assertIs(type(cse(stmt, Purity(attributes=False))), ast.Assign)
+        stmt = parse("x = f(a) + f(a)")
+        self.assertIsNot(type(cse(stmt, Purity(calls=['f']))), ast.Assign)
+
+    def test_cse_conditional(self):
+        stmt = parse("x = a and (b.c + 1) + (b.c + 1)")
+        self.assertIs(type(cse(stmt)), ast.Assign)
+        # Comparators after the first are only evaluated if it holds
+        stmt = parse("x = 0 < n < (b.c + 1) + (b.c + 1)")
+        self.assertIs(type(cse(stmt)), ast.Assign)
+        stmt = parse("x = (b.c + 1) < (b.c + 1) < n")
+        self.assertIsNot(type(cse(stmt)), ast.Assign)
+
+
+@staging(optimize=True)
+def make_folded(x):
+    return escape[quote[x * 1 + (2 + 3) * 4 if 1 < 2 else y]]
+
+@staging
+def make_suite(c):
+    with quote as body:
+        if escape[c]:
+            folded = 2 ** 3
+        else:
+            folded = 0
+    return body
+
+@staging(optimize=True)
+def make_folded_suite(n):
+    with quote as body:
+        if escape[n] > 2:
+            folded = x + (2 + 3) * 4
+        else:
+            folded = 0
+    return body
+
+@staging(optimize=True)
+def make_folded_expr(x):
+    return quote[(2 + 3) * 4 + escape[x] if 1 < 2 else y]
+
+parse_expr = lambda source: ast.parse(source, mode='eval').body
+
+
+class TestFold(unittest.TestCase):
+
+    def test_fold_expr(self):
+        result = fold(parse_expr("float(x) * 1 + (2 + 3) * 4"))
+        self.assertEqual(ast.dump(result), ast.dump(parse_expr("float(x) + 20")))
+
+    def test_fold_identities(self):
+        # x may be a list, a string or an array, for which these copy or fail
+        for source in ("x * 1", "1 * x", "x + 0", "x ** 1", "float(x) + 0"):
+            self.assertEqual(ast.dump(fold(parse_expr(source))),
+                             ast.dump(parse_expr(source)))
+        self.assertEqual(ast.dump(fold(parse_expr("len(x) + 0"))),
+                         ast.dump(parse_expr("len(x)")))
+        self.assertEqual(ast.dump(fold(parse_expr("1 * (2 * len(x))"))),
+                         ast.dump(parse_expr("2 * len(x)")))
+
+    def test_fold_limits(self):
+        for source in ("10 ** 10 ** 10", "1 << 10 ** 10", "'ab' * 10 ** 10",
+                       "10 ** 10 * 'ab'"):
+            self.assertIsInstance(fold(parse_expr(source)), ast.BinOp)
+        self.assertEqual(fold(parse_expr("2 ** 10")).n, 1024)
+        self.assertEqual(fold(parse_expr("'ab' * 2")).s, 'abab')
+
+    def test_fold_division(self):
+        self.assertIsInstance(fold(parse_expr("1 / 2")), ast.BinOp)
+        self.assertEqual(fold(parse_expr("1.0 / 2")).n, 0.5)
+
+    def test_fold_boolop(self):
+        self.assertEqual(ast.dump(fold(parse_expr("1 and x"))),
+                         ast.dump(parse_expr("x")))
+        self.assertEqual(fold(parse_expr("0 and x")).n, 0)
+
+    def test_fold_suite(self):
+        result = fold(make_suite(ast.Num(1)))
+        self.assertEqual(ast.dump(result), ast.dump(parse("folded = 8")))
+        env = {}
+        run(make_suite(ast.Num(0)), env, optimize=True)
+        self.assertEqual(env['folded'], 0)
+
+    def test_staging_optimize(self):
+        self.assertEqual(make_folded(3), 23)
+        code = make_folded.func_code
+        self.assertNotIn('y', code.co_names)
+
+    def test_staging_optimize_quotes(self):
+        result = make_folded_suite(3)
+        self.assertEqual(ast.dump(result),
+                         ast.dump(suite([parse("folded = x + 20")])))
+        self.assertEqual(ast.dump(make_folded_expr(ast.Num(3))),
+                         ast.dump(ast.Num(23)))
+
+    def test_optimizer_key(self):
+        class Passes(object):
+            def __init__(self, passes):
+                self.passes = passes
+            def __call__(self, tree):
+                return tree
+        first, second = lambda tree: tree, lambda tree: fold(tree)
+        self.assertNotEqual(optimizer_key(first), optimizer_key(second))
+        self.assertEqual(optimizer_key(Passes([fold])),
+                         optimizer_key(Passes([fold])))
+        self.assertNotEqual(optimizer_key(Passes([fold])),
+                            optimizer_key(Passes([cse])))
+
+
+@staging
+def make_loop(n):
+    with quote as body:
+        for i in range(escape[n]):
+            out.append(i * i)
+    return body
+
+def run_loop(tree, n):
+    env = {'out': [], 'n': n}
+    run(tree, env)
+    return env['out'], env.get('i')
+
+
+class TestUnroll(unittest.TestCase):
+
+    def test_unroll_full(self):
+        result = unroll(make_loop(ast.Num(3)))
+        self.assertEqual(count(result, ast.For), 0)
+        self.assertEqual(run_loop(result, None), ([0, 1, 4], 2))
+
+    def test_unroll_partial(self):
+        tree = make_loop(ast.Name('n', ast.Load()))
+        result = unroll(tree, factor=4)
+        self.assertEqual(count(result, ast.For), 2)
+        for n in (0, 1, 3, 4, 9):
+            self.assertEqual(run_loop(result, n), run_loop(tree, n))
+
+    def test_unroll_step(self):
+        tree = ast.parse("for i in range(1, n, 3):\n    out.append(i)")
+        result = unroll(tree, factor=2)
+        for n in (0, 1, 2, 7, 8, 13, 14):
+            self.assertEqual(run_loop(result, n), run_loop(tree, n))
+
+    def test_unroll_break(self):
+        tree = parse("for i in range(3):\n    if i: break")
+        self.assertIs(unroll(tree), tree)
+
+
+class TestHoist(unittest.TestCase):
+
+    source = """
+def total(n):
+    s = 0
+    for i in range(n):
+        s += math.sqrt(i) + scale
+    return s
+"""
+
+    def test_hoist(self):
+        tree = ast.parse(self.source)
+        result = hoist(tree, attributes=True)
+        env = {'math': math, 'scale': 1}
+        run(result, env)
+        code = env['total'].func_code
+        self.assertEqual(sorted(code.co_freevars),
+                         ['math.sqrt', 'range', 'scale'])
+        self.assertNotIn('range', code.co_names)
+        self.assertEqual(env['total'](4), sum(map(math.sqrt, range(4))) + 4)
+        self.assertEqual(ast.dump(tree), ast.dump(ast.parse(self.source)))
+
+    def test_hoist_names(self):
+        env = {'math': math, 'scale': 1}
+        run(hoist(ast.parse(self.source), names=['range']), env)
+        self.assertEqual(env['total'].func_code.co_freevars, ('range',))
+
+    def test_hoist_written_attributes(self):
+        tree = ast.parse("def step():\n"
+                         "    state.count += 1\n"
+                         "    state.last.value = state.count\n"
+                         "    return state.last.value, math.pi\n")
+        state = type('State', (), {})()
+        state.count, state.last = 0, type('Last', (), {})()
+        env = {'state': state, 'math': math}
+        run(hoist(tree, attributes=True), env)
+        self.assertEqual(env['step'](), (1, math.pi))
+        self.assertEqual(env['step'](), (2, math.pi))
+        self.assertEqual(sorted(env['step'].func_code.co_freevars),
+                         ['math.pi', 'state', 'state.last'])
+
+    def test_hoist_recursion(self):
+        tree = ast.parse("def fact(n):\n"
+                         "    return n * fact(n - 1) if n else 1\n")
+        env = {}
+        run(hoist(tree), env)
+        self.assertEqual(env['fact'](5), 120)
+        self.assertEqual(env['fact'].func_code.co_freevars, ())
+
+
+@staging(hygiene=True)
+def make_kernel(c):
+    with quote as body:
+        def kernel(x):
+            tmp = x * escape[c]
+            unused = x
+            count = 0
+            count += 1
+            side = log.append(x)
+            x, 2
+            return tmp
+    return body
+
+class TestDeadStores(unittest.TestCase):
+
+    def test_deadstores(self):
+        stats = {}
+        tree = deadstores(make_kernel(ast.Num(3)), stats=stats)
+        self.assertEqual(stats['removed'], 2)
+        source = string(tree)
+        self.assertNotIn('unused', source)
+        self.assertIn('staged.temp.count += 1', source)
+        self.assertIn('log.append', source)
+        self.assertNotIn('side', source)
+
+        env = {'log': []}
+        run(tree, env)
+        self.assertEqual(env['kernel'](2), 6)
+        self.assertEqual(env['log'], [2])
+
+    def test_module_level(self):
+        tree = ast.parse("staged.temp.x = 1\n(1, [2])\n")
+        result = deadstores(tree)
+        self.assertEqual(len(result.body), 1)
+        self.assertIsInstance(result.body[0], ast.Assign)
+
+    def test_raising(self):
+        tree = ast.parse("def f(a, b):\n"
+                         "    tmp = a[10]\n"
+                         "    a + b\n"
+                         "    c\n"
+                         "    del b\n"
+                         "    b\n"
+                         "    return 1\n")
+        stats = {}
+        result = deadstores(tree, prefix='tmp', stats=stats)
+        self.assertEqual(stats['removed'], 0)
+        self.assertEqual(len(result.body[0].body), 6)
+        self.assertNotIn('tmp', string(result))
+        env = {}
+        run(result, env)
+        self.assertRaises(IndexError, env['f'], [], 1)
+
+    def test_closure(self):
+        tree = ast.parse("def f():\n"
+                         "    staged.temp.x = 1\n"
+                         "    def g():\n"
+                         "        return staged.temp.x\n"
+                         "    return g\n")
+        self.assertEqual(string(deadstores(tree)), string(tree))
+
+
+class TestLazy(unittest.TestCase):
+
+    def test_passes(self):
+        for optimization in (fold, cse, unroll, hoist, deadstores,
+                             optimize.optimize):
+            tree = optimization(lazy_loop(3))
+            self.assertIsInstance(tree, ast.AST)
+            env = {'total': 0}
+            run(tree, env)
+            self.assertEqual(env['total'], 14)
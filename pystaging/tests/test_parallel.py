@@ -0,0 +1,57 @@
+import ast
+import unittest
+from pystaging import *
+from pystaging.parallel import stage_parallel
+
+@staging
+def make_scaled(c):
+    tmp = symbol('tmp')
+    with quote as body:
+        escape[tmp.store] = x * escape[c]
+        y = escape[tmp.load] + 1
+    return body
+
+@staging
+def make_lookup(n):
+    return quote[escape[range(n)][i]]
+
+def plain(n):
+    return n * 2
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_stage_parallel(self):
+        jobs = [(make_scaled, (ast.Num(n),)) for n in range(4)]
+        jobs.append((plain, (), {'n': 21}))
+        results = stage_parallel(jobs, processes=2)
+        self.assertEqual(results[-1], 42)
+
+        names = set()
+        for n, code in enumerate(results[:-1]):
+            env = {'x': 10}
+            exec code in env
+            self.assertEqual(env['y'], 10 * n + 1)
+            tmp, = [name for name in env if name.startswith('staged.temp.')]
+            self.assertTrue(tmp.endswith('.%d.tmp' % n), tmp)
+            names.add(tmp)
+        self.assertEqual(len(names), 4)
+
+    def test_deterministic(self):
+        first = stage_parallel([(make_scaled, (ast.Num(1),))] * 3,
+                               processes=3)
+        second = stage_parallel([(make_scaled, (ast.Num(1),))] * 3,
+                                processes=1)
+        strip = lambda code: [name.split('.', 3)[3] for name in code.co_names
+                              if name.startswith('staged.temp.')]
+        self.assertEqual(map(strip, first), map(strip, second))
+
+    def test_persisted(self):
+        env = {'i': 500}
+        code, = stage_parallel([(make_lookup, (1000,))], processes=1,
+                               globals=env)
+        self.assertEqual(eval(code, env), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
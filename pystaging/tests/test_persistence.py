@@ -0,0 +1,92 @@
+import ast
+import unittest
+from pystaging import *
+from pystaging.astutils import Persisted
+from pystaging.quotation import compilecode
+
+
+def table(n):
+    return range(n)
+
+@staging
+def lookup(values):
+    return quote[escape[values][i]]
+
+@staging
+def persisted(obj):
+    return quote[escape[obj]]
+
+@staging
+def quote_assign(obj):
+    with quote as stmts:
+        x = escape[obj]
+    return stmts
+
+@staging
+def splice_table():
+    return escape[table(1000)]
+
+
+class TestPersistence(unittest.TestCase):
+
+    def test_large_table(self):
+        values = table(100000)
+        tree = lookup(values)
+        self.assertLess(len(list(ast.walk(tree))), 10)
+        self.assertEqual(run(tree, {'i': 12345}), 12345)
+        self.assertIs(run(persisted(values), {}), values)
+
+    def test_literals(self):
+        self.assertEqual(string(persisted(3)), "3")
+        self.assertEqual(string(persisted('a')), "'a'")
+        # Containers of any size are shared, not copied
+        small = [1, 2]
+        self.assertIsInstance(persisted(small), Persisted)
+        self.assertIsInstance(persisted((1, 'a')), Persisted)
+        self.assertIs(run(persisted(small), {}), small)
+
+    def test_names_reused(self):
+        values = table(1000)
+        first, second = lookup(values), lookup(values)
+        self.assertEqual(first.value.id, second.value.id)
+        self.assertIs(compilecode(first, cache=True),
+                      compilecode(first, cache=True))
+        self.assertIsNot(compilecode(first), compilecode(first))
+        self.assertNotEqual(lookup(table(1000)).value.id, first.value.id)
+
+    def test_globals_untouched(self):
+        env = {'i': 3}
+        self.assertEqual(run(lookup(table(10)), env), 3)
+        unit = CompilationUnit()
+        unit.add(persisted(table(10)), name='values')
+        unit.run(env)
+        self.assertEqual(sorted(name for name in env
+                                if name != '__builtins__'), ['i', 'values'])
+        self.assertFalse([name for name in globals()
+                          if name.startswith('staged.temp.')])
+
+    def test_separate_locals(self):
+        values = table(10)
+        self.assertEqual(run(lookup(values), {}, {'i': 4}), 4)
+        env = {}
+        run(quote_assign(values), {}, env)
+        self.assertEqual(env, {'x': values})
+
+    def test_objects(self):
+        obj = object()
+        tree = persisted(obj)
+        self.assertIsInstance(tree, Persisted)
+        self.assertEqual(string(tree), tree.id)
+        self.assertIs(run(tree, {}), obj)
+
+    def test_compile_time_splice(self):
+        self.assertEqual(splice_table(), table(1000))
+        self.assertIs(splice_table(), splice_table())
+
+    def test_compilation_unit(self):
+        values = table(1000)
+        unit = CompilationUnit()
+        unit.add(persisted(values))
+        unit.add(lookup(values))
+        env = {'i': 7}
+        self.assertEqual(unit.run(env), [values, 7])
@@ -0,0 +1,48 @@
+import ast
+import json
+import unittest
+from pystaging import *
+from pystaging import profiling
+
+
+class TestProfiling(unittest.TestCase):
+
+    def stage(self):
+        @staging
+        def scale(a):
+            return quote[escape[a] * 2]
+        return scale
+
+    def test_stages(self):
+        with profiling.collect() as collector:
+            scale = self.stage()
+        stages = set(record['stage'] for record in collector.records)
+        for name in ('getsource', 'parse', 'process', 'compile', 'exec',
+                     'quote', 'escape_ast', 'escape'):
+            self.assertIn(name, stages)
+
+        site = ':%d' % (self.stage.im_func.func_code.co_firstlineno + 3)
+        for record in collector.records:
+            self.assertTrue(record['function'].endswith('.scale'))
+            self.assertTrue(record['seconds'] >= 0)
+            if record['stage'] in ('quote', 'escape'):
+                self.assertTrue(record['site'].endswith(site),
+                                record['site'])
+        self.assertEqual(run(scale(ast.Num(3))), 6)
+
+    def test_output(self):
+        with profiling.collect() as collector:
+            self.stage()
+        self.assertIn('process', collector.table())
+        summary = json.loads(collector.json())['summary']
+        self.assertEqual(len(summary), len(collector.summary()))
+        self.assertNotIn('records', json.loads(collector.json()))
+        self.assertIn('records', json.loads(collector.json(records=True)))
+
+    def test_nohooks(self):
+        collector = profiling.Collector()
+        with profiling.profiled(collector):
+            pass
+        self.stage()
+        self.assertEqual(collector.records, [])
+        self.assertEqual(profiling.hooks, [])
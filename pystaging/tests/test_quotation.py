@@ -1,5 +1,7 @@
+import ast
 import unittest
 from pystaging import *
+from pystaging import quotation
 
 @staging
 def make_expr(c):
@@ -34,4 +36,23 @@ class TestQuotation(unittest.TestCase):
         self.assertEqual(env['staged.temp.result'], 2 + 5 * 10)
 
     def test_inline_splice_expr(self):
-        self.assertEqual(splice_expr(10), 100)
\ No newline at end of file
+        self.assertEqual(splice_expr(10), 100)
+
+    def splices(self, **kwds):
+        before = dict(quotation.splicestats)
+        @staging(**kwds)
+        def make_sum(x):
+            term = quote[x * 2]
+            with quote as body:
+                total = escape[term] + escape[quote[1]] + escape[x]
+            return body
+        after = quotation.splicestats
+        env = {'x': 10}
+        run(make_sum(ast.Num(3)), env)
+        self.assertEqual(env['total'], 10 * 2 + 1 + 3)
+        return (after['elided'] - before['elided'],
+                after['checked'] - before['checked'])
+
+    def test_splice_elision(self):
+        self.assertEqual(self.splices(), (2, 1))
+        self.assertEqual(self.splices(asts=['x']), (3, 0))
\ No newline at end of file
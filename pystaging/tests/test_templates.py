@@ -0,0 +1,113 @@
+import os
+import ast
+import sys
+import shutil
+import tempfile
+import unittest
+from pystaging import *
+from pystaging.templates import Template, Hole, LazyQuotation
+
+@staging(templates=True)
+def make_expr(c):
+    return quote[a + b * escape[c]]
+
+@staging(templates=True, hygiene=True)
+def make_stmt(c):
+    with quote as body:
+        total = a + b * escape[c]
+    return body
+
+@staging(templates=True)
+def square(x):
+    return quote[escape[x] * escape[x]]
+
+@staging(templates=True)
+def splice_expr(x):
+    return escape[square(quote[x])]
+
+@staging(lazy=True)
+def lazy_expr(c):
+    return quote[a + b * escape[c]]
+
+@staging(lazy=True)
+def lazy_square(x):
+    return quote[escape[x] * escape[x]]
+
+
+class TestTemplates(unittest.TestCase):
+
+    def test_template_expr(self):
+        expected = ast.dump(ast.parse("a + b * 10", mode='eval').body)
+        self.assertEqual(ast.dump(make_expr(10)), expected)
+
+    def test_template_fresh_copies(self):
+        e1, e2 = make_expr(1), make_expr(2)
+        self.assertIsNot(e1, e2)
+        self.assertIsNot(e1.right, e2.right)
+        self.assertEqual(e1.right.right.n, 1)
+        self.assertEqual(e2.right.right.n, 2)
+
+    def test_template_stmt(self):
+        env = {'a': 2, 'b': 5}
+        run(make_stmt(10), env)
+        self.assertNotIn('total', env)
+        self.assertEqual(env['staged.temp.total'], 2 + 5 * 10)
+
+    def test_template_splice_expr(self):
+        self.assertEqual(splice_expr(10), 100)
+
+    def test_template_prototype(self):
+        tree = ast.parse("x + y", mode='eval').body
+        template = Template(tree, exclude=frozenset([tree.right]))
+        self.assertIsInstance(template.prototype.right, Hole)
+        result = template(ast.Num(3))
+        self.assertEqual(ast.dump(result),
+                         ast.dump(ast.parse("x + 3", mode='eval').body))
+
+    def test_lazy(self):
+        expr = lazy_expr(10)
+        self.assertIsInstance(expr, LazyQuotation)
+        self.assertIsNone(expr.tree)
+        self.assertEqual(string(expr), "(a + (b * 10))")
+        self.assertIsNotNone(expr.tree)
+        self.assertEqual(run(expr, {'a': 1, 'b': 2}), 21)
+
+    def test_lazy_equality(self):
+        candidates = [lazy_square(lazy_expr(n % 3)) for n in range(9)]
+        unique = set(candidates)
+        self.assertEqual(len(unique), 3)
+        self.assertEqual(candidates[0], candidates[3])
+        self.assertNotEqual(candidates[0], candidates[1])
+        self.assertTrue(all(c.tree is None for c in candidates))
+        self.assertIsInstance(candidates[0].values[0], LazyQuotation)
+        self.assertEqual(run(candidates[2], {'a': 1, 'b': 2}), 25)
+
+    def test_lazy_in_eager(self):
+        self.assertEqual(string(square(lazy_expr(1))),
+                         "((a + (b * 1)) * (a + (b * 1)))")
+
+
+class TestManyHoles(unittest.TestCase):
+    """More escapes than a call has room for positional arguments"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        terms = "sum([%s])" % ", ".join(["escape[x]"] * 300)
+        with open(os.path.join(self.directory, 'manyholes.py'), 'w') as f:
+            f.write("from pystaging import *\n")
+            for option in ('templates', 'lazy', 'intern', 'incremental'):
+                f.write("@staging(%s=True)\n"
+                        "def %s(x):\n"
+                        "    return quote[%s]\n" % (option, option, terms))
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        sys.modules.pop('manyholes', None)
+        shutil.rmtree(self.directory)
+
+    def test_many_holes(self):
+        import manyholes
+        for option in ('templates', 'lazy', 'intern', 'incremental'):
+            tree = getattr(manyholes, option)(ast.Num(2))
+            self.assertEqual(run(tree, {}), 600)
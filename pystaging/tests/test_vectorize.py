@@ -0,0 +1,122 @@
+import ast
+import unittest
+from pystaging import *
+from pystaging.optimize import fold
+from pystaging.vectorize import vectorize
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+@staging
+def add(a, b):
+    return quote[escape[a] + escape[b]]
+
+@staging
+def make_kernel(op):
+    with quote as body:
+        for i in range(A.shape[0]):
+            out[i] = escape[op(quote[A[i]], quote[B[i]])] * 2
+            out[i] += scale
+    return body
+
+parse = lambda source: ast.parse(source).body[0]
+
+
+class TestVectorize(unittest.TestCase):
+
+    def test_vectorize_pattern(self):
+        result = vectorize(fold(make_kernel(add)), numpy='np')
+        stop, result = result.body
+        self.assertEqual(string(stop.value), 'A.shape[0]')
+        self.assertIsInstance(result, ast.If)
+        calls = [node.func.attr for node in ast.walk(result.body[0])
+                 if isinstance(node, ast.Call) and
+                    isinstance(node.func, ast.Attribute)]
+        self.assertEqual(calls, ['multiply', 'add'])
+        self.assertIsInstance(result.orelse[0], ast.For)
+
+    def test_vectorize_fallback(self):
+        for source in ("for i in range(n):\n    out[i] = A[i + 1]",
+                       "for i in range(n):\n    out[i] = A[i] * i",
+                       "for i in range(n):\n    out[i] = out",
+                       "for i in range(n):\n    x = A[i]"):
+            tree = parse(source)
+            self.assertIs(vectorize(tree, numpy='np'), tree)
+
+    def test_vectorize_overlap(self):
+        result = vectorize(make_kernel(add), numpy='np')
+        checks = [(node.args[0].id, node.args[1].id)
+                  for node in ast.walk(result)
+                  if isinstance(node, ast.Call) and
+                     isinstance(node.func, ast.Attribute) and
+                     node.func.attr == 'may_share_memory']
+        self.assertEqual(checks, [('out', 'A'), ('out', 'B')])
+
+    def test_vectorize_guard_shapes(self):
+        stop, result = vectorize(fold(make_kernel(add)), numpy='np').body
+        tests = [string(test) for test in result.test.values]
+        for name in 'A', 'B', 'out':
+            self.assertIn('(%s.ndim == 1)' % name, tests)
+            self.assertIn('(%s.shape[0] >= %s)' % (name, stop.targets[0].id),
+                          tests)
+        self.assertEqual(string(result.orelse[0].iter),
+                         'range(%s)' % stop.targets[0].id)
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_vectorize_numpy(self):
+        tree = make_kernel(add)
+        results = []
+        for code in (tree, vectorize(tree)):
+            # numpy is persisted into the vectorized code
+            env = {'A': np.arange(10), 'B': np.arange(10.0),
+                   'out': np.zeros(10), 'scale': 3}
+            run(code, env)
+            results.append((env['out'].tolist(), env['i']))
+        self.assertEqual(results[0], results[1])
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_vectorize_aliased(self):
+        # out[i] is A[i + 1], so every iteration reads the previous result
+        tree = make_kernel(add)
+        results = []
+        for code in (tree, vectorize(tree)):
+            memory = np.arange(11.0)
+            env = {'A': memory[:10], 'B': np.ones(10), 'out': memory[1:],
+                   'scale': 3}
+            run(code, env)
+            results.append(memory.tolist())
+        self.assertEqual(results[0], results[1])
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_vectorize_shapes(self):
+        # Arrays too short or not one-dimensional run the original loop,
+        # which raises or broadcasts as the loop does
+        tree = vectorize(make_kernel(add))
+        for A, B, out in [(np.arange(10), np.arange(5.0), np.zeros(10)),
+                          (np.arange(10), np.arange(10.0), np.zeros(5)),
+                          (np.ones((10, 2)), np.ones((10, 2)),
+                           np.zeros((10, 2)))]:
+            errors = []
+            for code in (make_kernel(add), tree):
+                env = {'A': A, 'B': B, 'out': out.copy(), 'scale': 3}
+                try:
+                    run(code, env)
+                except (IndexError, ValueError) as e:
+                    errors.append(type(e))
+                else:
+                    errors.append(env['out'].tolist())
+            self.assertEqual(errors[0], errors[1])
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_vectorize_longer(self):
+        # Longer arrays are vectorized over their first stop elements
+        tree = vectorize(make_kernel(add))
+        results = []
+        for code in (make_kernel(add), tree):
+            env = {'A': np.arange(5), 'B': np.arange(8.0),
+                   'out': np.zeros(8), 'scale': 3}
+            run(code, env)
+            results.append(env['out'].tolist())
+        self.assertEqual(results[0], results[1])
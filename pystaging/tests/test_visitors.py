@@ -0,0 +1,45 @@
+import ast
+import unittest
+
+from pystaging.visitors import rewrite, bindings, findquotes, quotednames
+
+source = """
+def f(x):
+    y = quote[a + escape[x]]
+    with quote as body:
+        z = escape[y]
+    return escape[body]
+"""
+
+class TestRewrite(unittest.TestCase):
+
+    def test_rewrite(self):
+        tree = ast.parse(source)
+        quotes, escapes = findquotes(tree, None)
+        expected = bindings(tree, quotes | escapes)[tree.body[0]]
+
+        staged = []
+        def stage(node):
+            staged.append(node)
+            return ast.Name('staged%d' % len(staged), ast.Load())
+
+        tree, replacements, bindingmap = rewrite(tree, stage)
+        # Only the outermost quotes and escapes are staged, in source order
+        self.assertEqual([node.lineno for node in staged], [3, 4, 6])
+        self.assertEqual(set(replacements), quotes | escapes)
+        self.assertEqual(tree.body[0].body[0].value.id, 'staged1')
+
+        bound, free = bindingmap[tree.body[0]]
+        self.assertEqual(sorted(bound), sorted(expected[0]))
+        self.assertEqual(sorted(free), sorted(expected[1]))
+        self.assertEqual(sorted(bound), ['x', 'y'])
+
+    def test_quotednames(self):
+        tree = ast.parse(source)
+        self.assertEqual(quotednames(tree), set(['y', 'body']))
+        tree = ast.parse(source + "    for y in x: pass\n")
+        self.assertEqual(quotednames(tree), set(['body']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,8 +6,12 @@ Simple utilities.
 
 from __future__ import print_function, division, absolute_import
 
+import gc
 import inspect
 import textwrap
+import threading
+import itertools
+import contextlib
 import collections
 
 def hashable(x):
@@ -17,6 +21,16 @@ def hashable(x):
     except TypeError:
         return False
 
+class hashedtuple(tuple):
+    """Tuple that computes its hash only once, for large nested keys"""
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = tuple.__hash__(self)
+            return self._hash
+
 def getsource(func):
     """Get source code without decorator for a function"""
     source = inspect.getsource(func)
@@ -28,17 +42,192 @@ def getsource(func):
     return textwrap.dedent("\n".join(lines[i:]))
 
 def make_temper():
-    """Return a function that returns temporary names"""
-    temps = collections.defaultdict(int)
+    """
+    Return a function that returns temporary names. It may be called from
+    several threads without locking: every name has an itertools.count,
+    and creating and advancing counts are atomic operations.
+    """
+    counts = {}
+
+    def counter(name):
+        count = counts.get(name)
+        if count is None:
+            count = counts.setdefault(name, itertools.count())
+        return count
 
     def temper(name=None):
-        count = temps[name]
-        temps[name] += 1
-        if name and count == 0:
+        n = next(counter(name))
+        if name and n == 0:
             return name
         elif name:
-            return '%s%d' % (name, count)
+            return '%s%d' % (name, n)
         else:
-            return str(count)
+            return str(n)
+
+    def reserve(name):
+        """Make sure name is never returned"""
+        advance(counter(name), 1)
+        base = name.rstrip('0123456789')
+        if base != name:
+            advance(counter(base), int(name[len(base):]) + 1)
+
+    temper.reserve = reserve
+    return temper
+
+def advance(count, n):
+    """Advance an itertools.count until it returns at least n"""
+    current = next(count)
+    if current + 1 < n:
+        collections.deque(itertools.islice(count, n - current - 1), maxlen=0)
+
+# The cyclic garbage collector is process wide: it is off while any thread
+# is in a pausing gcpaused() block, and restored when the last one leaves
+gcstate = threading.local()
+gclock = threading.Lock()
+gcpauses = {'threads': 0, 'enabled': False}
+
+def pausegc():
+    with gclock:
+        if not gcpauses['threads']:
+            gcpauses['enabled'] = gc.isenabled()
+            gc.disable()
+        gcpauses['threads'] += 1
+
+def resumegc():
+    with gclock:
+        gcpauses['threads'] -= 1
+        if not gcpauses['threads'] and gcpauses['enabled']:
+            gc.enable()
+
+@contextlib.contextmanager
+def gcpaused(pause=True):
+    """
+    Pause the cyclic garbage collector, unless pause is False. Rewriting
+    allocates many AST nodes that are all reachable, and the collections
+    triggered by them make staging large functions superlinear. Blocks may
+    nest and may be entered by several threads at once.
+
+    The collector is process wide: while any thread is in a block, it is
+    off for every thread, including those not staging anything.
+    """
+    if not pause:
+        yield
+        return
+    depth = getattr(gcstate, 'depth', 0)
+    if not depth:
+        pausegc()
+    gcstate.depth = depth + 1
+    try:
+        yield
+    finally:
+        gcstate.depth = depth
+        if not depth:
+            resumegc()
+
+@contextlib.contextmanager
+def gcresumed():
+    """
+    Undo the gcpaused() blocks of this thread, e.g. while running user code
+    in the middle of a traversal
+    """
+    depth = getattr(gcstate, 'depth', 0)
+    if depth:
+        gcstate.depth = 0
+        resumegc()
+    try:
+        yield
+    finally:
+        if depth:
+            pausegc()
+            gcstate.depth = depth
+
+class BoundedCache(object):
+    """
+    Bounded mapping that evicts entries in insertion order once maxsize is
+    exceeded, counting hits, misses and evictions. Subclasses refine the
+    eviction policy through touch() and evict().
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.touch(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.evict()
+            self.evictions += 1
+
+    def touch(self, key):
+        """Record a cache hit for key"""
+
+    def evict(self):
+        """Evict a single entry"""
+        self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove key, returning its value or default"""
+        return self.data.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self.data),
+                    maxsize=self.maxsize)
+
+FIFOCache = BoundedCache
+
+class LRUCache(BoundedCache):
+    """Bounded mapping that evicts the least recently used entry"""
+
+    def touch(self, key):
+        self.data[key] = self.data.pop(key)
+
+class LFUCache(BoundedCache):
+    """
+    Bounded mapping that evicts the least frequently used entry, and the
+    oldest one among those.
+    """
+
+    def __init__(self, maxsize=128):
+        super(LFUCache, self).__init__(maxsize)
+        self.counts = collections.defaultdict(int)
+
+    def touch(self, key):
+        self.counts[key] += 1
+
+    def evict(self):
+        # Never evict the entry that was just inserted, unless it is the
+        # only one (maxsize=0)
+        candidates = list(self.data)[:-1] or list(self.data)
+        key = min(candidates, key=lambda key: self.counts.get(key, 0))
+        self.pop(key)
+
+    def pop(self, key, default=None):
+        self.counts.pop(key, None)
+        return super(LFUCache, self).pop(key, default)
 
-    return temper
\ No newline at end of file
+    def clear(self):
+        super(LFUCache, self).clear()
+        self.counts.clear()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorization of elementwise loops into whole-array NumPy operations:
+
+    for i in range(A.shape[0]):         staged.temp.stop = A.shape[0]
+        out[i] = A[i] + B[i]      ->    staged.temp.out = out[:staged.temp.stop]
+                                        ...
+                                        np.add(staged.temp.A, staged.temp.B,
+                                               out=staged.temp.out,
+                                               casting='unsafe')
+
+The vectorized code runs only if all arrays are one-dimensional NumPy
+arrays of at least stop elements at runtime and the arrays written do not
+share memory with the other arrays, otherwise the original loop runs over
+range(staged.temp.stop). Loops that do not match the pattern are
+left alone.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ast
+
+from pystaging.astutils import copynode, materialize, Persisted
+from pystaging.quotation import symbol, persist
+from pystaging.optimize import Rewriter, single, assign, dotted, constint
+
+def vectorize(tree, numpy=None):
+    """
+    Vectorize elementwise loops over range(n) of which the body consists
+    of assignments to arrays indexed by the induction variable, of
+    expressions built from arithmetic, math functions, loop-invariant
+    names and constants, and arrays indexed by the induction variable.
+
+        numpy: the name of the numpy module in the generated code, or None
+               to persist the numpy module into it. Without NumPy
+               installed, tree is returned unchanged.
+    """
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return tree
+    return single(Vectorizer(numpy).visit(materialize(tree)))
+
+ufuncs = {
+    ast.Add: 'add', ast.Sub: 'subtract', ast.Mult: 'multiply',
+    ast.Div: 'divide', ast.FloorDiv: 'floor_divide', ast.Mod: 'remainder',
+    ast.Pow: 'power', ast.LShift: 'left_shift', ast.RShift: 'right_shift',
+    ast.BitOr: 'bitwise_or', ast.BitXor: 'bitwise_xor',
+    ast.BitAnd: 'bitwise_and', ast.USub: 'negative', ast.Invert: 'invert',
+}
+
+functions = {
+    'abs': 'absolute', 'math.fabs': 'fabs', 'math.sqrt': 'sqrt',
+    'math.exp': 'exp', 'math.log': 'log', 'math.sin': 'sin',
+    'math.cos': 'cos', 'math.tan': 'tan', 'math.tanh': 'tanh',
+}
+
+class NotElementwise(Exception):
+    """Raised when a loop does not match the elementwise pattern"""
+
+class Vectorizer(Rewriter):
+
+    def __init__(self, numpy='np'):
+        if not isinstance(numpy, basestring):
+            numpy = persist(numpy)
+        self.numpy = numpy
+
+    def visit_For(self, node):
+        node = self.generic_visit(node)
+        try:
+            return self.vectorize(node)
+        except NotElementwise:
+            return node
+
+    def vectorize(self, node):
+        stop = self.extent(node)
+        self.index = node.target.id
+        self.views = {}         # array name -> symbol of view
+        self.written = set()    # names of the arrays assigned to
+        self.invariants = set() # loop invariant names
+
+        for stmt in node.body:
+            self.check(stmt)
+        if self.invariants & set(self.views):
+            raise NotElementwise
+
+        stopvar = symbol('stop')
+        stmts = []
+        for name, view in sorted(self.views.iteritems()):
+            stmts.append(assign(view.name, ast.Subscript(
+                ast.Name(name, ast.Load()),
+                ast.Slice(None, stopvar.load, None), ast.Load())))
+        for stmt in node.body:
+            stmts.append(self.statement(stmt))
+
+        # Leave the induction variable bound as the loop would
+        stmts.append(assign(self.index, ast.BinOp(stopvar.load, ast.Sub(),
+                                                  ast.Num(1))))
+
+        # The guard needs the stop, evaluate it once for both versions
+        nonempty = ast.Compare(stopvar.load, [ast.Gt()], [ast.Num(0)])
+        vectorized = [ast.If(nonempty, stmts, [])] + node.orelse
+        loop = copynode(node, iter=copynode(node.iter, args=[stopvar.load]))
+
+        return [assign(stopvar.name, stop),
+                ast.If(self.guard(stopvar), vectorized, [loop])]
+
+    def guard(self, stopvar):
+        """
+        All arrays are one-dimensional NumPy arrays with at least stop
+        elements, so that the views have the same shape, and the arrays
+        written do not overlap the other arrays, e.g. out = A[1:] would
+        make the loop read values it wrote in earlier iterations
+        """
+        load = lambda name: ast.Name(name, ast.Load())
+        tests = [ast.Call(load('isinstance'),
+                          [load(name), self.numpyattr('ndarray')], [],
+                          None, None)
+                 for name in sorted(self.views)]
+        for name in sorted(self.views):
+            ndim = ast.Attribute(load(name), 'ndim', ast.Load())
+            length = ast.Subscript(ast.Attribute(load(name), 'shape',
+                                                 ast.Load()),
+                                   ast.Index(ast.Num(0)), ast.Load())
+            tests.append(ast.Compare(ndim, [ast.Eq()], [ast.Num(1)]))
+            tests.append(ast.Compare(length, [ast.GtE()], [stopvar.load]))
+        for written in sorted(self.written):
+            for name in sorted(self.views):
+                if name != written:
+                    overlap = ast.Call(self.numpyattr('may_share_memory'),
+                                       [load(written), load(name)], [],
+                                       None, None)
+                    tests.append(ast.UnaryOp(ast.Not(), overlap))
+        return ast.BoolOp(ast.And(), tests)
+
+    # __________________________________________________________________
+    # Pattern matching
+
+    def extent(self, node):
+        """Return the stop of a loop over range(stop) or range(0, stop)"""
+        call = node.iter
+        if not (isinstance(node.target, ast.Name) and
+                isinstance(call, ast.Call) and
+                dotted(call.func) in ('range', 'xrange') and
+                not (call.keywords or call.starargs or call.kwargs)):
+            raise NotElementwise
+        if len(call.args) == 1:
+            return call.args[0]
+        elif (len(call.args) == 2 and constint(call.args[0]) and
+                  call.args[0].n == 0):
+            return call.args[1]
+        raise NotElementwise
+
+    def isindexed(self, node):
+        """Whether node is array[i] with i the induction variable"""
+        return (isinstance(node, ast.Subscript) and
+                isinstance(node.value, ast.Name) and
+                node.value.id != self.index and
+                isinstance(node.slice, ast.Index) and
+                isinstance(node.slice.value, ast.Name) and
+                node.slice.value.id == self.index)
+
+    def check(self, stmt):
+        if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1:
+            target = stmt.targets[0]
+        elif isinstance(stmt, ast.AugAssign) and type(stmt.op) in ufuncs:
+            target = stmt.target
+        else:
+            raise NotElementwise
+
+        if not self.isindexed(target):
+            raise NotElementwise
+        self.array(target.value.id)
+        self.written.add(target.value.id)
+        self.checkexpr(stmt.value)
+
+    def checkexpr(self, node):
+        if self.isindexed(node):
+            self.array(node.value.id)
+        elif isinstance(node, ast.BinOp) and type(node.op) in ufuncs:
+            self.checkexpr(node.left)
+            self.checkexpr(node.right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in ufuncs:
+            self.checkexpr(node.operand)
+        elif isinstance(node, ast.Call):
+            if (dotted(node.func) not in functions or len(node.args) != 1 or
+                    node.keywords or node.starargs or node.kwargs):
+                raise NotElementwise
+            self.checkexpr(node.args[0])
+        elif isinstance(node, ast.Num):
+            pass
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            # Loop invariant, arrays may only be accessed through subscripts
+            if node.id == self.index:
+                raise NotElementwise
+            self.invariants.add(node.id)
+        else:
+            raise NotElementwise
+
+    def array(self, name):
+        if name not in self.views:
+            self.views[name] = symbol(name)
+
+    # __________________________________________________________________
+    # Code generation
+
+    def numpyattr(self, attr):
+        if isinstance(self.numpy, Persisted):
+            module = Persisted(self.numpy.id, self.numpy.value)
+        else:
+            module = ast.Name(self.numpy, ast.Load())
+        return ast.Attribute(module, attr, ast.Load())
+
+    def statement(self, stmt):
+        if isinstance(stmt, ast.Assign):
+            out = self.views[stmt.targets[0].value.id]
+            return self.compute(stmt.value, out)
+
+        out = self.views[stmt.target.value.id]
+        value = ast.BinOp(out.load, stmt.op, stmt.value)
+        return self.compute(value, out)
+
+    def compute(self, node, out):
+        """Compute node into the view out, without a temporary if possible"""
+        keywords = [ast.keyword('out', out.load),
+                    ast.keyword('casting', ast.Str('unsafe'))]
+        if isinstance(node, ast.BinOp):
+            args = [self.expr(node.left), self.expr(node.right)]
+            ufunc = ufuncs[type(node.op)]
+        elif isinstance(node, ast.UnaryOp):
+            args = [self.expr(node.operand)]
+            ufunc = ufuncs[type(node.op)]
+        elif isinstance(node, ast.Call):
+            args = [self.expr(node.args[0])]
+            ufunc = functions[dotted(node.func)]
+        else:
+            target = ast.Subscript(out.load, ast.Index(ast.Ellipsis()),
+                                   ast.Store())
+            return ast.Assign([target], self.expr(node))
+
+        call = ast.Call(self.numpyattr(ufunc), args, keywords, None, None)
+        return ast.Expr(call)
+
+    def expr(self, node):
+        """Rewrite an elementwise expression to a whole-array expression"""
+        if self.isindexed(node):
+            return self.views[node.value.id].load
+        elif isinstance(node, ast.Call):
+            func = self.numpyattr(functions[dotted(node.func)])
+            return ast.Call(func, [self.expr(node.args[0])], [], None, None)
+        elif isinstance(node, ast.BinOp):
+            return copynode(node, left=self.expr(node.left),
+                            right=self.expr(node.right))
+        elif isinstance(node, ast.UnaryOp):
+            return copynode(node, operand=self.expr(node.operand))
+        return node
@@ -97,7 +97,9 @@ class BindingVisitor(ast.NodeVisitor):
         self.bound[name].extend(self.free.pop(name, []))
 
     def freevar(self, name, node):
-        if name not in self.bound:
+        if name in self.bound:
+            self.bound[name].append(node)
+        else:
             self.free[node.id].append(node)
 
 # ______________________________________________________________________
@@ -128,4 +130,171 @@ class QuoteFinder(ast.NodeVisitor):
             assert isinstance(dst, ast.Name), dst
             self.quotes.add(node)
         else:
-            self.generic_visit(node)
\ No newline at end of file
+            self.generic_visit(node)
+
+# ______________________________________________________________________
+
+def isquote(node):
+    """Whether node is quote[...] or a 'with quote as name:' block"""
+    if isinstance(node, ast.Subscript):
+        return isinstance(node.value, ast.Name) and node.value.id == 'quote'
+    return (isinstance(node, ast.With) and
+            isinstance(node.context_expr, ast.Name) and
+            node.context_expr.id == 'quote')
+
+def isescape(node):
+    """Whether node is escape[...]"""
+    return (isinstance(node, ast.Subscript) and
+            isinstance(node.value, ast.Name) and node.value.id == 'escape')
+
+def rewrite(ast, stage):
+    """
+    Find quotations and escapes and replace each one by stage(node), in a
+    single traversal that also collects the bindings of the code outside
+    of them. stage is called in source order and typically processes the
+    quoted or escaped code recursively, so that every node is visited once
+    at its own quotation level.
+
+    Returns (tree, replacements, bindings), with replacements a dict
+    mapping the quote and escape nodes to their replacements, and bindings
+    as returned by bindings(tree, exclude=replacements).
+    """
+    v = QuoteRewriter(stage)
+    tree = v.rewrite(ast)
+    return tree, v.replacements, v.bindings
+
+class QuoteRewriter(ast.NodeTransformer, BindingVisitor):
+
+    def __init__(self, stage):
+        BindingVisitor.__init__(self)
+        self.stage = stage
+        self.replacements = {}
+
+    def rewrite(self, node):
+        result = []
+        self.collect(node, lambda node: result.append(self.visit(node)))
+        return result[0]
+
+    def visit_Subscript(self, node):
+        if isquote(node) or isescape(node):
+            return self.replace(node)
+        return self.generic_visit(node)
+
+    def visit_With(self, node):
+        if isquote(node):
+            assert isinstance(node.optional_vars, ast.Name), node.optional_vars
+            return self.replace(node)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        self.boundvar(node.name, node)
+        result = []
+        self.collect(node, lambda node: result.append(self.generic_visit(node)))
+        return result[0]
+
+    def visit_Name(self, node):
+        BindingVisitor.visit_Name(self, node)
+        return node
+
+    def replace(self, node):
+        replacement = self.stage(node)
+        self.replacements[node] = replacement
+        return replacement
+
+# ______________________________________________________________________
+
+def stagednames(ast):
+    """
+    Find the names loaded at staging time, i.e. outside of quotations or
+    inside escapes.
+    """
+    v = StagedNameFinder()
+    v.visit(ast)
+    return v.names
+
+class StagedNameFinder(ast.NodeVisitor):
+
+    def __init__(self):
+        self.names = set()
+        self.level = 0
+
+    def visit_Subscript(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == 'quote':
+            self.visit_level(node.slice, 1)
+        elif isinstance(node.value, ast.Name) and node.value.id == 'escape':
+            self.visit_level(node.slice, -1)
+        else:
+            self.generic_visit(node)
+
+    def visit_With(self, node):
+        ctx = node.context_expr
+        if isinstance(ctx, ast.Name) and ctx.id == 'quote':
+            for stmt in node.body:
+                self.visit_level(stmt, 1)
+        else:
+            self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if self.level <= 0 and isinstance(node.ctx, ast.Load):
+            self.names.add(node.id)
+
+    def visit_level(self, node, delta):
+        self.level += delta
+        self.visit(node)
+        self.level -= delta
+
+def quotednames(ast):
+    """
+    Find the names that are only bound to quotations at staging time, by
+    name = quote[...] or 'with quote as name:'. Escapes of these names
+    always splice in an AST.
+    """
+    v = QuotedNameFinder()
+    v.visit(ast)
+    return v.quoted - v.bound
+
+class QuotedNameFinder(StagedNameFinder):
+
+    def __init__(self):
+        super(QuotedNameFinder, self).__init__()
+        self.quoted = set()
+        self.bound = set() # names bound to anything else
+
+    def visit_Assign(self, node):
+        target, = node.targets if len(node.targets) == 1 else (None,)
+        if (self.level <= 0 and isinstance(target, ast.Name) and
+                isquote(node.value)):
+            self.quoted.add(target.id)
+            self.visit(node.value)
+        else:
+            self.generic_visit(node)
+
+    def visit_With(self, node):
+        var = node.optional_vars
+        if self.level <= 0 and isquote(node) and isinstance(var, ast.Name):
+            self.quoted.add(var.id)
+            for stmt in node.body:
+                self.visit_level(stmt, 1)
+        else:
+            super(QuotedNameFinder, self).visit_With(node)
+
+    def visit_Name(self, node):
+        if self.level <= 0 and not isinstance(node.ctx, ast.Load):
+            self.bound.add(node.id)
+
+    def visit_FunctionDef(self, node):
+        if self.level <= 0:
+            self.bound.add(node.name)
+        self.generic_visit(node)
+
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_Import(self, node):
+        if self.level <= 0:
+            for alias in node.names:
+                self.bound.add(alias.asname or alias.name.split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Global(self, node):
+        self.bound.update(node.names)
@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import
+
+import sys
+from pystaging.benchmarks import runner
+
+sys.exit(runner.main(sys.argv[1:]))